@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+# Manifest of the slices of a VS directory, kept in an SQLite database at its
+# root (manifest.db): one row per slice, with its repeat, ID ranges and job
+# script, written by vs_build.py (and vs_resume.py), then updated by
+# vs_submit.py with the job ID, submission time, retries, state and exit code of
+# its job, and with the resubmissions of the failed slices in supervised mode.
+# vs_report.py queries it instead of reading every file of the VS.
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import sqlite3
+import time
+
+
+MANIFEST_NAME = "manifest.db"
+
+# States of the slices whose job may still change state
+ACTIVE_STATES = ("submitted", "pending", "running")
+
+# States of the slices left alone by the supervised mode of vs_submit.py
+UNSUPERVISED_STATES = ("built", "resumed", "exhausted", "cancelled")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS slices (
+    id INTEGER PRIMARY KEY,
+    repeat INTEGER NOT NULL,
+    sliceIndex INTEGER NOT NULL,
+    ranges TEXT NOT NULL,
+    lower INTEGER NOT NULL,
+    upper INTEGER NOT NULL,
+    ligands INTEGER NOT NULL,
+    script TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    jobID TEXT,
+    submitTime TEXT,
+    state TEXT NOT NULL DEFAULT 'built',
+    exitCode INTEGER,
+    retries INTEGER NOT NULL DEFAULT 0,
+    resubmits INTEGER NOT NULL DEFAULT 0,
+    checked INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS slicesScript ON slices (script);
+CREATE INDEX IF NOT EXISTS slicesJob ON slices (jobID);
+"""
+
+# Columns added since the first manifests, with their definition
+ADDED_COLUMNS = (("resubmits", "INTEGER NOT NULL DEFAULT 0"),
+                 ("checked", "INTEGER NOT NULL DEFAULT 0"))
+
+
+def openManifest(vsDir, create=False):
+    """
+    Connect to the manifest of a VS directory, creating it when create is
+    True. Returns None when the VS has no manifest (built before it existed)
+    """
+
+    path = os.path.join(vsDir, MANIFEST_NAME)
+    if not create and not os.path.exists(path):
+        return None
+
+    connection = sqlite3.connect(path, timeout=60)
+    connection.executescript(SCHEMA)
+
+    columns = [row[1] for row in
+               connection.execute("PRAGMA table_info(slices)")]
+    with connection:
+        for column, definition in ADDED_COLUMNS:
+            if column not in columns:
+                connection.execute("ALTER TABLE slices ADD COLUMN " + column +
+                                   " " + definition)
+
+    return connection
+
+
+def sliceRow(repeat, sliceIndex, ranges, script, queue):
+    """
+    Manifest row of a slice: its repeat, index in the repeat, ID ranges (a
+    list of (lowerLimit, upperLimit)), and the path of its job script
+    relative to the VS directory
+    """
+
+    return (repeat, sliceIndex,
+            ",".join(str(lower) + "-" + str(upper) for lower, upper in ranges),
+            ranges[0][0], ranges[-1][1],
+            sum(upper - lower + 1 for lower, upper in ranges), script, queue)
+
+
+def replaceSlices(connection, repeats, rows):
+    """
+    Replace the slices of the repeats that were built again by the rows given
+    """
+
+    with connection:
+        connection.executemany("DELETE FROM slices WHERE repeat = ?",
+                               [(repeat,) for repeat in repeats])
+        addSlices(connection, rows)
+
+
+def addSlices(connection, rows):
+    """
+    Add the slice rows given (see sliceRow)
+    """
+
+    with connection:
+        connection.executemany("INSERT INTO slices (repeat, sliceIndex," +
+                               " ranges, lower, upper, ligands, script," +
+                               " queue) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               rows)
+
+
+def recordSubmission(connection, label, jobID, retries, size=None):
+    """
+    Record the job of a submitted script (label: its path relative to the VS
+    directory, followed by ":offset" for a chunk of a job array). The slices
+    of a job array chunk of size tasks get the ID of their task. A jobID of
+    None records a submission that failed
+    """
+
+    submitTime = time.strftime("%Y-%m-%d_%H:%M:%S")
+    state = "submitted" if jobID is not None else "unsubmitted"
+    script, sep, offset = label.partition(":")
+
+    with connection:
+        if not sep:
+            connection.execute("UPDATE slices SET jobID = ?, submitTime = ?," +
+                               " state = ?, exitCode = NULL, retries = ?," +
+                               " checked = 0 WHERE script = ?",
+                               (jobID, submitTime, state, retries, script))
+            return
+
+        offset = int(offset)
+        connection.execute("UPDATE slices SET jobID = ? || '_' ||" +
+                           " (sliceIndex - ?), submitTime = ?, state = ?," +
+                           " exitCode = NULL, retries = ?, checked = 0" +
+                           " WHERE script = ? AND sliceIndex > ? AND" +
+                           " sliceIndex <= ?",
+                           (jobID, offset, submitTime, state, retries,
+                            script, offset, offset + (size or 0)))
+
+
+def activeJobIDs(connection):
+    """
+    Return the job IDs of the slices whose job may still change state
+    """
+
+    cursor = connection.execute("SELECT DISTINCT jobID FROM slices WHERE" +
+                                " jobID IS NOT NULL AND state IN (?, ?, ?)",
+                                ACTIVE_STATES)
+
+    return [row[0] for row in cursor]
+
+
+def sliceJobIDs(connection):
+    """
+    Return the job ID of the slices that were submitted since they were
+    built, as a dictionary by script of dictionaries by slice index
+    """
+
+    sliceJobIDs = {}
+    cursor = connection.execute("SELECT script, sliceIndex, jobID FROM" +
+                                " slices WHERE jobID IS NOT NULL")
+    for script, sliceIndex, jobID in cursor:
+        sliceJobIDs.setdefault(script, {})[sliceIndex] = jobID
+
+    return sliceJobIDs
+
+
+def recordStates(connection, states):
+    """
+    Record the state and exit code of jobs, given as a dictionary of
+    (state, exitCode) by job ID
+    """
+
+    with connection:
+        connection.executemany("UPDATE slices SET state = ?, exitCode = ?" +
+                               " WHERE jobID = ? AND state IN (?, ?, ?)",
+                               [(state, exitCode, jobID) + ACTIVE_STATES
+                                for jobID, (state, exitCode)
+                                in states.items()])
+
+
+def resumeSlices(connection, repeat, lowerLimit, upperLimit, rows):
+    """
+    Mark the slices of a repeat with an ID range holding lowerLimit to
+    upperLimit as resumed (the range may be any of the ranges of a slice),
+    and add the rows of their continuation
+    """
+
+    cursor = connection.execute("SELECT id, ranges FROM slices WHERE" +
+                                " repeat = ? AND lower <= ? AND upper >= ?",
+                                (repeat, lowerLimit, upperLimit))
+    sliceIDs = [(sliceID,) for sliceID, ranges in cursor
+                if any(int(lower) <= lowerLimit and upperLimit <= int(upper)
+                       for lower, upper in [r.split("-") for r
+                                            in ranges.split(",")])]
+
+    with connection:
+        connection.executemany("UPDATE slices SET state = 'resumed' WHERE" +
+                               " id = ?", sliceIDs)
+        addSlices(connection, rows)
+
+
+def endedSlices(connection):
+    """
+    Return the (id, repeat, sliceIndex, ranges, script, jobID, state,
+    exitCode, resubmits) of the slices whose job ended (or whose submission
+    failed) and that were not checked by the supervised mode yet
+    """
+
+    states = ACTIVE_STATES + UNSUPERVISED_STATES
+    cursor = connection.execute("SELECT id, repeat, sliceIndex, ranges," +
+                                " script, jobID, state, exitCode, resubmits" +
+                                " FROM slices WHERE checked = 0 AND state" +
+                                " NOT IN (" + ", ".join("?" * len(states)) +
+                                ") ORDER BY repeat, lower", states)
+
+    return cursor.fetchall()
+
+
+def markChecked(connection, sliceIDs, state=None):
+    """
+    Mark the slices (given by their id) as checked by the supervised mode,
+    giving them a new state if any
+    """
+
+    with connection:
+        connection.executemany("UPDATE slices SET checked = 1," +
+                               " state = COALESCE(?, state) WHERE id = ?",
+                               [(state, sliceID) for sliceID in sliceIDs])
+
+
+def recordResubmission(connection, sliceJobIDs):
+    """
+    Record the new job of resubmitted slices, given as (id, jobID) pairs (a
+    jobID of None records a resubmission that failed)
+    """
+
+    submitTime = time.strftime("%Y-%m-%d_%H:%M:%S")
+
+    with connection:
+        connection.executemany("UPDATE slices SET jobID = ?, submitTime = ?," +
+                               " state = ?, exitCode = NULL, checked = 0," +
+                               " resubmits = resubmits + 1 WHERE id = ?",
+                               [(jobID, submitTime,
+                                 "submitted" if jobID is not None
+                                 else "unsubmitted", sliceID)
+                                for sliceID, jobID in sliceJobIDs])
+
+
+def activeCount(connection):
+    """
+    Return the number of slices whose job may still change state
+    """
+
+    cursor = connection.execute("SELECT COUNT(*) FROM slices WHERE state IN" +
+                                " (?, ?, ?)", ACTIVE_STATES)
+
+    return cursor.fetchone()[0]
+
+
+def stateCounts(connection):
+    """
+    Return the (repeat, state, slice count, ligand count) of each state of
+    each repeat
+    """
+
+    cursor = connection.execute("SELECT repeat, state, COUNT(*)," +
+                                " SUM(ligands) FROM slices GROUP BY repeat," +
+                                " state ORDER BY repeat, state")
+
+    return cursor.fetchall()
+
+
+def failedSlices(connection):
+    """
+    Return the (repeat, ranges, script, jobID, state, exitCode) of the slices
+    whose job ended without completing, or was not submitted
+    """
+
+    cursor = connection.execute("SELECT repeat, ranges, script, jobID," +
+                                " state, exitCode FROM slices WHERE state" +
+                                " NOT IN ('built', 'completed', 'resumed'," +
+                                " ?, ?, ?) ORDER BY repeat, lower",
+                                ACTIVE_STATES)
+
+    return cursor.fetchall()
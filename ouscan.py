@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Scans the ICM .ou files for the lines holding a marker ("SCORES>",
+# "Skipping", ...) without splitting the whole file into Python lines: the file
+# is memory mapped, the markers are located with bytes searches, and only the
+# lines holding them are decoded. Used by vs_results.py, vs_report.py,
+# vs_build.py and vs_resume.py
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import contextlib
+import mmap
+
+
+# Suffix of the .ou files holding the completed part of an interrupted slice,
+# whose remaining ligands are docked by a continuation job (vs_resume.py):
+# they have no FINISHED line, but no ligand is missing after them
+PART_SUFFIX = ".part.ou"
+
+
+@contextlib.contextmanager
+def mapOuFile(ouFilePath):
+    """
+    Memory map a .ou file for reading, and give its content as a bytes-like
+    object (empty files, which cannot be mapped, give b"")
+    """
+
+    with open(ouFilePath, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            data = None
+
+        if data is None:
+            yield b""
+            return
+
+        # The file is read once from start to end
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+
+        try:
+            yield data
+        finally:
+            data.close()
+
+
+def completeEnd(data, start=0):
+    """
+    Return the offset of the end of the last complete line after start. A last
+    line that is still being written by ICM (no end of line) is left out,
+    unless it is the FINISHED line
+    """
+
+    end = max(data.rfind(b"\n", start) + 1, start)
+    if data.find(b"FINISHED", end) != -1:
+        end = len(data)
+
+    return end
+
+
+def markerLines(data, marker, start=0, end=None):
+    """
+    Yield the lines between the start and end offsets that contain the marker
+    (bytes), decoded and without their end of line, in the order of the file
+    """
+
+    for lineStart, lineEnd in markerSpans(data, marker, start, end):
+        yield data[lineStart:lineEnd].decode(errors="replace")
+
+
+def countLines(data, marker, start=0, end=None):
+    """
+    Count the lines between the start and end offsets that contain the marker
+    (bytes), without decoding them
+    """
+
+    count = 0
+    for span in markerSpans(data, marker, start, end):
+        count += 1
+
+    return count
+
+
+def markerSpans(data, marker, start=0, end=None):
+    """
+    Yield the (start, end) offsets of each line containing the marker. Each
+    line is given once, even if the marker appears several times in it
+    """
+
+    if end is None:
+        end = len(data)
+
+    pos = data.find(marker, start, end)
+    while pos != -1:
+        lineStart = max(data.rfind(b"\n", start, pos) + 1, start)
+        lineEnd = data.find(b"\n", pos, end)
+        if lineEnd == -1:
+            lineEnd = end
+        yield lineStart, lineEnd
+        pos = data.find(marker, lineEnd, end)
+
+
+def ligandIDs(data, marker, start=0, end=None):
+    """
+    Yield the ligand IDs of the lines between the start and end offsets that
+    contain the marker: the "SCORES>  Lig <ID> ..." lines of the docked
+    ligands, or the "Skipping ligand <ID>, ..." lines of the skipped ones
+    """
+
+    for line in markerLines(data, marker, start, end):
+        ll = line.split()
+        if len(ll) < 3:
+            continue
+        try:
+            yield int(ll[2].rstrip(","))
+        except ValueError:
+            continue
+
+
+def lastLigandID(data, end=None):
+    """
+    Return the highest ligand ID completed (scored or skipped) by ICM up to the
+    end offset, or None if there is none
+    """
+
+    lastID = None
+    for marker in (b"SCORES>", b"Skipping"):
+        for ligID in ligandIDs(data, marker, 0, end):
+            if lastID is None or ligID > lastID:
+                lastID = ligID
+
+    return lastID
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+# Times and memory-profiles each stage of the VS analysis (vs_results.py,
+# vs_report.py and the plotting pipeline) on a synthetic VS directory
+# fabricated by vs_bench_data.py, so that regressions and speedups of these
+# scripts can be measured without running a VS on the cluster.
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import argparse
+import contextlib
+import multiprocessing
+import queue
+import resource
+import sys
+import time
+
+import vs_bench_data
+import vs_results
+import vs_report
+
+
+def main():
+    """
+    Run script
+    """
+
+    benchDir, ligNums, repeatNum, sliceSize, verbose, stages, jobs, top, \
+        outPath = parseArgs()
+
+    benchRows = []
+
+    for ligNum in ligNums:
+        # Generate the synthetic VS once per size, and reuse it afterwards
+        vsDir = os.path.join(benchDir, "bench" + str(ligNum))
+        if not os.path.exists(vsDir):
+            print("\nGENERATING: " + vsDir + "\n")
+            with open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                vs_bench_data.generateVs(vsDir, ligNum, repeatNum, sliceSize,
+                                         verbose=verbose)
+
+        print("\nBENCHMARKING: " + vsDir + "\n")
+        printHeader()
+
+        for stage in stages:
+            timings, maxRss, exitCode = runStage(stage, vsDir, jobs, top)
+            if exitCode is not None:
+                print("{:<16} failed (exit code {})".format(stage,
+                                                            exitCode))
+                continue
+            # A stage that could not be run returns no timing
+            if timings is None:
+                print("{:<16} skipped (plotting dependencies missing)".format(
+                    stage))
+                continue
+            for step, seconds in timings:
+                row = [ligNum, stage, step, seconds, maxRss]
+                benchRows.append(row)
+                printRow(row)
+            sys.stdout.flush()
+
+    if outPath:
+        writeBenchFile(outPath, benchRows)
+
+    print("")
+
+
+def parseArgs():
+    """
+    Define arguments, parse and return them
+    """
+
+    stageNames = ", ".join(sorted(STAGES.keys()))
+
+    descr = "Benchmark the VS analysis scripts on synthetic VS directories"
+    descr_benchDir = "Directory where the synthetic VS are generated (and" \
+        " reused by the following runs)"
+    descr_ligNums = "Comma separated library sizes to benchmark (default" \
+        " 10000)"
+    descr_repeatNum = "Number of repeats of the synthetic VS (default 3)"
+    descr_sliceSize = "Slice size of the synthetic VS (default 1000)"
+    descr_verbose = "Extra log lines per ligand in the .ou files (default 0)"
+    descr_stages = "Comma separated stages to run among: " + stageNames + \
+        " (default all)"
+    descr_jobs = "Number of processes for the results_jobs stage (default 4)"
+    descr_top = "Number of ligands for the results_top stage (default 1000)"
+    descr_out = "Append the measurements to this .csv file, to compare runs"
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("benchDir", help=descr_benchDir)
+    parser.add_argument("--ligNums", default="10000",
+                        help=descr_ligNums)
+    parser.add_argument("--repeatNum", type=int, default=3,
+                        help=descr_repeatNum)
+    parser.add_argument("--sliceSize", type=int, default=1000,
+                        help=descr_sliceSize)
+    parser.add_argument("--verbose", type=int, default=0, help=descr_verbose)
+    parser.add_argument("--stages", help=descr_stages)
+    parser.add_argument("--jobs", type=int, default=4, help=descr_jobs)
+    parser.add_argument("--top", type=int, default=1000, help=descr_top)
+    parser.add_argument("--out", help=descr_out)
+
+    args = parser.parse_args()
+
+    ligNums = [int(ligNum) for ligNum in args.ligNums.split(",")]
+
+    if args.stages:
+        stages = args.stages.split(",")
+    else:
+        stages = sorted(STAGES.keys())
+    for stage in stages:
+        if stage not in STAGES:
+            print("Unknown stage '" + stage + "', stages are: " + stageNames)
+            sys.exit()
+
+    return args.benchDir, ligNums, args.repeatNum, args.sliceSize, \
+        args.verbose, stages, args.jobs, args.top, args.out
+
+
+def runStage(stage, vsDir, jobs, top):
+    """
+    Run a stage in a new process, so that its peak memory is measured on its
+    own. Returns the list of (step, seconds) timings of the stage, the peak
+    resident memory of the process in MB, and None. When the process died
+    before sending its results (the stage crashed), returns None, None and
+    its exit code
+    """
+
+    resultQueue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=stageProcess,
+                                      args=(resultQueue, stage, vsDir, jobs,
+                                            top))
+    process.start()
+
+    while True:
+        try:
+            timings, maxRss = resultQueue.get(timeout=1.)
+            break
+        except queue.Empty:
+            if process.is_alive():
+                continue
+            # The results may have been sent just before the process ended
+            try:
+                timings, maxRss = resultQueue.get(timeout=1.)
+                break
+            except queue.Empty:
+                process.join()
+                return None, None, process.exitcode
+
+    process.join()
+
+    return timings, maxRss, None
+
+
+def stageProcess(queue, stage, vsDir, jobs, top):
+    """
+    Body of the process running a stage: the output of the scripts is silenced
+    and the stage timings and peak memory are sent back through the queue
+    """
+
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        timings = STAGES[stage](vsDir, jobs, top)
+
+    # ru_maxrss is in KB on Linux
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    queue.put((timings, maxRss))
+
+
+class stepTimer:
+    """
+    Collects the time spent in each step of a stage
+    """
+
+    def __init__(self):
+        self.timings = []
+        self.start = time.time()
+
+    def step(self, name):
+        """
+        Record the time since the previous step under the given name
+        """
+        now = time.time()
+        self.timings.append((name, now - self.start))
+        self.start = now
+
+
+def benchResults(vsDir, jobs, top, stream=False, useJobs=False):
+    """
+    vs_results.py extraction of the full results, step by step
+    """
+
+    projName = os.path.basename(os.path.normpath(vsDir))
+    timer = stepTimer()
+
+    table, totalRepeatNum, repCounts = vs_results.collectScoreData(
+        vsDir, stream, jobs if useJobs else 1)
+    timer.step("collectScoreData")
+
+    table = vs_results.removeFailed(table, totalRepeatNum,
+                                    999999999999999999999, repCounts)
+    timer.step("removeFailed")
+
+    bestTable = vs_results.sortRepeats(table)
+    timer.step("sortRepeats")
+
+    vs_results.writeResultFiles(bestTable, projName + "_bench", vsDir)
+    timer.step("writeResultFiles")
+
+    return timer.timings
+
+
+def benchResultsStream(vsDir, jobs, top):
+    """
+    vs_results.py extraction with -stream
+    """
+
+    return benchResults(vsDir, jobs, top, stream=True)
+
+
+def benchResultsJobs(vsDir, jobs, top):
+    """
+    vs_results.py extraction with --jobs
+    """
+
+    return benchResults(vsDir, jobs, top, useJobs=True)
+
+
+def benchRepeatFiles(vsDir, jobs, top):
+    """
+    vs_results.py writing of the results of each repeat. The table is parsed
+    first without being timed (its memory counts in the peak of the stage)
+    """
+
+    projName = os.path.basename(os.path.normpath(vsDir))
+
+    table, totalRepeatNum, repCounts = vs_results.collectScoreData(vsDir,
+                                                                   False, 1)
+    table = vs_results.removeFailed(table, totalRepeatNum,
+                                    999999999999999999999, repCounts)
+
+    timer = stepTimer()
+    vs_results.writeRepeatFiles(table, totalRepeatNum, projName + "_bench",
+                                vsDir)
+    timer.step("writeRepeatFiles")
+
+    return timer.timings
+
+
+def benchResultsTop(vsDir, jobs, top):
+    """
+    vs_results.py extraction with --top
+    """
+
+    projName = os.path.basename(os.path.normpath(vsDir))
+    timer = stepTimer()
+
+    topTable = vs_results.collectTopScores(vsDir, top, 999999999999999999999)
+    timer.step("collectTopScores")
+
+    vs_results.writeTopFile(topTable, top, projName + "_bench", vsDir)
+    timer.step("writeTopFile")
+
+    return timer.timings
+
+
+def benchReport(vsDir, jobs, top):
+    """
+    vs_report.py scan of the .ou files of the repeats
+    """
+
+    timer = stepTimer()
+
+    specs, skipCount = vs_report.loopOverRepeats(os.path.abspath(vsDir))
+    timer.step("loopOverRepeats")
+
+    return timer.timings
+
+
+def benchPlotting(vsDir, jobs, top):
+    """
+    Reading and intersecting a results file, and writing the enrichment data,
+    as done by vs_plot_roc.py and vs_plot_ef.py. Returns None when matplotlib
+    or scikit-learn are not installed
+    """
+
+    try:
+        import plotting
+    except ImportError:
+        return None
+
+    projName = os.path.basename(os.path.normpath(vsDir))
+    resultsPath = os.path.join(vsDir, "results_" + projName + ".csv")
+    timer = stepTimer()
+
+    # Use the first 1% of the library as true positives and the rest as false
+    # positives, as a ROC curve would
+    with open(resultsPath) as f:
+        ligNum = sum(1 for line in f) - 1
+    truePosNum = max(1, ligNum // 100)
+    truePosStr = "1-" + str(truePosNum)
+    falsePosStr = str(truePosNum + 1) + "-" + str(ligNum)
+
+    # The plotting class writes its log file in the current directory
+    cwd = os.getcwd()
+    os.chdir(vsDir)
+    try:
+        p = plotting.plotting("bench plotting")
+        truePosIDlist = p.makeIDlist(truePosStr, "", printOut=False)
+        falsePosIDlist = p.makeIDlist(falsePosStr, "", printOut=False)
+        libraryIDlist = truePosIDlist + falsePosIDlist
+        timer.step("makeIDlist")
+
+        vsIntersects, ligIDintersectSet = p.intersectResults(
+            [os.path.abspath(os.path.basename(resultsPath))], libraryIDlist)
+        timer.step("intersectResults")
+
+        p.writePercFile(vsIntersects[0], os.path.basename(resultsPath), "ROC",
+                        {}, "FP", falsePosStr, falsePosIDlist,
+                        len(falsePosIDlist), "TP", truePosStr, truePosIDlist,
+                        len(truePosIDlist))
+        timer.step("writePercFile")
+    finally:
+        os.chdir(cwd)
+
+    return timer.timings
+
+
+# Stages that can be benchmarked, and the functions running them
+STAGES = {"results": benchResults,
+          "results_stream": benchResultsStream,
+          "results_jobs": benchResultsJobs,
+          "results_repeats": benchRepeatFiles,
+          "results_top": benchResultsTop,
+          "report": benchReport,
+          "plotting": benchPlotting}
+
+
+def printHeader():
+    """
+    Print the header of the measurements table
+    """
+
+    print("{:<16} {:<20} {:>10} {:>12}".format("STAGE", "STEP", "SECONDS",
+                                               "PEAK MB"))
+
+
+def printRow(row):
+    """
+    Print one measurement: ligNum, stage, step, seconds, peak memory
+    """
+
+    print("{:<16} {:<20} {:>10.2f} {:>12.1f}".format(row[1], row[2], row[3],
+                                                     row[4]))
+
+
+def writeBenchFile(outPath, benchRows):
+    """
+    Append the measurements to a .csv file, with the date of the run
+    """
+
+    newFile = not os.path.exists(outPath)
+    date = time.strftime("%Y-%m-%d_%H:%M:%S")
+
+    with open(outPath, "a") as f:
+        if newFile:
+            f.write("date,ligNum,stage,step,seconds,peakMB\n")
+        for ligNum, stage, step, seconds, maxRss in benchRows:
+            f.write("{},{},{},{},{:.3f},{:.1f}\n".format(date, ligNum, stage,
+                                                          step, seconds,
+                                                          maxRss))
+
+    print("\nMeasurements written to: " + outPath)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# Fabricates the files of a VS directory as they would be found after a VS
+# ran on a cluster: repeat directories containing ICM .ou files (with SCORES>
+# lines, Skipping lines and FINISHED markers), empty .out files, and the
+# results .csv file. Used by vs_bench.py to measure how the analysis scripts
+# scale, without having to run a VS.
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import argparse
+import random
+import array
+import sys
+
+
+def main():
+    """
+    Run script
+    """
+
+    vsDir, ligNum, repeatNum, sliceSize, skipRate, failRate, truncRate, \
+        verbose, seed = parseArgs()
+
+    generateVs(vsDir, ligNum, repeatNum, sliceSize, skipRate, failRate,
+               truncRate, verbose, seed)
+
+
+def parseArgs():
+    """
+    Define arguments, parse and return them
+    """
+
+    descr = "Generate a synthetic VS directory for benchmarking"
+    descr_vsDir = "VS directory to be created (its name is the project name)"
+    descr_ligNum = "Number of ligands in the library (e.g. 10000 to 10000000)"
+    descr_repeatNum = "Number of repeats (default 3)"
+    descr_sliceSize = "Size of the slices, one .ou file per slice and repeat" \
+        " (default 1000)"
+    descr_skipRate = "Fraction of ligands skipped by ICM (default 0.01)"
+    descr_failRate = "Fraction of ligands missing from a repeat (default" \
+        " 0.001)"
+    descr_truncRate = "Fraction of slices truncated, as when hitting the" \
+        " walltime (default 0.01)"
+    descr_verbose = "Number of extra log lines written per ligand, to mimic" \
+        " verbose ICM output (default 0)"
+    descr_seed = "Seed of the random generator (default 0)"
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("vsDir", help=descr_vsDir)
+    parser.add_argument("ligNum", type=int, help=descr_ligNum)
+    parser.add_argument("--repeatNum", type=int, default=3,
+                        help=descr_repeatNum)
+    parser.add_argument("--sliceSize", type=int, default=1000,
+                        help=descr_sliceSize)
+    parser.add_argument("--skipRate", type=float, default=0.01,
+                        help=descr_skipRate)
+    parser.add_argument("--failRate", type=float, default=0.001,
+                        help=descr_failRate)
+    parser.add_argument("--truncRate", type=float, default=0.01,
+                        help=descr_truncRate)
+    parser.add_argument("--verbose", type=int, default=0, help=descr_verbose)
+    parser.add_argument("--seed", type=int, default=0, help=descr_seed)
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.vsDir):
+        print("The directory " + args.vsDir + " already exists")
+        sys.exit()
+
+    return args.vsDir, args.ligNum, args.repeatNum, args.sliceSize, \
+        args.skipRate, args.failRate, args.truncRate, args.verbose, args.seed
+
+
+def generateVs(vsDir, ligNum, repeatNum=3, sliceSize=1000, skipRate=0.01,
+               failRate=0.001, truncRate=0.01, verbose=0, seed=0):
+    """
+    Write the repeat directories of a synthetic VS of ligNum ligands, and its
+    results file. The VS is generated one slice at a time (for all repeats),
+    so that memory does not depend on ligNum. Returns the path to the results
+    file
+    """
+
+    rand = random.Random(seed)
+    projName = os.path.basename(os.path.normpath(vsDir))
+
+    for repeat in range(1, repeatNum + 1):
+        os.makedirs(os.path.join(vsDir, str(repeat)))
+
+    # The best repeat of each ligand is written unsorted to a temporary file,
+    # keeping only its score and offset in memory, then sorted by score
+    resultsPath = os.path.join(vsDir, "results_" + projName + ".csv")
+    tmpPath = resultsPath + ".tmp"
+    bestScores = array.array("d")
+    bestOffsets = array.array("q")
+
+    with open(tmpPath, "wb") as tmpFile:
+        for lowerLimit in range(1, ligNum + 1, sliceSize):
+            upperLimit = min(lowerLimit + sliceSize - 1, ligNum)
+
+            # Properties of each ligand that do not change between repeats: its
+            # name, size, and a base score around which the score of each
+            # repeat varies. Skipped ligands are skipped in every repeat
+            ligands = {}
+            for ligID in range(lowerLimit, upperLimit + 1):
+                skipped = rand.random() < skipRate
+                ligands[ligID] = (skipped, "ZINC{:08d}".format(ligID),
+                                  rand.randint(10, 60), rand.randint(6, 25),
+                                  rand.gauss(-20., 7.))
+
+            bestLines = {}
+            for repeat in range(1, repeatNum + 1):
+                repeatDir = os.path.join(vsDir, str(repeat))
+                truncated = rand.random() < truncRate
+                writeOuFile(repeatDir, projName, repeat, lowerLimit,
+                            upperLimit, ligands, bestLines, failRate,
+                            truncated, verbose, rand)
+
+            for ligID in sorted(bestLines.keys()):
+                score, csvLine = bestLines[ligID]
+                bestScores.append(score)
+                bestOffsets.append(tmpFile.tell())
+                tmpFile.write(csvLine.encode())
+
+            print("\tSLICE:" + str(lowerLimit) + "-" + str(upperLimit))
+            sys.stdout.flush()
+
+    # Write the best repeats sorted by score
+    order = sorted(range(len(bestScores)), key=bestScores.__getitem__)
+    with open(tmpPath, "rb") as tmpFile, open(resultsPath, "w") as f:
+        f.write("No,Nat,Nva,dEhb,dEgrid,dEin,dEsurf" +
+                ",dEel,dEhp,Score,mfScore,Name,Run#\n")
+        for i in order:
+            tmpFile.seek(bestOffsets[i])
+            f.write(tmpFile.readline().decode())
+    os.remove(tmpPath)
+
+    print("\tRESULTS:" + resultsPath)
+
+    return resultsPath
+
+
+def writeOuFile(repeatDir, projName, repeat, lowerLimit, upperLimit, ligands,
+                bestLines, failRate, truncated, verbose, rand):
+    """
+    Write the .ou file of one slice of a repeat, and the empty .out file of its
+    job. A truncated slice stops part way, without the FINISHED marker
+    """
+
+    lines = ["Info> ICM-Pro 3.8-4 (synthetic benchmark output)\n",
+             "Info> project " + projName + " from=" + str(lowerLimit) +
+             " to=" + str(upperLimit) + "\n"]
+
+    lastID = upperLimit
+    if truncated:
+        lastID = rand.randint(lowerLimit, upperLimit)
+
+    for ligID in range(lowerLimit, lastID + 1):
+        skipped, name, nat, nva, baseScore = ligands[ligID]
+
+        for i in range(verbose):
+            lines.append("Info> ligand " + str(ligID) + " MC step " + str(i) +
+                         " energy " + "{:.3f}".format(rand.uniform(-50, 50)) +
+                         "\n")
+
+        if skipped:
+            if rand.random() < 0.5:
+                lines.append("Skipping ligand " + str(ligID) +
+                             ", LogP " + "{:.2f}".format(rand.uniform(6, 9)) +
+                             " > 6.00\n")
+            else:
+                lines.append("Skipping ligand " + str(ligID) +
+                             ", Number of torsions " + str(nva + 10) +
+                             " > 20\n")
+            continue
+
+        # Ligands that failed in this repeat leave no SCORES> line
+        if rand.random() < failRate:
+            continue
+
+        score = baseScore + rand.gauss(0., 2.)
+        terms = [rand.uniform(-6, 0), rand.uniform(-35, 0),
+                 rand.uniform(0, 6), rand.uniform(0, 15),
+                 rand.uniform(-4, 0), rand.uniform(-6, 0)]
+        mfScore = rand.uniform(-120, 0)
+        lines.append("SCORES>  Lig " + str(ligID) +
+                     " Nat= " + str(nat) + " Nva= " + str(nva) +
+                     " dEhb= {:.2f} dEgrid= {:.2f} dEin= {:.2f}"
+                     " dEsurf= {:.2f} dEel= {:.2f} dEhp= {:.2f}".format(*terms) +
+                     " Score= {:.2f} mfScore= {:.2f}".format(score, mfScore) +
+                     " Name= " + name + " completed\n")
+
+        csvLine = ",".join([str(ligID), str(nat), str(nva)] +
+                           ["{:.2f}".format(t) for t in terms] +
+                           ["{:.2f}".format(score), "{:.2f}".format(mfScore),
+                            name, str(repeat)]) + "\n"
+        score = round(score, 2)
+        if ligID not in bestLines or score < bestLines[ligID][0]:
+            bestLines[ligID] = (score, csvLine)
+
+    if not truncated:
+        lines.append("%FINISHED\n")
+
+    ouPath = os.path.join(repeatDir, projName + "_" + str(upperLimit) + ".ou")
+    with open(ouPath, "w") as f:
+        f.writelines(lines)
+
+    # Job output file, empty when no error occured
+    outPath = os.path.join(repeatDir, projName + "_" + str(upperLimit) + ".out")
+    open(outPath, "w").close()
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,26 @@ import socket
 import json
 import datetime
 import time
+import math
+import numpy as np
+
+import manifest
+import ouscan
+import vs_results
+
+# Seconds before the end of the walltime at which the jobs staged to the
+# node-local scratch are signalled (SLURM --signal, SGE s_rt), to copy their
+# results back
+SCRATCH_SIGNAL_TIME = 120
+
+# Memory requested for the docking of a slice, in MB
+SLICE_MEM = 1024
+
+# Unselected ligands docked between two selected ligands of the adaptive
+# repeats and of stage 2, rather than starting a new ICM run (and .ou file)
+# for the next ID range: a run loads the maps and the library index, which
+# costs about as much as docking a few ligands
+DEFAULT_GAP = 3
 
 def main():
     """
@@ -24,7 +44,9 @@ def main():
 
     # Getting all the args
     libStart, libEnd, sliceSize, repeatNum, thor, \
-        walltime, setupDir, projName, queue = parsing()
+        walltime, setupDir, projName, queue, adaptive, cutoff, window, \
+        gap, stage2, stage2Thor, stage2Repeats, stage2Walltime, balance, \
+        ligandTime, workers, cores, fill, link, scratch = parsing()
 
     # Get the path from the Json file
     icmHome = getPath()
@@ -36,9 +58,43 @@ def main():
     # Get current working directory
     workDir = os.getcwd()
 
+    # Names of the setup files staged to the node-local scratch by each job
+    scratchFiles = None
+    if scratch:
+        scratchFiles = sorted(os.path.basename(filePath)
+                              for filePath in glob.glob(setupDir + "/*"))
+
+    # Dock again only the ligands missing from the repeats of a VS that ran
+    if fill:
+        buildFill(libStart, libEnd, sliceSize, repeatNum, thor, walltime,
+                  setupDir, projName, queue, workDir, icmHome, balance,
+                  ligandTime, workers, cores, link, scratchFiles)
+        return
+
+    # A multi-stage VS first docks the whole library (stage 1). Once all its
+    # repeats have results, the same command builds stage 2 in stage2/
+    if stage2 is not None and all(repeatHasResults(workDir + "/" + str(r))
+                                  for r in range(1, repeatNum + 1)):
+        buildStage2(libStart, libEnd, sliceSize, repeatNum, setupDir,
+                    projName, queue, gap, stage2, stage2Thor, stage2Repeats,
+                    stage2Walltime, workDir, icmHome, balance, ligandTime,
+                    workers, cores, link, scratchFiles)
+        return
+
+    # An adaptive VS first runs repeat 1 over the whole library. Once its
+    # results are in, the later repeats are built for the ligands scoring
+    # close to the cutoff only, and repeat 1 is kept as it is
+    firstRepeat = 1
+    if adaptive and repeatHasResults(workDir + "/1"):
+        firstRepeat = 2
+    lastRepeat = repeatNum
+    if adaptive and firstRepeat == 1:
+        lastRepeat = 1
+
     # Clean files present in the current repeat directories, if any
     for repeatDir in glob.glob(workDir + "/[0-9]*"):
-        cleanRepeatDir(repeatDir)
+        if int(os.path.basename(repeatDir)) >= firstRepeat:
+            cleanRepeatDir(repeatDir)
 
     reportLines.append("\nPARAMETERS:\n")
     reportLines.append("\t libStart: " + str(libStart))
@@ -49,6 +105,15 @@ def main():
     reportLines.append("\t thoroughness: " + thor)
     reportLines.append("\t setupDir: " + setupDir)
     reportLines.append("\t projName: " + projName)
+    if adaptive:
+        reportLines.append("\t adaptive cutoff: " + str(cutoff))
+        reportLines.append("\t adaptive window: " + str(window))
+        reportLines.append("\t adaptive gap: " + str(gap))
+    if stage2 is not None:
+        reportLines.append("\t stage 2 top: " + str(stage2) + "%")
+    if balance:
+        reportLines.append("\t balanced with: " + balance)
+        reportLines.append("\t ligand time: " + str(ligandTime) + " s")
     reportLines.append("\n")
 
     # grep the parameters to lookout for in the .dtb file, and print them out
@@ -57,13 +122,49 @@ def main():
     reportLines.append("\n***********************\n")
 
     # Creating the repeats directories, which are copies of the setupDir
-    reportLines = createRepeats(repeatNum, setupDir, reportLines)
+    reportLines = createRepeats(repeatNum, setupDir, reportLines,
+                                firstRepeat, lastRepeat, link=link)
 
     reportLines.append("\n***********************\n")
 
+    # The ligand ID ranges to dock: the whole library, or the ligands
+    # selected from the results of repeat 1 for the later repeats of an
+    # adaptive VS
+    if firstRepeat == 1:
+        ranges = [(libStart, libEnd)]
+        reportLines = removeAdaptivePlan(workDir, reportLines)
+    else:
+        ranges, reportLines = adaptiveRanges(workDir, libStart, libEnd,
+                                             cutoff, window, gap,
+                                             repeatNum, reportLines)
+        reportLines.append("\n***********************\n")
+
+    # Cut them into slices of sliceSize ligands, or of balanced predicted
+    # runtimes
+    slices, sliceTimes, reportLines = makeSlices(ranges, sliceSize, libStart,
+                                                 libEnd, balance, ligandTime,
+                                                 walltime, reportLines)
+
     # Create the .slurm slices
-    reportLines = createSlices(libStart, libEnd, sliceSize, walltime, thor,
-                               projName, repeatNum, queue, reportLines, icmHome)
+    repeatSlices = [(repeat, slices)
+                    for repeat in range(firstRepeat, lastRepeat + 1)]
+    reportLines = createSlices(repeatSlices, libStart, libEnd, walltime, thor,
+                               projName, queue, reportLines, icmHome,
+                               sliceTimes=sliceTimes, workers=workers,
+                               cores=cores, scratchFiles=scratchFiles)
+
+    if adaptive and firstRepeat == 1:
+        reportLines.append("\nADAPTIVE: once repeat 1 has completed, run" +
+                           " this command again to build repeats 2 to " +
+                           str(repeatNum))
+    if stage2 is not None:
+        reportLines.append("\nSTAGE 2: once stage 1 has completed, run" +
+                           " this command again to build stage 2 in " +
+                           workDir + "/stage2")
+    elif glob.glob(workDir + "/stage2/[0-9]*"):
+        reportLines.append("\nWARNING: the stage2/ directory of a previous" +
+                           " multi-stage VS is present, vs_results.py will" +
+                           " merge its results")
 
     reportLines.append("\n")
 
@@ -85,7 +186,55 @@ def parsing():
     descr_thor = "Thoroughness of the docking (format: 5.)"
     descr_walltime = "Walltime for a single slice (format: 1-24:00:00)"
     descr_setupDir = "Name of the directory containing setup files"
-    descr_queue = "Queuing system to be used (sge/slurm/slurm-srun)"
+    descr_queue = "Queuing system to be used (sge/slurm/slurm-srun/" \
+        "slurm-array/slurm-pull/slurm-node)"
+    descr_adaptive = "Adaptive repeats: build repeat 1 over the whole" \
+        " library, then (running the same command once repeat 1 has" \
+        " completed) build the later repeats only for the ligands whose" \
+        " score in repeat 1 is within --window of --cutoff"
+    descr_cutoff = "Hit cutoff score of the adaptive repeats"
+    descr_window = "Score window around the cutoff of the ligands docked" \
+        " again in the adaptive repeats. Default is 3.0"
+    descr_gap = "Dock up to this number of unselected ligands between two" \
+        " selected ligands in the adaptive repeats (or in stage 2), rather" \
+        " than starting a new ICM run for the next range. 0 docks the" \
+        " selected ligands only. Default is " + str(DEFAULT_GAP)
+    descr_stage2 = "Multi-stage VS: dock the whole library first (stage 1)," \
+        " then (running the same command once stage 1 has completed) build" \
+        " stage 2 in stage2/ for this percentage of the best scoring ligands"
+    descr_stage2Thor = "Thoroughness of the stage 2 docking (format: 10.)"
+    descr_stage2Repeats = "Number of repeats of stage 2. Default is" \
+        " repeatNum"
+    descr_stage2Walltime = "Walltime for a single slice of stage 2. Default" \
+        " is walltime"
+    descr_balance = "Balance the slices on the predicted docking time of" \
+        " their ligands rather than on their number, with the ligand sizes" \
+        " and torsions read from a .sdf library, or from the .ou files of a" \
+        " previous VS directory of the same library"
+    descr_ligandTime = "Average docking time of a ligand in seconds, used to" \
+        " predict the walltime of the balanced slices. Default is 30"
+    descr_workers = "With slurm-pull, number of worker jobs per repeat," \
+        " claiming the slices from the queue of the repeat until it is" \
+        " empty (with slurm-node, number of node jobs per repeat). Default" \
+        " is 10"
+    descr_cores = "With slurm-node, cores of a node: the minimum number of" \
+        " cores of the nodes allocated, and the number of slices per node" \
+        " job used to plan the number of node jobs. Each node job runs one" \
+        " worker per core it is given (SLURM_CPUS_ON_NODE). Default is 16"
+    descr_nodeMem = "With slurm-node, memory of a node in MB, used to plan" \
+        " the number of node jobs: no more slices are planned per node than" \
+        " fit in it, at 1024 MB each (the node jobs also limit their" \
+        " workers to the memory they are given)"
+    descr_fill = "Fill the gaps of a VS that ran: build slices docking only" \
+        " the ligands missing from each repeat (neither scored nor skipped" \
+        " in its .ou files), keeping the results in place"
+    descr_link = "Link the setup files into the repeat directories rather" \
+        " than copying them (hard links, or symbolic links across" \
+        " filesystems). The .dtb project file, written by ICM, is still copied"
+    descr_scratch = "Stage the setup files of each job to the node-local" \
+        " scratch ($TMPDIR) and run ICM there. The files written by ICM are" \
+        " copied back to the repeat directory when the job exits, including" \
+        " when it is signalled at the end of its walltime"
 
     # Defining the arguments
     parser = argparse.ArgumentParser(description=descr)
@@ -97,6 +246,28 @@ def parsing():
     parser.add_argument("walltime", help=descr_walltime)
     parser.add_argument("setupDir", help=descr_setupDir)
     parser.add_argument("queue", help=descr_queue)
+    parser.add_argument("-adaptive", action="store_true",
+                        help=descr_adaptive)
+    parser.add_argument("--cutoff", type=float, help=descr_cutoff)
+    parser.add_argument("--window", type=float, default=3.0,
+                        help=descr_window)
+    parser.add_argument("--gap", type=int, default=DEFAULT_GAP,
+                        help=descr_gap)
+    parser.add_argument("--stage2", type=float, help=descr_stage2)
+    parser.add_argument("--stage2Thor", help=descr_stage2Thor)
+    parser.add_argument("--stage2Repeats", type=int,
+                        help=descr_stage2Repeats)
+    parser.add_argument("--stage2Walltime", help=descr_stage2Walltime)
+    parser.add_argument("--balance", help=descr_balance)
+    parser.add_argument("--ligandTime", type=float, default=30.,
+                        help=descr_ligandTime)
+    parser.add_argument("--workers", type=int, default=10,
+                        help=descr_workers)
+    parser.add_argument("--cores", type=int, default=16, help=descr_cores)
+    parser.add_argument("--nodeMem", type=int, help=descr_nodeMem)
+    parser.add_argument("-fill", action="store_true", help=descr_fill)
+    parser.add_argument("-link", action="store_true", help=descr_link)
+    parser.add_argument("-scratch", action="store_true", help=descr_scratch)
 
     # Parsing and storing into variables
     args = parser.parse_args()
@@ -115,12 +286,75 @@ def parsing():
     dtbFileName = glob.glob(setupDir + "/*.dtb")[0]
     projName = dtbFileName.replace(".dtb", "").split("/")[1]
 
-    if queue not in ("sge", "slurm", "slurm-srun"):
-        print("'sge', 'slurm' and 'slurm-srun' are the queuing system options")
+    # Adaptive repeats
+    adaptive = args.adaptive
+    cutoff = args.cutoff
+    window = args.window
+    gap = max(0, args.gap)
+
+    if queue not in ("sge", "slurm", "slurm-srun", "slurm-array",
+                     "slurm-pull", "slurm-node"):
+        print("'sge', 'slurm', 'slurm-srun', 'slurm-array', 'slurm-pull' and" +
+              " 'slurm-node' are the queuing system options")
+        sys.exit()
+
+    if adaptive and cutoff is None:
+        print("The hit --cutoff has to be given with -adaptive")
+        sys.exit()
+
+    # Multi-stage VS
+    stage2 = args.stage2
+    stage2Thor = args.stage2Thor
+    stage2Repeats = args.stage2Repeats
+    stage2Walltime = args.stage2Walltime
+    if stage2Repeats is None:
+        stage2Repeats = repeatNum
+    if stage2Walltime is None:
+        stage2Walltime = walltime
+
+    if stage2 is not None:
+        if not 0 < stage2 <= 100 or stage2Thor is None:
+            print("--stage2 takes a percentage (0-100] and requires" +
+                  " --stage2Thor")
+            sys.exit()
+        if adaptive:
+            print("-adaptive and --stage2 cannot be used together")
+            sys.exit()
+
+    # Balanced slices
+    balance = args.balance
+    ligandTime = args.ligandTime
+    if balance and not os.path.exists(balance):
+        print("The --balance .sdf file or VS directory does not exist: " +
+              balance)
+        sys.exit()
+
+    # Worker jobs, and slices docked at once by a node job (bounded by the
+    # memory of the node)
+    workers = max(1, args.workers)
+    cores = None
+    if queue == "slurm-node":
+        cores = max(1, args.cores)
+        if args.nodeMem is not None:
+            cores = max(1, min(cores, args.nodeMem // SLICE_MEM))
+
+    # Gap filling
+    fill = args.fill
+
+    # Linked setup files
+    link = args.link
+
+    # Node-local scratch
+    scratch = args.scratch
+    if scratch and queue in ("slurm-pull", "slurm-node"):
+        print("-scratch is not available with the slurm-pull and slurm-node" +
+              " queuing systems")
         sys.exit()
 
     return libStart, libEnd, sliceSize, repeatNum, thor, walltime, setupDir, \
-        projName, queue
+        projName, queue, adaptive, cutoff, window, gap, stage2, stage2Thor, \
+        stage2Repeats, stage2Walltime, balance, ligandTime, workers, cores, \
+        fill, link, scratch
 
 
 def getPath():
@@ -215,19 +449,25 @@ def printParams(setupDir, reportLines):
     return reportLines
 
 
-def createRepeats(repeatNum, setupDir, reportLines):
+def createRepeats(repeatNum, setupDir, reportLines, firstRepeat=1,
+                  lastRepeat=None, baseDir="", link=False):
     """
     Copy the content of the setup directory to however many
-    repeat directories wanted by the user
+    repeat directories wanted by the user (from firstRepeat to lastRepeat,
+    all repeats by default), created in baseDir. With link, the files ICM
+    only reads are linked rather than copied
     """
 
+    if lastRepeat is None:
+        lastRepeat = repeatNum
+
     # Get files in setupDir
     filePaths = glob.glob(setupDir + "/*")
 
     # Create each repeat dirs, and populate them with files
-    for repeatDir in range(1, repeatNum + 1):
+    for repeatDir in range(firstRepeat, lastRepeat + 1):
 
-        repeatDir = str(repeatDir)
+        repeatDir = baseDir + str(repeatDir)
         # Create the directory if it doesn't already exist
         if not os.path.exists(repeatDir):
             os.makedirs(repeatDir)
@@ -238,49 +478,762 @@ def createRepeats(repeatNum, setupDir, reportLines):
         # Copy each file into this new directory
         for filePath in filePaths:
             fileName = os.path.basename(filePath)
-            shutil.copy(filePath, repeatDir + "/" + fileName)
-            reportLines.append("\t COPYING:" + fileName)
+            destPath = repeatDir + "/" + fileName
+            if link and not fileName.endswith(".dtb"):
+                action = linkSetupFile(filePath, destPath)
+            else:
+                # A link left by a previous build would be written through
+                if os.path.lexists(destPath):
+                    os.remove(destPath)
+                shutil.copy(filePath, destPath)
+                action = "COPYING"
+            reportLines.append("\t " + action + ":" + fileName)
+
+    return reportLines
+
+
+def linkSetupFile(filePath, linkPath):
+    """
+    Hard link a setup file into a repeat directory, or symbolic link it when
+    hard links are not possible (other filesystem, or not supported). A file
+    already at linkPath is replaced. Returns the action, for the report
+    """
+
+    if os.path.lexists(linkPath):
+        os.remove(linkPath)
+
+    try:
+        os.link(filePath, linkPath)
+        return "LINKING"
+    except OSError:
+        os.symlink(os.path.abspath(filePath), linkPath)
+        return "SYMLINKING"
+
+
+def repeatHasResults(repeatDir):
+    """
+    Tell whether docking results were already written to this repeat
+    directory
+    """
+
+    return len(glob.glob(repeatDir + "/*.ou")) > 0
+
+
+def removeAdaptivePlan(workDir, reportLines):
+    """
+    Remove the plan of a previous adaptive VS from this directory, as the
+    repeats built now cover the whole library
+    """
+
+    planPath = workDir + "/adaptive.json"
+    if os.path.exists(planPath):
+        os.remove(planPath)
+        reportLines.append("\nREMOVED PREVIOUS ADAPTIVE PLAN: " + planPath)
 
     return reportLines
 
 
-def createSlices(libStart, libEnd, sliceSize, walltime, thor, projName,
-                 repeatNum, queue, reportLines, icmHome):
+def adaptiveRanges(workDir, libStart, libEnd, cutoff, window, gap, repeatNum,
+                   reportLines):
+    """
+    Parse the .ou files of repeat 1, and select the ligands whose score is
+    within the window of the cutoff, to be docked again in the later repeats.
+    The selected IDs are merged into ranges (bridging gaps of up to gap IDs),
+    which are written to the adaptive.json plan read by vs_results.py.
+    Returns the ranges
+    """
+
+    bestTable, unfinished = repeatBestScores([workDir + "/1"], libStart,
+                                             libEnd)
+
+    selected = bestTable["No"][np.abs(bestTable["Score"] - cutoff) <= window]
+    ranges = vs_results.idRanges(selected, gap)
+    dockedNum = int(np.sum(ranges[:, 1] - ranges[:, 0] + 1))
+
+    with open(workDir + "/adaptive.json", "w") as f:
+        json.dump({"cutoff": cutoff, "window": window, "gap": gap,
+                   "repeatNum": repeatNum, "libRange": [libStart, libEnd],
+                   "ligands": dockedNum, "ranges": ranges.tolist()},
+                  f, indent=1)
+
+    # Docking compute of the later repeats, compared to full repeats
+    libSize = libEnd - libStart + 1
+    reportLines.append("ADAPTIVE REPEATS:\n")
+    if unfinished > 0:
+        reportLines.append("\t WARNING: " + str(unfinished) + " .ou files" +
+                           " of repeat 1 are not FINISHED")
+    reportLines.append("\t ligands scored in repeat 1: " +
+                       str(len(bestTable)))
+    reportLines.append("\t ligands within " + str(window) + " of " +
+                       str(cutoff) + ": " + str(len(selected)))
+    reportLines.append("\t ligands docked in repeats 2-" + str(repeatNum) +
+                       ": " + str(dockedNum) + " in " + str(len(ranges)) +
+                       " ID ranges")
+    reportLines.append("\t later repeats docking cost: " +
+                       "{:.1f}".format(100. * dockedNum / libSize) +
+                       "% of a full repeat")
+    reportLines.append("\t plan written to: " + workDir + "/adaptive.json")
+
+    return ranges, reportLines
+
+
+def repeatBestScores(repeatDirs, libStart, libEnd):
+    """
+    Parse the .ou files of the repeat directories, and return the results
+    table of the best repeat of each ligand of the library, and the number of
+    .ou files that are not FINISHED (the selection made from an incomplete
+    repeat misses ligands). The parts of the resumed slices are not counted
+    """
+
+    unfinished = 0
+    fileTables = []
+    for repeatDir in repeatDirs:
+        for ouFilePath in glob.glob(repeatDir + "/*.ou"):
+            with ouscan.mapOuFile(ouFilePath) as data:
+                if ouscan.countLines(data, b"FINISHED") == 0 and \
+                        not ouFilePath.endswith(ouscan.PART_SUFFIX):
+                    unfinished += 1
+            fileTables.append(vs_results.parseOuFile(ouFilePath)[2])
+
+    bestTable = vs_results.sortRepeats(vs_results.concatTables(fileTables))
+    bestTable = bestTable[(bestTable["No"] >= libStart) &
+                          (bestTable["No"] <= libEnd)]
+
+    return bestTable, unfinished
+
+
+def buildStage2(libStart, libEnd, sliceSize, repeatNum, setupDir, projName,
+                queue, gap, stage2, stage2Thor, stage2Repeats, stage2Walltime,
+                workDir, icmHome, balance=None, ligandTime=30., workers=10,
+                cores=None, link=False, scratchFiles=None):
+    """
+    Build stage 2 of a multi-stage VS in the stage2/ directory: the top
+    stage2 percent ligands of stage 1 are docked again at the stage 2
+    thoroughness, in stage2Repeats repeats. stage2/ is a VS directory of its
+    own (submitted with vs_submit.py), and vs_results.py merges its results
+    with the stage 1 results
+    """
+
+    stageDir = workDir + "/stage2"
+    reportLines = []
+
+    # Clean files present in the stage 2 repeat directories, if any
+    for repeatDir in glob.glob(stageDir + "/[0-9]*"):
+        cleanRepeatDir(repeatDir)
+
+    reportLines.append("\nSTAGE 2 PARAMETERS:\n")
+    reportLines.append("\t libStart: " + str(libStart))
+    reportLines.append("\t libEnd: " + str(libEnd))
+    reportLines.append("\t sliceSize: " + str(sliceSize))
+    reportLines.append("\t top: " + str(stage2) + "%")
+    reportLines.append("\t repeatNum: " + str(stage2Repeats))
+    reportLines.append("\t walltime: " + stage2Walltime)
+    reportLines.append("\t thoroughness: " + stage2Thor)
+    reportLines.append("\t setupDir: " + setupDir)
+    reportLines.append("\t projName: " + projName)
+    reportLines.append("\n")
+
+    # Select the best ligands of stage 1, over all its repeats
+    bestTable, unfinished = repeatBestScores(
+        [workDir + "/" + str(r) for r in range(1, repeatNum + 1)],
+        libStart, libEnd)
+    topNum = int(math.ceil(len(bestTable) * stage2 / 100.))
+    selected = bestTable[np.argsort(bestTable["Score"],
+                                    kind="stable")[:topNum]]
+    ranges = vs_results.idRanges(np.sort(selected["No"]), gap)
+    dockedNum = int(np.sum(ranges[:, 1] - ranges[:, 0] + 1))
+
+    reportLines.append("STAGE 1 SELECTION:\n")
+    if unfinished > 0:
+        reportLines.append("\t WARNING: " + str(unfinished) + " .ou files" +
+                           " of stage 1 are not FINISHED")
+    reportLines.append("\t ligands scored in stage 1: " +
+                       str(len(bestTable)))
+    if len(selected) > 0:
+        reportLines.append("\t top " + str(stage2) + "%: " +
+                           str(len(selected)) + " ligands, scores up to " +
+                           str(selected["Score"][-1]))
+    reportLines.append("\t ligands docked in stage 2: " + str(dockedNum) +
+                       " in " + str(len(ranges)) + " ID ranges")
+
+    if not os.path.exists(stageDir):
+        os.makedirs(stageDir)
+    with open(stageDir + "/stage2.json", "w") as f:
+        json.dump({"top": stage2, "thoroughness": stage2Thor,
+                   "repeatNum": stage2Repeats, "libRange": [libStart, libEnd],
+                   "ligands": dockedNum, "ranges": ranges.tolist()},
+                  f, indent=1)
+    reportLines.append("\t selection written to: " + stageDir +
+                       "/stage2.json")
+
+    reportLines.append("\n***********************\n")
+
+    # grep the parameters to lookout for in the .dtb file, and print them out
+    reportLines = printParams(setupDir, reportLines)
+
+    reportLines.append("\n***********************\n")
+
+    # Creating the stage 2 repeats directories, copies of the setupDir
+    reportLines = createRepeats(stage2Repeats, setupDir, reportLines,
+                                baseDir="stage2/", link=link)
+
+    reportLines.append("\n***********************\n")
+
+    # Create the slices of the selected ligands
+    slices, sliceTimes, reportLines = makeSlices(ranges, sliceSize, libStart,
+                                                 libEnd, balance, ligandTime,
+                                                 stage2Walltime, reportLines)
+    repeatSlices = [(repeat, slices)
+                    for repeat in range(1, stage2Repeats + 1)]
+    reportLines = createSlices(repeatSlices, libStart, libEnd,
+                               stage2Walltime, stage2Thor, projName, queue,
+                               reportLines, icmHome, baseDir="stage2/",
+                               sliceTimes=sliceTimes, workers=workers,
+                               cores=cores, scratchFiles=scratchFiles)
+
+    reportLines.append("\nSTAGE 2: submit it with vs_submit.py " +
+                       os.path.relpath(stageDir) + " " +
+                       queue.replace("slurm-srun", "slurm"))
+    reportLines.append("\n")
+
+    # Print and write report
+    printWriteReport(reportLines, stageDir, projName)
+
+
+def buildFill(libStart, libEnd, sliceSize, repeatNum, thor, walltime,
+              setupDir, projName, queue, workDir, icmHome, balance=None,
+              ligandTime=30., workers=10, cores=None, link=False,
+              scratchFiles=None):
+    """
+    Build the slices filling the gaps of a VS that ran: in each repeat, the
+    ligands of the library (or of the adaptive plan, for the later repeats of
+    an adaptive VS) that are neither scored nor skipped in its .ou files are
+    coalesced into ID ranges, packed into slices. The results are kept in
+    place, and the previous job scripts are moved to a backup directory so
+    that vs_submit.py only submits the new slices. Nothing is moved or
+    renamed until every repeat was checked, so that a fill that cannot be
+    built leaves the VS as it was
+    """
+
+    reportLines = []
+
+    reportLines.append("\nFILL PARAMETERS:\n")
+    reportLines.append("\t libStart: " + str(libStart))
+    reportLines.append("\t libEnd: " + str(libEnd))
+    reportLines.append("\t sliceSize: " + str(sliceSize))
+    reportLines.append("\t repeatNum: " + str(repeatNum))
+    reportLines.append("\t walltime: " + walltime)
+    reportLines.append("\t thoroughness: " + thor)
+    reportLines.append("\t setupDir: " + setupDir)
+    reportLines.append("\t projName: " + projName)
+    reportLines.append("\n")
+
+    # grep the parameters to lookout for in the .dtb file, and print them out
+    reportLines = printParams(setupDir, reportLines)
+
+    reportLines.append("\n***********************\n")
+
+    planRanges = vs_results.loadAdaptivePlan(workDir)
+    backupName = "backup_" + datetime.datetime.fromtimestamp(
+        int(time.time())).strftime("%Y-%m-%d_%H:%M:%S")
+
+    repeatSlices = []
+    repeatRenames = []
+    for repeat in range(1, repeatNum + 1):
+        repeatDir = workDir + "/" + str(repeat)
+
+        # A repeat that was never built is docked over its whole range
+        if not os.path.exists(repeatDir):
+            reportLines = createRepeats(repeatNum, setupDir, reportLines,
+                                        repeat, repeat, link=link)
+
+        ligIDs, unfinished = repeatLigandIDs(repeatDir)
+        missing = vs_results.missingRanges(ligIDs, libStart, libEnd)
+        if planRanges is not None and repeat > 1:
+            missing = vs_results.intersectRanges(missing, planRanges)
+        missingNum = int(np.sum(missing[:, 1] - missing[:, 0] + 1))
+
+        reportLines.append("\nREPEAT:" + str(repeat) + "\n")
+        if unfinished > 0:
+            reportLines.append("\t WARNING: " + str(unfinished) + " .ou" +
+                               " files are not FINISHED, their slices may" +
+                               " still be running")
+        reportLines.append("\t ligands missing: " + str(missingNum) + " in " +
+                           str(len(missing)) + " ID ranges")
+        if missingNum == 0:
+            continue
+
+        slices, sliceTimes, reportLines = makeSlices(missing, sliceSize,
+                                                     libStart, libEnd,
+                                                     balance, ligandTime,
+                                                     walltime, reportLines)
+        repeatRenames.append((repeatDir, ouRenames(repeatDir, projName,
+                                                   slices)))
+        repeatSlices.append((repeat, slices))
+
+    # The fill can no longer abort: replace the scripts of the repeats filled
+    for repeatDir, renames in repeatRenames:
+        reportLines.append("\nFILLED REPEAT:" + os.path.basename(repeatDir) +
+                           "\n")
+        reportLines = backupScripts(repeatDir, backupName, reportLines)
+        reportLines = keepOuFiles(renames, reportLines)
+
+    reportLines.append("\n***********************\n")
+
+    reportLines = createSlices(repeatSlices, libStart, libEnd, walltime, thor,
+                               projName, queue, reportLines, icmHome,
+                               workers=workers, cores=cores,
+                               scratchFiles=scratchFiles)
+
+    if not repeatSlices:
+        reportLines.append("\nFILL: no ligand is missing, nothing to dock")
+    reportLines.append("\n")
+
+    # Print and write report
+    printWriteReport(reportLines, workDir, projName)
+
+
+def repeatLigandIDs(repeatDir):
+    """
+    Return the sorted unique IDs of the ligands scored or skipped in the .ou
+    files of a repeat directory, and the number of .ou files that are not
+    FINISHED (the parts of the resumed slices are not counted)
+    """
+
+    unfinished = 0
+    idArrays = [np.zeros(0, dtype="i8")]
+    for ouFilePath in glob.glob(repeatDir + "/*.ou"):
+        with ouscan.mapOuFile(ouFilePath) as data:
+            if ouscan.countLines(data, b"FINISHED") == 0 and \
+                    not ouFilePath.endswith(ouscan.PART_SUFFIX):
+                unfinished += 1
+            for marker in (b"SCORES>", b"Skipping"):
+                idArrays.append(np.fromiter(ouscan.ligandIDs(data, marker),
+                                            dtype="i8"))
+
+    return np.unique(np.concatenate(idArrays)), unfinished
+
+
+def backupScripts(repeatDir, backupName, reportLines):
+    """
+    Move the job scripts and slice tables of a repeat directory to its backup
+    directory, leaving its .ou files in place
+    """
+
+    scriptPaths = []
+    for pattern in ("*.slurm", "*.sge", "*.sh", "slices.tsv", "chunks.tsv",
+                    "queue.log"):
+        scriptPaths.extend(glob.glob(repeatDir + "/" + pattern))
+    if not scriptPaths:
+        return reportLines
+
+    backupDir = repeatDir + "/" + backupName
+    os.makedirs(backupDir)
+    for scriptPath in scriptPaths:
+        shutil.move(scriptPath, backupDir)
+    reportLines.append("\t previous job scripts moved to: " +
+                       os.path.relpath(backupDir))
+
+    return reportLines
+
+
+def ouRenames(repeatDir, projName, slices):
+    """
+    The .ou file of a new slice range is named after its upper limit. When a
+    .ou file of that name exists (the end of a slice is missing), it has to
+    be renamed after the last ligand it completed, so that it is not
+    overwritten. Returns the (path, new path) of these files, and exits
+    before anything is renamed when a new path is already taken
+    """
+
+    renames = []
+    for ranges in slices:
+        for lowerLimit, upperLimit in ranges:
+            ouPath = repeatDir + "/" + projName + "_" + str(upperLimit) + ".ou"
+            if not os.path.exists(ouPath):
+                continue
+
+            with ouscan.mapOuFile(ouPath) as data:
+                lastID = ouscan.lastLigandID(data)
+            # Nothing to keep when no ligand was completed
+            if lastID is None:
+                continue
+
+            keptPath = repeatDir + "/" + projName + "_" + str(lastID) + ".ou"
+            if os.path.exists(keptPath):
+                print("Cannot rename " + ouPath + ", " + keptPath +
+                      " already exists")
+                sys.exit()
+            renames.append((ouPath, keptPath))
+
+    return renames
+
+
+def keepOuFiles(renames, reportLines):
+    """
+    Rename the .ou files that new slice ranges would overwrite (see
+    ouRenames)
+    """
+
+    for ouPath, keptPath in renames:
+        os.rename(ouPath, keptPath)
+        reportLines.append("\t kept " + os.path.basename(ouPath) +
+                           " as " + os.path.basename(keptPath))
+
+    return reportLines
+
+
+def makeSlices(ranges, sliceSize, libStart, libEnd, balance, ligandTime,
+               walltime, reportLines):
+    """
+    Cut the ID ranges to dock into slices, each slice being a list of
+    (lowerLimit, upperLimit) ID ranges. Without balance, the slices hold
+    sliceSize ligands. With balance (a .sdf library or a previous VS
+    directory), the same number of slices is made, of equal predicted docking
+    time. Returns the slices and their predicted walltimes in seconds (None
+    when not balanced)
+    """
+
+    if not balance:
+        return packRanges(ranges, sliceSize), None, reportLines
+
+    costs, reportLines = ligandCosts(balance, libStart, libEnd, reportLines)
+    slices, sliceCosts = balancedSlices(ranges, sliceSize, costs, libStart)
+    sliceTimes = [sliceCost * ligandTime for sliceCost in sliceCosts]
+
+    # Compare the predicted walltimes to the walltime requested
+    if sliceTimes:
+        limit = walltimeSeconds(walltime)
+        reportLines.append("\nPREDICTED WALLTIMES:\n")
+        reportLines.append("\t shortest slice: " +
+                           formatWalltime(min(sliceTimes)))
+        reportLines.append("\t longest slice: " +
+                           formatWalltime(max(sliceTimes)))
+        reportLines.append("\t slices over the walltime of " + walltime +
+                           ": " + str(sum(1 for sliceTime in sliceTimes
+                                          if sliceTime > limit)))
+        reportLines.append("\n***********************\n")
+
+    return slices, sliceTimes, reportLines
+
+
+def ligandCosts(balance, libStart, libEnd, reportLines):
+    """
+    Return the relative docking cost of each ligand from libStart to libEnd
+    (normalised to a mean of 1), read from a .sdf library or from the .ou
+    files of a previous VS directory. Ligands without a known cost get the
+    mean cost
+    """
+
+    if os.path.isdir(balance):
+        bestTable, unfinished = repeatBestScores(
+            glob.glob(balance + "/[0-9]*"), libStart, libEnd)
+        costs = np.full(libEnd - libStart + 1, np.nan)
+        costs[bestTable["No"] - libStart] = ligandCost(bestTable["Nat"],
+                                                       bestTable["Nva"])
+    else:
+        costs = sdfCosts(balance, libStart, libEnd)
+
+    known = np.count_nonzero(~np.isnan(costs))
+    reportLines.append("\nLIGAND COSTS:\n")
+    reportLines.append("\t read from: " + balance)
+    reportLines.append("\t ligands with a known cost: " + str(known) +
+                       " of " + str(len(costs)))
+
+    if known == 0:
+        return np.ones(len(costs)), reportLines
+    costs /= np.nanmean(costs)
+    costs[np.isnan(costs)] = 1.
+
+    return costs, reportLines
+
+
+def ligandCost(atomNum, torsionNum):
+    """
+    Relative docking cost of ligands: the cost of scoring a pose grows with
+    the number of atoms, and the number of poses sampled with the number of
+    torsions
+    """
+
+    return atomNum * (1. + 0.25 * np.asarray(torsionNum))
+
+
+def sdfCosts(sdfPath, libStart, libEnd):
+    """
+    Read the number of heavy atoms and rotatable bonds of the ligands libStart
+    to libEnd (their position in the .sdf library, starting at 1) and return
+    their docking costs (nan for the molecules that could not be read)
+    """
+
+    costs = np.full(libEnd - libStart + 1, np.nan)
+
+    ligID = 1
+    molLines = []
+    with open(sdfPath, errors="replace") as sdfFile:
+        for line in sdfFile:
+            if not line.startswith("$$$$"):
+                # Only keep the lines of the molecules in the library range
+                if ligID >= libStart:
+                    molLines.append(line)
+                continue
+
+            if ligID >= libStart:
+                counts = molCounts(molLines)
+                if counts is not None:
+                    costs[ligID - libStart] = ligandCost(*counts)
+            molLines = []
+            ligID += 1
+            if ligID > libEnd:
+                break
+
+    return costs
+
+
+def molCounts(molLines):
+    """
+    Count the heavy atoms and rotatable bonds of a V2000 molfile. Rotatable
+    bonds are single bonds between two non-terminal heavy atoms that are not
+    in a ring, ring bonds being the bonds that are not bridges of the
+    molecular graph. Returns None if the molecule cannot be read
+    """
+
+    try:
+        countsLine = molLines[3]
+        if "V3000" in countsLine:
+            return None
+        atomNum = int(countsLine[0:3])
+        bondNum = int(countsLine[3:6])
+        heavy = [line[31:34].strip() not in ("H", "D")
+                 for line in molLines[4:4 + atomNum]]
+        bonds = []
+        for line in molLines[4 + atomNum:4 + atomNum + bondNum]:
+            atom1 = int(line[0:3]) - 1
+            atom2 = int(line[3:6]) - 1
+            if heavy[atom1] and heavy[atom2]:
+                bonds.append((atom1, atom2, int(line[6:9])))
+    except (IndexError, ValueError):
+        return None
+
+    degrees = [0] * atomNum
+    for atom1, atom2, bondType in bonds:
+        degrees[atom1] += 1
+        degrees[atom2] += 1
+
+    isBridge = bridges(atomNum, [(atom1, atom2) for atom1, atom2, bondType
+                                 in bonds])
+    rotatable = 0
+    for (atom1, atom2, bondType), bridge in zip(bonds, isBridge):
+        if bondType == 1 and bridge and degrees[atom1] > 1 and \
+                degrees[atom2] > 1:
+            rotatable += 1
+
+    return sum(heavy), rotatable
+
+
+def bridges(atomNum, bonds):
+    """
+    Find the bridges of a graph (the bonds whose removal disconnects it, which
+    are the bonds not in a ring) with an iterative depth first search. Returns
+    a list of booleans aligned with the bonds
+    """
+
+    neighbours = [[] for i in range(atomNum)]
+    for bondIndex, (atom1, atom2) in enumerate(bonds):
+        neighbours[atom1].append((atom2, bondIndex))
+        neighbours[atom2].append((atom1, bondIndex))
+
+    # Order in which the atoms are visited, and lowest order reachable from
+    # each atom without going back through the bond it was reached from
+    order = [-1] * atomNum
+    low = [0] * atomNum
+    isBridge = [False] * len(bonds)
+    visited = 0
+
+    for root in range(atomNum):
+        if order[root] != -1:
+            continue
+        order[root] = low[root] = visited
+        visited += 1
+        stack = [(root, -1, iter(neighbours[root]))]
+
+        while stack:
+            atom, parentBond, atomNeighbours = stack[-1]
+            descended = False
+            for neighbour, bondIndex in atomNeighbours:
+                if bondIndex == parentBond:
+                    continue
+                if order[neighbour] == -1:
+                    order[neighbour] = low[neighbour] = visited
+                    visited += 1
+                    stack.append((neighbour, bondIndex,
+                                  iter(neighbours[neighbour])))
+                    descended = True
+                    break
+                low[atom] = min(low[atom], order[neighbour])
+
+            if not descended:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[atom])
+                    if low[atom] > order[parent]:
+                        isBridge[parentBond] = True
+
+    return isBridge
+
+
+def balancedSlices(ranges, sliceSize, costs, libStart):
+    """
+    Cut the ID ranges into as many slices as slices of sliceSize ligands
+    would make, each of about the same total cost. Returns the slices (lists
+    of (lowerLimit, upperLimit) ID ranges) and their costs
+    """
+
+    ligIDs = np.concatenate([np.arange(lowerLimit, upperLimit + 1)
+                             for lowerLimit, upperLimit in ranges] +
+                            [np.zeros(0, dtype=int)])
+    if len(ligIDs) == 0:
+        return [], []
+
+    cumCosts = np.cumsum(costs[ligIDs - libStart])
+    sliceNum = int(math.ceil(len(ligIDs) / float(sliceSize)))
+
+    # Cut before or after the ligand where the cumulative cost reaches each
+    # multiple of the cost of a slice, whichever is closer
+    targets = cumCosts[-1] * np.arange(1, sliceNum) / sliceNum
+    reached = np.searchsorted(cumCosts, targets)
+    before = np.where(reached > 0, cumCosts[np.maximum(reached - 1, 0)], 0.)
+    cuts = np.where(targets - before < cumCosts[reached] - targets,
+                    reached, reached + 1)
+    bounds = np.unique(np.concatenate([[0], cuts, [len(ligIDs)]]))
+
+    slices = []
+    sliceCosts = []
+    for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        slices.append([tuple(idRange) for idRange in
+                       vs_results.idRanges(ligIDs[start:end]).tolist()])
+        startCost = cumCosts[start - 1] if start > 0 else 0.
+        sliceCosts.append(float(cumCosts[end - 1] - startCost))
+
+    return slices, sliceCosts
+
+
+def walltimeSeconds(walltime):
+    """
+    Convert a walltime (D-HH:MM:SS, HH:MM:SS or MM:SS) into seconds
+    """
+
+    days = 0
+    if "-" in walltime:
+        days, walltime = walltime.split("-")
+    seconds = 0
+    for field in walltime.split(":"):
+        seconds = seconds * 60 + int(field)
+
+    return int(days) * 86400 + seconds
+
+
+def formatWalltime(seconds):
+    """
+    Format a number of seconds as a walltime (D-HH:MM:SS)
+    """
+
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+
+    return "{}-{:02d}:{:02d}:{:02d}".format(days, seconds // 3600,
+                                            seconds // 60 % 60, seconds % 60)
+
+
+def packRanges(ranges, sliceSize):
+    """
+    Pack ID ranges into slices of at most sliceSize ligands, splitting the
+    ranges that do not fit in the room left in a slice. Each slice is a list
+    of (lowerLimit, upperLimit) ID ranges
+    """
+
+    slices = []
+    currentSlice = []
+    room = sliceSize
+
+    for lowerLimit, upperLimit in np.asarray(ranges).tolist():
+        while lowerLimit <= upperLimit:
+            end = min(upperLimit, lowerLimit + room - 1)
+            currentSlice.append((lowerLimit, end))
+            room -= end - lowerLimit + 1
+            lowerLimit = end + 1
+            if room == 0:
+                slices.append(currentSlice)
+                currentSlice = []
+                room = sliceSize
+
+    if currentSlice:
+        slices.append(currentSlice)
+
+    return slices
+
+
+def createSlices(repeatSlices, libStart, libEnd, walltime, thor, projName,
+                 queue, reportLines, icmHome, baseDir="", sliceTimes=None,
+                 workers=10, cores=None, scratchFiles=None):
     """
     Create the .slurm slices to split the VS job into portions for submission
-    to the cluster
+    to the cluster. repeatSlices holds (repeat, slices) pairs, each slice
+    being a list of (lowerLimit, upperLimit) ID ranges. The repeat directories
+    are in baseDir. sliceTimes optionally gives the predicted walltime of
+    each slice (the same slices in every repeat), added to the report.
+    workers is the number of worker jobs per repeat of the slurm-pull queue
+    (of node jobs of the slurm-node queue, each docking cores slices at once).
+    With scratchFiles (the names of the setup files), the jobs stage these
+    files to the node-local scratch and run ICM there. The slices of the
+    repeats replace theirs in the manifest of the VS directory
     """
 
-    repeat = 1
+    cwd = os.getcwd()
+    repeatDirs = [cwd + "/" + baseDir + str(repeat) + "/"
+                  for repeat, slices in repeatSlices]
+    manifestRows = []
 
     # Loop over repeat directories
-    while repeat <= repeatNum:
+    for repeat, slices in repeatSlices:
 
         # Initialize variables for this repeat
-        cwd = os.getcwd()
-        repeatDir = cwd + "/" + str(repeat) + "/"
+        repeatDir = cwd + "/" + baseDir + str(repeat) + "/"
+        for sliceCount, ranges in enumerate(slices, 1):
+            scriptName = sliceScriptName(queue, projName, repeat, ranges,
+                                         libStart, libEnd)
+            manifestRows.append(manifest.sliceRow(repeat, sliceCount, ranges,
+                                                  str(repeat) + "/" +
+                                                  scriptName, queue))
         # Update the report
         reportLines.append("\n")
         reportLines.append("REPEAT:" + repeatDir + "\n")
 
-        # Initialize variables for the first slice
-        lowerLimit = libStart
-        upperLimit = libStart + sliceSize - 1
-        sliceCount = 1
-        keepLooping = True
+        # A single job array runs all the slices of this repeat
+        if queue == "slurm-array":
+            reportLines = slurmArray(walltime, projName, thor, slices,
+                                     repeatDir, repeat, reportLines, icmHome,
+                                     scratchFiles)
+            continue
+
+        # Worker jobs claim the slices of this repeat from its queue, then
+        # help with the queues of the other repeats
+        if queue in ("slurm-pull", "slurm-node"):
+            otherDirs = [otherDir for otherDir in repeatDirs
+                         if otherDir != repeatDir]
+            chunkTime = 0
+            if sliceTimes:
+                chunkTime = int(max(sliceTimes))
+            reportLines = slurmPull(walltime, projName, thor, slices,
+                                    repeatDir, otherDirs, repeat, workers,
+                                    chunkTime, reportLines, icmHome, cores)
+            continue
 
         # Loop over the slices
-        while keepLooping:
-
-            # Exit statement of the loop, when upperLimit has reached the
-            # size of the ligand library
-            if upperLimit >= libEnd:
-                upperLimit = libEnd
-                # Once the end of the libSize has been reached, stop the next
-                # loop
-                keepLooping = False
+        for sliceCount, ranges in enumerate(slices, 1):
 
             # Create sliceName for job name and slurm file name
+            upperLimit = ranges[-1][1]
             sliceName = projName + "_rep" + str(repeat) + \
                 "_sl" + str(upperLimit)
 
@@ -288,35 +1241,192 @@ def createSlices(libStart, libEnd, sliceSize, walltime, thor, projName,
             # command
             if queue == "slurm-srun":
                 reportLines = slurmSrunSlice(sliceCount, projName, thor,
-                                             lowerLimit, upperLimit,
-                                             libStart, libEnd,
-                                             repeatDir, reportLines, icmHome)
+                                             ranges, libStart, libEnd,
+                                             repeatDir, reportLines, icmHome,
+                                             scratchFiles)
             elif queue == "sge":
                 reportLines = sgeSlice(walltime, sliceName, projName, thor,
-                                       lowerLimit, upperLimit, repeatDir,
-                                       reportLines, icmHome)
+                                       ranges, repeatDir, reportLines,
+                                       icmHome, scratchFiles)
             elif queue == "slurm":
                 reportLines = slurmSlice(walltime, sliceName, projName, thor,
-                                         lowerLimit, upperLimit, repeatDir,
-                                         reportLines, icmHome)
+                                         ranges, repeatDir, reportLines,
+                                         icmHome, scratchFiles)
 
-            # Update upperLimit and sliceCount
-            lowerLimit += sliceSize
-            upperLimit += sliceSize
-            sliceCount += 1
-
-        # Update the repeat number
-        repeat += 1
+            if sliceTimes is not None:
+                reportLines[-1] += ", predicted walltime: " + \
+                    formatWalltime(sliceTimes[sliceCount - 1])
 
         # Combine these slices in a call srun
         if queue == "slurm-srun":
             slurmSrun(projName, libStart, libEnd, walltime,
-                      repeatDir, repeat, sliceCount - 1)
+                      repeatDir, repeat, len(slices), scratchFiles)
+
+    connection = manifest.openManifest(cwd + "/" + baseDir, create=True)
+    manifest.replaceSlices(connection, [repeat for repeat, slices
+                                        in repeatSlices], manifestRows)
+    connection.close()
 
     return reportLines
 
 
-def slurmSrun(projName, libStart, libEnd,  walltime, repeatDir, repeat, sliceCount):
+def sliceScriptName(queue, projName, repeat, ranges, libStart, libEnd):
+    """
+    Name of the script submitted to run a slice: its own script, or the
+    array, srun or worker script of its repeat
+    """
+
+    if queue == "slurm-array":
+        return "array_" + projName + "_rep" + str(repeat) + ".slurm"
+    if queue == "slurm-srun":
+        return "srun_" + str(libStart) + "-" + str(libEnd) + ".slurm"
+    if queue == "slurm-pull":
+        return projName + "_rep" + str(repeat) + "_workers.slurm"
+    if queue == "slurm-node":
+        return projName + "_rep" + str(repeat) + "_nodes.slurm"
+
+    return projName + "_rep" + str(repeat) + "_sl" + str(ranges[-1][1]) + \
+        "." + queue
+
+
+def icmCommands(projName, thor, ranges):
+    """
+    Lines of a slice script running the ICM docking of each ID range of the
+    slice, each into its own .ou file
+    """
+
+    return [icmCommand(projName, thor, lowerLimit, upperLimit)
+            for lowerLimit, upperLimit in ranges]
+
+
+def icmCommand(projName, thor, lowerLimit, upperLimit):
+    """
+    ICM docking command of the ligands lowerLimit to upperLimit (numbers, or
+    shell variables), writing to the .ou file named after upperLimit
+    """
+
+    return "$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + projName + \
+        " thorough=" + thor + \
+        " from=" + str(lowerLimit) + \
+        " to=" + str(upperLimit) + \
+        " >& " + projName + "_" + str(upperLimit) + ".ou"
+
+
+def jobCommands(projName, thor, ranges, repeatDir, scratchFiles=None):
+    """
+    Lines of a slice script running the ICM docking of the ID ranges of the
+    slice, in the repeat directory, or in the node-local scratch when the
+    names of the setup files to stage there are given
+    """
+
+    if scratchFiles is None:
+        return icmCommands(projName, thor, ranges)
+
+    lines = scratchLines(repeatDir, scratchFiles)
+    for command in icmCommands(projName, thor, ranges):
+        lines.extend(stagedCommand(command))
+
+    return lines
+
+
+def scratchLines(repeatDir, scratchFiles):
+    """
+    Lines of a job script staging the setup files of the repeat directory to a
+    node-local scratch directory (in $TMPDIR), and moving there. On exit,
+    including when the job is signalled at the end of its walltime, the files
+    written by ICM are copied back to the repeat directory, each to a hidden
+    temporary file renamed in place, so that no half copied .ou file is seen
+    """
+
+    lines = []
+    lines.append("REPEATDIR=" + repeatDir)
+    lines.append("SETUPFILES=\"" + " ".join(scratchFiles) + "\"")
+    lines.append("SCRATCH=$(mktemp -d ${TMPDIR:-/tmp}/vs_XXXXXX) || exit 1")
+    lines.append("stageBack() {")
+    lines.append("\tcd $SCRATCH || return")
+    lines.append("\tfor f in *; do")
+    lines.append("\t\tcase \" $SETUPFILES \" in *\" $f \"*) continue ;; esac")
+    lines.append("\t\t[ -f \"$f\" ] || continue")
+    lines.append("\t\tcp -p \"$f\" \"$REPEATDIR.$f.tmp\" &&" +
+                 " mv -f \"$REPEATDIR.$f.tmp\" \"$REPEATDIR$f\"")
+    lines.append("\tdone")
+    lines.append("\tcd $REPEATDIR")
+    lines.append("\trm -rf $SCRATCH")
+    lines.append("}")
+    lines.append("trap stageBack EXIT")
+    lines.append("trap 'kill $ICMPID 2>/dev/null; exit 1' USR1 USR2 TERM INT")
+    lines.append("cd $REPEATDIR && cp -L $SETUPFILES $SCRATCH/ &&" +
+                 " cd $SCRATCH || exit 1")
+
+    return lines
+
+
+def stagedCommand(command):
+    """
+    Run a command in the background and wait for it, so that the signal traps
+    of the script run as soon as a signal is received
+    """
+
+    return [command + " &", "ICMPID=$!", "wait $ICMPID"]
+
+
+def slurmArray(walltime, projName, thor, slices, repeatDir, repeat,
+               reportLines, icmHome, scratchFiles=None):
+    """
+    Create the SLURM job array of a repeat: the slice table (one line per ID
+    range: slice index, from, to) and a single array script, whose task i
+    docks the ID ranges of slice i. Task IDs are offset by SLICE_OFFSET when
+    set, so that vs_submit.py can submit the array in chunks that fit the
+    maximum array size of the cluster
+    """
+
+    arrayName = projName + "_rep" + str(repeat)
+
+    # WRITE THE SLICE TABLE
+    writeSliceTable(repeatDir + "slices.tsv", slices)
+
+    lines = []
+    lines.append("#!/bin/bash")
+    lines.append("#SBATCH --mem=1024")
+    lines.append("#SBATCH --time=" + walltime)
+    lines.append("#SBATCH --job-name=" + arrayName)
+    lines.append("#SBATCH --account=monash063")
+    lines.append("#SBATCH --ntasks=1")
+    lines.append("#SBATCH --cpus-per-task=1")
+    lines.append("#SBATCH --array=1-" + str(len(slices)))
+    if scratchFiles is not None:
+        lines.append("#SBATCH --signal=B:USR1@" + str(SCRATCH_SIGNAL_TIME))
+    lines.append("")
+    lines.append("ICMHOME=" + icmHome)
+    lines.append("SLICE=$((SLURM_ARRAY_TASK_ID + ${SLICE_OFFSET:-0}))")
+    commands = [icmCommand(projName, thor, "$from", "$to")]
+    # The slice table is staged with the setup files
+    if scratchFiles is not None:
+        lines.extend(scratchLines(repeatDir, scratchFiles + ["slices.tsv"]))
+        commands = stagedCommand(commands[0])
+    lines.append("for range in $(awk -v slice=$SLICE " +
+                 "'$1 == slice {print $2 \":\" $3}' slices.tsv)")
+    lines.append("do")
+    lines.append("\tfrom=${range%:*}")
+    lines.append("\tto=${range#*:}")
+    lines.extend("\t" + command for command in commands)
+    lines.append("done")
+
+    # WRITE SLURM LINES TO FILE
+    with open(repeatDir + "array_" + arrayName + ".slurm", "w") as f:
+        f.write("\n".join(lines))
+
+    # Update report
+    reportLines.append("\tproject: " + projName +
+                       ", repeat:" + os.path.relpath(repeatDir) +
+                       ", array:" + arrayName + ", slices:" +
+                       str(len(slices)))
+
+    return reportLines
+
+
+def slurmSrun(projName, libStart, libEnd,  walltime, repeatDir, repeat, sliceCount,
+              scratchFiles=None):
     """
     Create the srun SLURM script which will group all SLURM submissions together
     """
@@ -333,6 +1443,9 @@ def slurmSrun(projName, libStart, libEnd,  walltime, repeatDir, repeat, sliceCou
     lines.append("#SBATCH --time=" + walltime)
     lines.append("#SBATCH --job-name=" + slurmName)
     lines.append("#SBATCH --account=monash063")
+    # The tasks copy their results back when signalled
+    if scratchFiles is not None:
+        lines.append("#SBATCH --signal=USR1@" + str(SCRATCH_SIGNAL_TIME))
     lines.append("")
     lines.append("for i in `seq 1 $SLURM_NTASKS`")
     lines.append("do")
@@ -345,8 +1458,8 @@ def slurmSrun(projName, libStart, libEnd,  walltime, repeatDir, repeat, sliceCou
         f.write("\n".join(lines))
 
 
-def slurmSrunSlice(sliceCount, projName, thor, lowerLimit, upperLimit,
-                   libStart, libEnd, repeatDir, reportLines, icmHome):
+def slurmSrunSlice(sliceCount, projName, thor, ranges, libStart, libEnd,
+                   repeatDir, reportLines, icmHome, scratchFiles=None):
     """
     Create a slurm slice that will be used as part of a bundled SRUN command
     and write to a file with the info provided
@@ -356,11 +1469,7 @@ def slurmSrunSlice(sliceCount, projName, thor, lowerLimit, upperLimit,
     lines.append("#!/bin/bash")
     lines.append("")
     lines.append("ICMHOME=" + icmHome)
-    lines.append("$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + projName +
-                 " thorough=" + thor +
-                 " from=" + str(lowerLimit) +
-                 " to=" + str(upperLimit) +
-                 " >& " + projName + "_" + str(upperLimit) + ".ou")
+    lines.extend(jobCommands(projName, thor, ranges, repeatDir, scratchFiles))
 
     # WRITE SLURM LINES TO FILE
     sliceName = str(libStart) + "-" + str(libEnd) + "_" + str(sliceCount)
@@ -375,8 +1484,8 @@ def slurmSrunSlice(sliceCount, projName, thor, lowerLimit, upperLimit,
     return reportLines
 
 
-def slurmSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
-               repeatDir, reportLines, icmHome):
+def slurmSlice(walltime, sliceName, projName, thor, ranges, repeatDir,
+               reportLines, icmHome, scratchFiles=None):
     """
     Create a slurm slice and write to a file with the info provided
     """
@@ -389,13 +1498,11 @@ def slurmSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
     lines.append("#SBATCH --account=monash063")
     lines.append("#SBATCH --ntasks=1")
     lines.append("#SBATCH --cpus-per-task=1")
+    if scratchFiles is not None:
+        lines.append("#SBATCH --signal=B:USR1@" + str(SCRATCH_SIGNAL_TIME))
     lines.append("")
     lines.append("ICMHOME=" + icmHome)
-    lines.append("$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + projName +
-                 " thorough=" + thor +
-                 " from=" + str(lowerLimit) +
-                 " to=" + str(upperLimit) +
-                 " >& " + projName + "_" + str(upperLimit) + ".ou")
+    lines.extend(jobCommands(projName, thor, ranges, repeatDir, scratchFiles))
 
     # WRITE SLURM LINES TO FILE
     with open(repeatDir + sliceName + ".slurm", "w") as f:
@@ -409,8 +1516,8 @@ def slurmSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
     return reportLines
 
 
-def sgeSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
-             repeatDir, reportLines, icmHome):
+def sgeSlice(walltime, sliceName, projName, thor, ranges, repeatDir,
+             reportLines, icmHome, scratchFiles=None):
     """
     Create a SGE slice given the info provided
     """
@@ -418,18 +1525,22 @@ def sgeSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
     lines.append("#!/bin/sh")
     lines.append("#$ -S /bin/sh")
     lines.append("#$ -l h_rt=" + walltime)
+    # SGE kills the job without warning at h_rt, but sends SIGUSR1 at the
+    # soft limit s_rt, so that the results are copied back from the scratch
+    if scratchFiles is not None:
+        lines.append("#$ -l s_rt=" + str(max(1, walltimeSeconds(walltime) -
+                                              SCRATCH_SIGNAL_TIME)))
     lines.append("#$ -l h_vmem=1G")
     lines.append("#$ -q hqu9")
     lines.append("#$ -l dpod=1")
     lines.append("#$ -cwd")
     lines.append("#$ -N " + str(sliceName))
+    # Warn the job with a signal before it is killed by qdel
+    if scratchFiles is not None:
+        lines.append("#$ -notify")
     lines.append("")
     lines.append("ICMHOME=" + icmHome)
-    lines.append("$ICMHOME/icm64 -vlscluster $ICMHOME/_dockScan " + projName +
-                 " thorough=" + thor +
-                 " from=" + str(lowerLimit) +
-                 " to=" + str(upperLimit) +
-                 " >& " + projName + "_" + str(upperLimit) + ".ou")
+    lines.extend(jobCommands(projName, thor, ranges, repeatDir, scratchFiles))
 
     # WRITE SLURM LINES TO FILE
     with open(repeatDir + sliceName + ".sge", "w") as f:
@@ -441,6 +1552,100 @@ def sgeSlice(walltime, sliceName, projName, thor, lowerLimit, upperLimit,
     return reportLines
 
 
+def slurmPull(walltime, projName, thor, slices, repeatDir, otherDirs, repeat,
+              workers, chunkTime, reportLines, icmHome, cores=None):
+    """
+    Create the pull queue of a repeat: the chunk table (one line per ID range:
+    chunk index, from, to), an empty queue log, and the job array of the
+    worker jobs. Each worker runs vs_worker.py, which claims chunks from the
+    queue log of this repeat, then of the other repeats, until they are empty
+    or its walltime is nearly used up. With cores, each job of the array takes
+    a whole node with at least that many cores, and runs one worker per core
+    of its allocation (as long as SLICE_MEM MB fit for each), so that a core
+    is given the next chunk as soon as it is done with one. The number of
+    node jobs is planned for nodes of cores cores
+    """
+
+    workersName = projName + "_rep" + str(repeat) + "_workers"
+    jobNum = min(workers, len(slices))
+    if cores is not None:
+        workersName = projName + "_rep" + str(repeat) + "_nodes"
+        jobNum = min(workers, int(math.ceil(len(slices) / float(cores))))
+
+    # WRITE THE CHUNK TABLE, AND START A NEW QUEUE
+    writeSliceTable(repeatDir + "chunks.tsv", slices)
+    open(repeatDir + "queue.log", "w").close()
+
+    workerPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "vs_worker.py")
+
+    workerCommand = sys.executable + " " + workerPath + " " + \
+        " ".join([repeatDir] + otherDirs) + \
+        " --projName " + projName + " --thor " + thor + \
+        " --walltime " + walltime + " --chunkTime " + str(chunkTime)
+
+    lines = []
+    lines.append("#!/bin/bash")
+    if cores is None:
+        lines.append("#SBATCH --mem=" + str(SLICE_MEM))
+    else:
+        # The whole node and its memory, so that no other job shares it
+        lines.append("#SBATCH --nodes=1")
+        lines.append("#SBATCH --exclusive")
+        lines.append("#SBATCH --mem=0")
+    lines.append("#SBATCH --time=" + walltime)
+    lines.append("#SBATCH --job-name=" + workersName)
+    lines.append("#SBATCH --account=monash063")
+    lines.append("#SBATCH --ntasks=1")
+    lines.append("#SBATCH --cpus-per-task=" + str(cores or 1))
+    lines.append("#SBATCH --array=1-" + str(jobNum))
+    lines.append("")
+    lines.append("export ICMHOME=" + icmHome)
+    if cores is None:
+        lines.append(workerCommand)
+    else:
+        # One worker per core allocated, within the memory allocated
+        lines.append("WORKERS=${SLURM_CPUS_ON_NODE:-" + str(cores) + "}")
+        lines.append("MEMWORKERS=$((${SLURM_MEM_PER_NODE:-0} / " +
+                     str(SLICE_MEM) + "))")
+        lines.append("if [ $MEMWORKERS -ge 1 ] && [ $MEMWORKERS -lt $WORKERS ]")
+        lines.append("then")
+        lines.append("	WORKERS=$MEMWORKERS")
+        lines.append("fi")
+        lines.append("for slot in $(seq 1 $WORKERS)")
+        lines.append("do")
+        lines.append("\t" + workerCommand + " --slot $slot &")
+        lines.append("done")
+        lines.append("wait")
+
+    # WRITE SLURM LINES TO FILE
+    with open(repeatDir + workersName + ".slurm", "w") as f:
+        f.write("\n".join(lines))
+
+    # Update report
+    reportLines.append("\tproject: " + projName +
+                       ", repeat:" + os.path.relpath(repeatDir) +
+                       ", jobs:" + str(jobNum) +
+                       ", workers per job:" + (str(cores) + " or more"
+                                               if cores else "1") +
+                       ", chunks:" + str(len(slices)))
+
+    return reportLines
+
+
+def writeSliceTable(tablePath, slices):
+    """
+    Write a slice table: one line per ID range of each slice, holding the
+    slice index (from 1), and the from and to IDs of the range
+    """
+
+    with open(tablePath, "w") as f:
+        for sliceCount, ranges in enumerate(slices, 1):
+            for lowerLimit, upperLimit in ranges:
+                f.write(str(sliceCount) + "\t" + str(lowerLimit) + "\t" +
+                        str(upperLimit) + "\n")
+
+
 def printWriteReport(reportLines, workDir, projName):
     """
     Go through the report lines and print them to standard output and
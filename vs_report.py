@@ -2,7 +2,9 @@
 
 # Run in a VS repeat directory, checks all .ou files and
 # compiles the number of occurence of the 'SCORE' word in
-# order to inform about the status of that repeat
+# order to inform about the status of that repeat.
+# The state of the jobs of the slices is read from
+# the manifest of the VS, when it has one
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
@@ -11,6 +13,9 @@ import glob
 import os
 import argparse
 
+import manifest
+import ouscan
+
 def main():
     """
     Run script
@@ -21,6 +26,9 @@ def main():
 
     print("\n************************\n")
 
+    # Print the state of the slices recorded in the manifest
+    printManifest(workDir)
+
     specs, skipCount = loopOverRepeats(workDir)
 
     # Print the skipped ligands data
@@ -32,6 +40,33 @@ def main():
     printSlurmOuts(workDir)
 
 
+def printManifest(workDir):
+    """
+    Print the number of slices (and ligands) of each repeat in each state,
+    and the slices whose job failed, from the manifest of the VS (updated
+    with vs_submit.py -refresh)
+    """
+
+    connection = manifest.openManifest(workDir)
+    if connection is None:
+        return
+
+    print("SLICE STATES (manifest):")
+    for repeat, state, sliceNum, ligandNum in manifest.stateCounts(connection):
+        print("\tREPEAT:{:<6} {:<14} slices:{:>8} \t ligands:{:>10}".format(
+            repeat, state, sliceNum, ligandNum))
+
+    failed = manifest.failedSlices(connection)
+    if failed:
+        print("\nFAILED SLICES:")
+    for repeat, ranges, script, jobID, state, exitCode in failed:
+        print("\t" + script + "\tranges:" + ranges + "\tjob:" +
+              str(jobID) + "\t" + state + "\texit code:" + str(exitCode))
+    print("\n************************\n")
+
+    connection.close()
+
+
 def loopOverRepeats(workDir):
     """
     Loop over the repeats in this VS directory, gathering
@@ -55,20 +90,15 @@ def loopOverRepeats(workDir):
             # Looping over .ou files in the current dir
             for file in ouFiles:
 
-                # Read all lines of that .ou file
-                f = open(file, "r")
-                lines = f.readlines()
-                f.close()
-
-                # Loop through the lines in that file,
-                # and collect both the SCORE count and
-                # the Skipped information
-                for line in lines:
+                # Map that .ou file, and only decode the lines of interest:
+                # the SCORE lines are counted, and the Skipped lines are
+                # collected
+                with ouscan.mapOuFile(file) as data:
                     # Update "SCORE" count
-                    if "SCORE" in line:
-                        scoreCount +=1
+                    scoreCount += ouscan.countLines(data, b"SCORE")
                     # Update "Skipping" count
-                    specs, skipCount = countSkipped(line, specs, skipCount)
+                    for line in ouscan.markerLines(data, b"Skipping"):
+                        specs, skipCount = countSkipped(line, specs, skipCount)
 
             printCompleted(subDir, scoreCount)
 
@@ -12,6 +12,25 @@ import glob
 import os
 import argparse
 import sys
+import multiprocessing
+import pickle
+import json
+import time
+import contextlib
+import numpy as np
+
+import ouscan
+
+
+# Columns of the results table (and of the results .csv files), with the type
+# each of them is stored as. The width of the "Name" strings is set per table
+TABLE_COLUMNS = [("No", "i8"), ("Nat", "i4"), ("Nva", "i4"), ("dEhb", "f8"),
+                 ("dEgrid", "f8"), ("dEin", "f8"), ("dEsurf", "f8"),
+                 ("dEel", "f8"), ("dEhp", "f8"), ("Score", "f8"),
+                 ("mfScore", "f8"), ("Name", "S"), ("Run#", "i4")]
+
+# Compact record kept for every ligand by the top mode
+LIGSTATS_DTYPE = np.dtype([("No", "i8"), ("count", "i4"), ("Score", "f8")])
 
 
 def main():
@@ -20,7 +39,8 @@ def main():
     """
 
     # Get arguments
-    vsDir, minRep, allRep = parseArguments()
+    vsDir, minRep, allRep, stream, jobs, incremental, top, withFull, \
+        coverage, watch, interval = parseArguments()
 
     # Get the project name out of the vsDir
     projName = os.path.basename(os.path.normpath(vsDir))
@@ -28,51 +48,110 @@ def main():
     if projName == ".":
         projName = os.path.basename(os.getcwd())
 
-    print vsDir, minRep, allRep, projName
+    print(vsDir, minRep, allRep, projName)
     sys.stdout.flush()
 
-    # Create the dictionary storing ligand info
-    # based on ligandID: for each ligandID key there
-    # is a number of ligangInfo lists equal to the
-    # number of repeats
-    ligDict = {}
+    # Results file used to tell whether anything changed in incremental mode
+    if top and not withFull:
+        resultPath = vsDir + "/" + topFileName(top, projName)
+    else:
+        resultPath = vsDir + "/results_" + projName + ".csv"
+
+    # Coverage file written by removeFailed, if requested
+    coveragePath = None
+    if coverage:
+        coveragePath = vsDir + "/coverage_" + projName + ".json"
+
+    # Ligand ID ranges docked in every repeat, when the later repeats of this
+    # VS were only built for some ligands (vs_build.py --adaptive)
+    adaptiveRanges = loadAdaptivePlan(vsDir)
+
+    # Follow the .ou files while the VS runs, until interrupted
+    if watch:
+        watchResults(vsDir, projName, minRep, jobs, top, interval,
+                     adaptiveRanges)
+        return
+
+    # In incremental mode, load the records parsed by the previous runs
+    cache = None
+    if incremental:
+        cachePath = vsDir + "/results_" + projName + ".cache"
+        cache = loadCache(cachePath, [minRep, allRep, stream, top, withFull])
+
+    # Only the best ligands are wanted: keep the best scores within a bounded
+    # number of candidates while parsing, and write the top results file
+    if top and not withFull:
+        print('collectTopScores...')
+        sys.stdout.flush()
+        topTable = collectTopScores(vsDir, top, minRep, jobs, cache,
+                                    coveragePath, adaptiveRanges)
+        if incremental:
+            if not cache["changed"] and os.path.exists(resultPath):
+                print("\nNo new results since the last run, "
+                      "results not written")
+                return
+            saveCache(cachePath, cache)
+        writeTopFile(topTable, top, projName, vsDir)
+        return
 
     # Goes through repeat directories to gather the score data
-    # Returns ligDict (VS results) total number of repeats
-    print 'collectScoreData...'
+    # Returns the results table (one row per ligand and repeat, or only the
+    # best repeat of each ligand when streaming), the total number of repeats,
+    # and the number of repeats each ligand was docked in when streaming
+    print('collectScoreData...')
     sys.stdout.flush()
-    ligDict, totalRepeatNum = collectScoreData(vsDir, ligDict)
+    table, totalRepeatNum, repCounts = collectScoreData(vsDir, stream, jobs,
+                                                        cache)
+
+    # Stage 2 of a multi-stage VS (vs_build.py --stage2), whose results are
+    # merged with the results of this VS
+    stage2Dir = vsDir + "/stage2"
+    hasStage2 = len(glob.glob(stage2Dir + "/*/*.ou")) > 0
+
+    # Save the updated cache, and stop here if nothing changed since the
+    # results were last written (the stage 2 files are not cached)
+    if incremental:
+        if not cache["changed"] and os.path.exists(resultPath) and \
+                not hasStage2:
+            print("\nNo new results since the last run, results not written")
+            return
+        saveCache(cachePath, cache)
 
     # Getting rid of the ligands that were not docking in all repeats attempted
-    print 'removeFailed...'
+    print('removeFailed...')
     sys.stdout.flush()
-    ligDict = removeFailed(ligDict, totalRepeatNum, minRep)
+    table = removeFailed(table, totalRepeatNum, minRep, repCounts,
+                         coveragePath, adaptiveRanges)
 
-    # Sort each ligand docking amongst repeats
-    print 'sortRepeats'
+    # Keep the best repeat of each ligand
+    print('sortRepeats')
     sys.stdout.flush()
-    ligDict = sortRepeats(ligDict)
+    bestTable = sortRepeats(table)
 
     # Write the results in a .csv file
-    print 'writeResultFiles'
+    print('writeResultFiles')
     sys.stdout.flush()
-    writeResultFiles(ligDict, projName, vsDir)
+    writeResultFiles(bestTable, projName, vsDir)
+
+    # Write out the best ligands alongside the full results, if requested
+    if top:
+        writeTopFile(bestTable, top, projName, vsDir)
+
+    # Replace the stage 1 results of the ligands docked in stage 2 by their
+    # stage 2 results
+    if hasStage2:
+        print('\nmergeStage2...')
+        sys.stdout.flush()
+        stage2Table, stage2RepeatNum, stage2Counts = collectScoreData(
+            stage2Dir, stream, jobs)
+        stage2Table = removeFailed(stage2Table, stage2RepeatNum, minRep,
+                                   stage2Counts,
+                                   dockedRanges=loadStage2Plan(stage2Dir))
+        writeMergedFile(bestTable, sortRepeats(stage2Table), projName, vsDir)
 
     # Write out individual results files for each repeat, if requested
     if allRep:
-        # For each repeat,
-        for repeat in range(1, totalRepeatNum + 1):
-            # Initialise a results text file
-            repFileName = "repeat{}_results_{}.csv".format(repeat, projName)
-            print("\t" + repFileName)
-	    sys.stdout.flush()
-            repFile = open(vsDir + "/" + repFileName, "w")
-            repFile.write("No,Nat,Nva,dEhb,dEgrid,dEin,dEsurf" +
-                          ",dEel,dEhp,Score,mfScore,Name,Run#\n")
-
-            # Then, extract ligDict data corresponding to that repeat, sort,
-            # and write to text file
-            writeRepeatFile(repFile, repeat, ligDict)
+        writeRepeatFiles(table, totalRepeatNum, projName, vsDir)
 
 
 def parseArguments():
@@ -84,18 +163,78 @@ def parseArguments():
         " the results. Default is max number of repeats"
     descr_allRep = "Print out all results from each repeat in a different" \
         " text file"
+    descr_stream = "Stream the .ou files and only keep the best repeat of" \
+        " each ligand in memory (not compatible with -allRep)"
+    descr_jobs = "Number of processes used to parse the .ou files in" \
+        " parallel. Default is 1"
+    descr_incremental = "Keep the parsed results in a cache file in the VS" \
+        " directory, and only parse what was appended to the .ou files since" \
+        " the previous run"
+    descr_top = "Only write the results of the K best ligands, to" \
+        " top<K>_results_<projName>.csv, keeping at most about K ligands in" \
+        " memory while parsing"
+    descr_coverage = "Write the number of ligands docked in each number of" \
+        " repeats and the ID ranges of the incomplete dockings to" \
+        " coverage_<projName>.json"
+    descr_withFull = "With --top, also write the full results file (this" \
+        " uses as much memory as a normal run)"
+    descr_watch = "Keep following the .ou files while the VS runs, and" \
+        " rewrite the results file and progress_<projName>.json whenever new" \
+        " results were found (stop with Ctrl-C)"
+    descr_interval = "Number of seconds between two checks of the .ou files" \
+        " with --watch. Default is 300"
 
     # Defining the arguments
     parser = argparse.ArgumentParser(description=descr)
     parser.add_argument("vsDir", help=descr_vsDir)
     parser.add_argument("--minRep", help=descr_minRep)
     parser.add_argument("-allRep", action="store_true", help=descr_allRep)
+    parser.add_argument("-stream", action="store_true", help=descr_stream)
+    parser.add_argument("--jobs", type=int, default=1, help=descr_jobs)
+    parser.add_argument("-incremental", action="store_true",
+                        help=descr_incremental)
+    parser.add_argument("--top", type=int, help=descr_top)
+    parser.add_argument("-withFull", action="store_true", help=descr_withFull)
+    parser.add_argument("-coverage", action="store_true",
+                        help=descr_coverage)
+    parser.add_argument("--watch", action="store_true", help=descr_watch)
+    parser.add_argument("--interval", type=int, default=300,
+                        help=descr_interval)
 
     # Parsing arguments
     args = parser.parse_args()
     vsDir = args.vsDir
     minRep = args.minRep
     allRep = args.allRep
+    stream = args.stream
+    jobs = max(1, args.jobs)
+    incremental = args.incremental
+    top = args.top
+    withFull = args.withFull
+    coverage = args.coverage
+    watch = args.watch
+    interval = max(1, args.interval)
+
+    if top is not None and top < 1:
+        print("--top has to be a positive number of ligands")
+        sys.exit()
+    # The repeat files need every repeat of every ligand
+    if top and allRep and not withFull:
+        print("-allRep can only be used with --top when -withFull is used")
+        sys.exit()
+
+    # The streaming parser drops all but the best repeat of each ligand, so
+    # the individual repeat files cannot be written from it
+    if stream and allRep:
+        print("The -stream and -allRep options cannot be used together")
+        sys.exit()
+
+    # The watch mode keeps its own in-memory records, and only writes the
+    # results file (and the top file)
+    if watch and (allRep or stream or incremental or withFull or coverage):
+        print("--watch cannot be used with -allRep, -stream, -incremental,"
+              " -withFull or -coverage")
+        sys.exit()
 
     # Deal with minRep in case the option was not used in which case use a very
     # large int number. Otherwise make the minRep an int.
@@ -106,54 +245,659 @@ def parseArguments():
         # the repeat number be that high)
         minRep = 999999999999999999999
 
-    return vsDir, minRep, allRep
+    return vsDir, minRep, allRep, stream, jobs, incremental, top, withFull, \
+        coverage, watch, interval
 
 
-def collectScoreData(vsDir, ligDict):
+def collectScoreData(vsDir, stream=False, jobs=1, cache=None):
     """
-    Go through the repeat directories and collect the score data
+    Go through the repeat directories and collect the score data in a results
+    table. When stream is True, only the best repeat of each ligand is kept in
+    the table and the number of repeats found for each ligand is counted in
+    repCounts (an array aligned with the table rows).
+    With more than one job, the .ou files are parsed in a pool of processes and
+    their results merged here, in the same order as the sequential parsing.
+    When a cache is provided (incremental mode), each .ou file is only parsed
+    from the offset reached by the previous run, and the cache is updated
     """
 
     print("\nPARSING:\n")
 
     maxRepeatNum = -1
+    # Tables of the files parsed, and the best repeats and their counts when
+    # streaming
+    fileTables = []
+    bestTable = emptyTable()
+    repCounts = np.zeros(0, dtype="i4")
 
     # Get all .ou files in each repeat directory
     ouFiles = glob.glob(vsDir + "/*/*.ou")
-    # Loop through them and look for the 'SCORES' line
-    for ouFilePath in ouFiles:
-        # Open file containing text result of the VLS
-        file = open(ouFilePath, "r")
-        lines = file.readlines()
-        file.close()
-
-        vs_dir = os.path.dirname(os.path.dirname(ouFilePath))
-        repeatNum = os.path.dirname(ouFilePath).replace(vs_dir + "/", "")
-        # print ouFilePath
-        # print repeatNum
-
-        # Loop through each line of the file
-        ligDockedNum = 0
-        for line in lines:
-            # We take only the lines that contain "SCORE>"
-            if "SCORES>" in line:
-                ligDockedNum += 1
-                ligDict = parseScoreLine(ligDict, line, repeatNum)
-
-        print("\t" + ouFilePath + "\t" + str(ligDockedNum) + " ligands")
-	sys.stdout.flush()
+
+    # Loop through them and gather their tables
+    for ouFilePath, repeatNum, fileTable, skipped in iterFileTables(ouFiles,
+                                                                    jobs,
+                                                                    cache):
+        fileTables.append(fileTable)
+
+        # When streaming, regularly fold the parsed tables into the best
+        # repeats, so that memory stays proportional to the number of ligands
+        if stream and sum(len(t) for t in fileTables) > \
+                max(len(bestTable), 100000):
+            bestTable, repCounts = keepBestScore(bestTable, repCounts,
+                                                 fileTables)
+            fileTables = []
+
+        printParsed(ouFilePath, fileTable, skipped)
 
         # Update the repeat number in order to grab the max repeat number
         if maxRepeatNum < int(repeatNum):
             maxRepeatNum = int(repeatNum)
 
-    return ligDict, maxRepeatNum
+    # Without streaming the repeat counts are computed from the table rows
+    if stream:
+        table, repCounts = keepBestScore(bestTable, repCounts, fileTables)
+    else:
+        table = concatTables(fileTables)
+        repCounts = None
+
+    return table, maxRepeatNum, repCounts
+
+
+def iterFileTables(ouFiles, jobs=1, cache=None):
+    """
+    Parse the .ou files and yield the path, repeat number, results table and
+    number of incomplete lines skipped of each of them, in the order of
+    ouFiles (the worker processes do not print, their results are reported
+    here in this order).
+    With more than one job, the .ou files are parsed in a pool of processes.
+    When a cache is provided (incremental mode), each .ou file is only parsed
+    from the offset reached by the previous run, and the cache is updated
+    """
+
+    # Get the offset from which each file has to be parsed, None when the file
+    # is unchanged since the cache was written
+    if cache is not None:
+        offsets = checkCache(cache, ouFiles)
+    else:
+        offsets = [0] * len(ouFiles)
+    parseTasks = [(ouFilePath, offset) for ouFilePath, offset
+                  in zip(ouFiles, offsets) if offset is not None]
+
+    # Parse the files either in this process, or in a pool of processes. imap
+    # returns the parsed files in the order of ouFiles, which keeps the merge
+    # (and therefore the ordering of ties in the results) deterministic
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        parsedFiles = pool.imap(parseOuTask, parseTasks)
+    else:
+        parsedFiles = map(parseOuTask, parseTasks)
+
+    for ouFilePath, offset in zip(ouFiles, offsets):
+        skipped = 0
+        if offset is None:
+            repeatNum, fileTable = cache["files"][ouFilePath]["records"]
+        else:
+            ouFilePath, repeatNum, fileTable, endOffset, skipped = \
+                next(parsedFiles)
+            if cache is not None:
+                fileTable = updateCache(cache, ouFilePath, repeatNum,
+                                        fileTable, offset, endOffset)
+        yield ouFilePath, repeatNum, fileTable, skipped
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def printParsed(ouFilePath, fileTable, skipped):
+    """
+    Print the number of ligands parsed from a .ou file, and of the incomplete
+    lines skipped if any
+    """
+
+    line = "\t" + ouFilePath + "\t" + str(len(fileTable)) + " ligands"
+    if skipped > 0:
+        line += ", " + str(skipped) + " incomplete lines skipped"
+    print(line)
+    sys.stdout.flush()
+
+
+def collectTopScores(vsDir, top, minRepeatNum, jobs=1, cache=None,
+                     coveragePath=None, adaptiveRanges=None):
+    """
+    Go through the repeat directories and collect the best repeat of the top
+    best scoring ligands that pass the minimum repeat rule of removeFailed.
+    Only a compact record (ligID, repeat count, best score) is kept for every
+    ligand, and full rows are only kept for the candidates that can still make
+    it to the top. Returns the table of the candidates passing the minimum
+    repeat rule, which holds the top ligands
+    """
+
+    print("\nPARSING:\n")
+
+    # Parse the repeats of the same slice one after the other (they share
+    # their .ou file name), so that ligands reach their final number of
+    # repeats early and the candidates can be pruned as parsing goes
+    ouFiles = sorted(glob.glob(vsDir + "/*/*.ou"),
+                     key=lambda path: (os.path.basename(path), path))
+    repeatNums = [int(os.path.basename(os.path.dirname(path)))
+                  for path in ouFiles]
+    totalRepeatNum = max(repeatNums + [-1])
+
+    # Number of repeats needed for a ligand to be included (see removeFailed)
+    minRepeats = min(totalRepeatNum, minRepeatNum)
+
+    fileTables = []
+    candidates = emptyTable()
+    ligStats = np.zeros(0, dtype=LIGSTATS_DTYPE)
+
+    for ouFilePath, repeatNum, fileTable, skipped in iterFileTables(ouFiles,
+                                                                    jobs,
+                                                                    cache):
+        fileTables.append(fileTable)
+        if sum(len(t) for t in fileTables) > max(len(candidates), 100000):
+            candidates, ligStats = keepTopScores(candidates, ligStats,
+                                                 fileTables, top, minRepeats,
+                                                 adaptiveRanges)
+            fileTables = []
+
+        printParsed(ouFilePath, fileTable, skipped)
+
+    candidates, ligStats = keepTopScores(candidates, ligStats, fileTables,
+                                         top, minRepeats, adaptiveRanges)
+
+    # Print the incomplete dockings of all ligands, from their compact record
+    removeFailed(ligStats, totalRepeatNum, minRepeatNum, ligStats["count"],
+                 coveragePath, adaptiveRanges)
+
+    # Keep the candidates passing the minimum repeat rule
+    counts = ligStats["count"][np.searchsorted(ligStats["No"],
+                                               candidates["No"])]
+
+    return candidates[counts >= requiredRepeats(candidates["No"], minRepeats,
+                                                adaptiveRanges)]
+
+
+def keepTopScores(candidates, ligStats, fileTables, top, minRepeats,
+                  adaptiveRanges=None):
+    """
+    Fold newly parsed file tables into the compact record of every ligand
+    (ligStats: ligID, number of repeats, best score) and into the candidates
+    table (best repeat of the ligands that can still make it to the top).
+    Once at least top ligands have enough repeats, any candidate scoring worse
+    than the top-th of them can never make it to the top, as scores only
+    improve with new repeats, and is dropped
+    """
+
+    newTable = concatTables(fileTables)
+
+    # Update the compact record of each ligand, sorted by ligID
+    newStats = np.zeros(len(newTable), dtype=LIGSTATS_DTYPE)
+    newStats["No"] = newTable["No"]
+    newStats["count"] = 1
+    newStats["Score"] = newTable["Score"]
+    ligStats = np.concatenate([ligStats, newStats])
+    ligStats = ligStats[np.argsort(ligStats["No"], kind="stable")]
+    firsts = firstOfEachLigand(ligStats)
+    mergedStats = ligStats[firsts]
+    mergedStats["count"] = np.add.reduceat(ligStats["count"], firsts)
+    mergedStats["Score"] = np.minimum.reduceat(ligStats["Score"], firsts)
+    ligStats = mergedStats
+
+    # Update the best repeat of the candidates
+    candidates, counts = keepBestScore(candidates,
+                                       np.zeros(len(candidates), dtype="i4"),
+                                       [newTable])
+
+    # Score of the top-th best ligand having enough repeats, if there are
+    # enough of them already
+    eligible = ligStats["count"] >= requiredRepeats(ligStats["No"], minRepeats,
+                                                    adaptiveRanges)
+    eligibleScores = ligStats["Score"][eligible]
+    if len(eligibleScores) >= top:
+        threshold = np.partition(eligibleScores, top - 1)[top - 1]
+        candidates = candidates[candidates["Score"] <= threshold]
+
+    return candidates, ligStats
+
+
+def watchResults(vsDir, projName, minRepeatNum, jobs=1, top=None,
+                 interval=300, adaptiveRanges=None):
+    """
+    Follow the .ou files of a running VS. Every interval seconds, the .ou files
+    are checked with os.stat, and only the lines appended since the previous
+    check are parsed and folded into the best repeat of each ligand, which is
+    all that is kept in memory. Whenever new results were found, the results
+    file (and the top file) and the progress summary are rewritten
+    """
+
+    # Only the offset reached in each .ou file is kept in this cache, the rows
+    # parsed are folded into the best repeats
+    cache = {"options": None, "files": {}}
+    bestTable = emptyTable()
+    repCounts = np.zeros(0, dtype="i4")
+    repeatRows = {}
+
+    print("\nWATCHING: " + vsDir + " every " + str(interval) +
+          " seconds (Ctrl-C to stop)\n")
+    sys.stdout.flush()
+
+    try:
+        while True:
+            newTables, ouFileNum, totalRepeatNum = followOuFiles(vsDir, jobs,
+                                                                 cache)
+
+            # A .ou file was rewritten or removed (e.g. a slice was docked
+            # again): its previous rows cannot be taken out of the best
+            # repeats, so everything is parsed again
+            if cache["reset"]:
+                print("\tA .ou file was rewritten, parsing from scratch")
+                cache["files"] = {}
+                bestTable = emptyTable()
+                repCounts = np.zeros(0, dtype="i4")
+                repeatRows = {}
+                newTables, ouFileNum, totalRepeatNum = followOuFiles(vsDir,
+                                                                     jobs,
+                                                                     cache)
+
+            if cache["changed"]:
+                bestTable, repCounts = keepBestScore(bestTable, repCounts,
+                                                     newTables)
+                newRowNum = 0
+                for newTable in newTables:
+                    newRowNum += len(newTable)
+                    repeats, counts = np.unique(newTable["Run#"],
+                                                return_counts=True)
+                    for repeat, count in zip(repeats.tolist(),
+                                             counts.tolist()):
+                        repeatRows[repeat] = repeatRows.get(repeat, 0) + count
+
+                # removeFailed prints the ranges of incomplete dockings, which
+                # are most of the library while the VS runs
+                with open(os.devnull, "w") as devnull, \
+                        contextlib.redirect_stdout(devnull):
+                    resultTable = removeFailed(bestTable, totalRepeatNum,
+                                               minRepeatNum, repCounts,
+                                               adaptiveRanges=adaptiveRanges)
+                    writeResultFiles(resultTable, projName, vsDir)
+                    if top:
+                        writeTopFile(resultTable, top, projName, vsDir)
+
+                writeProgressFile(vsDir, projName, ouFileNum, totalRepeatNum,
+                                  min(totalRepeatNum, minRepeatNum),
+                                  repeatRows, bestTable, resultTable)
+
+                print("\t" + time.strftime("%Y-%m-%d %H:%M:%S") + "\t" +
+                      str(newRowNum) + " new results, " +
+                      str(len(bestTable)) + " ligands docked, " +
+                      str(len(resultTable)) + " in the results")
+                sys.stdout.flush()
+
+            time.sleep(interval)
+
+    except KeyboardInterrupt:
+        print("\nStopped watching " + vsDir)
+
+
+def followOuFiles(vsDir, jobs, cache):
+    """
+    Parse what was appended to the .ou files since the previous call (new .ou
+    files are parsed from their start). Returns the tables of the new rows,
+    the number of .ou files and the total number of repeats. The cache only
+    keeps the offsets of the files: cache["changed"] tells whether new lines
+    were found, and cache["reset"] whether a file was rewritten or removed
+    """
+
+    cache["changed"] = False
+    cache["reset"] = False
+
+    ouFiles = glob.glob(vsDir + "/*/*.ou")
+
+    newTables = []
+    totalRepeatNum = -1
+    for ouFilePath, repeatNum, fileTable, skipped in iterFileTables(ouFiles,
+                                                                    jobs,
+                                                                    cache):
+        newTables.append(fileTable)
+        if skipped > 0:
+            print("\t" + ouFilePath + "\t" + str(skipped) +
+                  " incomplete lines skipped")
+        # Drop the rows from the cache entry, so that the next call only
+        # returns the rows appended after this one
+        cache["files"][ouFilePath]["records"][1] = fileTable[:0]
+
+        if totalRepeatNum < int(repeatNum):
+            totalRepeatNum = int(repeatNum)
+
+    return newTables, len(ouFiles), totalRepeatNum
+
+
+def writeProgressFile(vsDir, projName, ouFileNum, totalRepeatNum, minRepeats,
+                      repeatRows, bestTable, resultTable):
+    """
+    Write a small summary of the progress of the VS to progress_<proj>.json,
+    through a temporary file so that it can be read at any time
+    """
+
+    progress = {"updated": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "ouFiles": ouFileNum,
+                "totalRepeats": totalRepeatNum,
+                "minRepeats": minRepeats,
+                "dockedPerRepeat": {str(repeat): repeatRows[repeat]
+                                    for repeat in sorted(repeatRows)},
+                "ligandsDocked": len(bestTable),
+                "ligandsInResults": len(resultTable)}
+
+    if len(resultTable) > 0:
+        best = resultTable[np.argmin(resultTable["Score"])]
+        progress["bestLigand"] = {"No": int(best["No"]),
+                                  "Name": best["Name"].decode(
+                                      errors="replace"),
+                                  "Score": float(best["Score"])}
+
+    progressPath = vsDir + "/progress_" + projName + ".json"
+    with open(progressPath + ".tmp", "w") as f:
+        json.dump(progress, f, indent=2)
+    os.replace(progressPath + ".tmp", progressPath)
+
+
+def loadAdaptivePlan(vsDir):
+    """
+    Read the adaptive.json plan written by vs_build.py --adaptive in the VS
+    directory, and return the sorted [start, end] ranges of the ligand IDs
+    docked in every repeat. Returns None for a VS that is not adaptive
+    """
+
+    planPath = vsDir + "/adaptive.json"
+    if not os.path.exists(planPath):
+        return None
+
+    with open(planPath) as f:
+        plan = json.load(f)
+    print("\nADAPTIVE VS: " + str(len(plan["ranges"])) +
+          " ID ranges docked in every repeat, others in repeat 1 only")
+
+    return np.array(plan["ranges"], dtype="i8").reshape(-1, 2)
+
+
+def loadStage2Plan(stage2Dir):
+    """
+    Read the stage2.json selection written by vs_build.py --stage2, and
+    return the sorted [start, end] ranges of the ligand IDs docked in stage 2.
+    Returns None when there is no selection file
+    """
+
+    planPath = stage2Dir + "/stage2.json"
+    if not os.path.exists(planPath):
+        return None
+
+    with open(planPath) as f:
+        plan = json.load(f)
+
+    return np.array(plan["ranges"], dtype="i8").reshape(-1, 2)
+
+
+def requiredRepeats(ligIDs, minRepeats, adaptiveRanges=None):
+    """
+    Return the number of repeats each ligand needs to be included in the
+    results: minRepeats, or at most 1 for the ligands an adaptive VS only
+    planned for the first repeat (outside of adaptiveRanges)
+    """
+
+    required = np.full(len(ligIDs), minRepeats, dtype="i8")
+    if adaptiveRanges is None:
+        return required
+
+    # Find the last range starting before each ligand, and check that the
+    # ligand is before its end
+    inRanges = np.zeros(len(ligIDs), dtype=bool)
+    if len(adaptiveRanges) > 0:
+        rangeIndex = np.searchsorted(adaptiveRanges[:, 0], ligIDs,
+                                     side="right") - 1
+        inRanges = (rangeIndex >= 0) & \
+            (ligIDs <= adaptiveRanges[np.maximum(rangeIndex, 0), 1])
+    required[~inRanges] = min(minRepeats, 1)
+
+    return required
+
+
+def tableDtype(nameWidth):
+    """
+    Return the numpy dtype of a results table, with a given width (in bytes)
+    for the ligand names
+    """
+
+    return np.dtype([(col, "S" + str(max(nameWidth, 1))) if typ == "S"
+                     else (col, typ) for col, typ in TABLE_COLUMNS])
 
 
-def parseScoreLine(ligDict, line, repeatNum):
+def emptyTable():
     """
-    Populate the ligDict dictionary in the following manner:
-    ligDict{ligandID, [[ligInfo_rep1], [ligInfo_rep2], ...]}
+    Return a results table with no rows
+    """
+
+    return np.zeros(0, dtype=tableDtype(1))
+
+
+def concatTables(tables):
+    """
+    Concatenate results tables, widening the ligand names to the widest
+    """
+
+    if len(tables) == 0:
+        return emptyTable()
+
+    nameWidth = max(t.dtype["Name"].itemsize for t in tables)
+    dtype = tableDtype(nameWidth)
+
+    return np.concatenate([t.astype(dtype) for t in tables])
+
+
+def loadCache(cachePath, options):
+    """
+    Load the cache of the previous incremental run. A new cache is started if
+    there is none, or if the options that shape the results have changed
+    """
+
+    cache = None
+    if os.path.exists(cachePath):
+        with open(cachePath, "rb") as f:
+            cache = pickle.load(f)
+        if cache.get("options") != options:
+            print("\nOptions differ from the cached run, parsing from scratch")
+            cache = None
+
+    if cache is None:
+        cache = {"options": options, "files": {}}
+
+    cache["changed"] = False
+
+    return cache
+
+
+def saveCache(cachePath, cache):
+    """
+    Write the cache next to the results, through a temporary file so that an
+    interrupted run does not leave a corrupted cache behind
+    """
+
+    tmpPath = cachePath + ".tmp"
+    with open(tmpPath, "wb") as f:
+        pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, cachePath)
+
+
+def checkCache(cache, ouFiles):
+    """
+    Compare each .ou file to its cache entry, and return the offset from which
+    it needs to be parsed: None if unchanged, the end of the last parsed line
+    if data was appended, or 0 if the file was replaced or truncated
+    """
+
+    offsets = []
+    for ouFilePath in ouFiles:
+        entry = cache["files"].get(ouFilePath)
+        stat = os.stat(ouFilePath)
+
+        if entry is None:
+            offset = 0
+        elif stat.st_size == entry["size"] and \
+                stat.st_mtime == entry["mtime"]:
+            offset = None
+        elif stat.st_size < entry["offset"] or \
+                readHead(ouFilePath) != entry["head"]:
+            offset = 0
+        else:
+            offset = entry["offset"]
+
+        if offset is not None:
+            cache["changed"] = True
+        # Rows previously parsed from this file are no longer valid
+        if offset == 0 and entry is not None:
+            cache["reset"] = True
+        offsets.append(offset)
+
+    # Forget about the files that are gone
+    for ouFilePath in set(cache["files"].keys()) - set(ouFiles):
+        del cache["files"][ouFilePath]
+        cache["changed"] = True
+        cache["reset"] = True
+
+    return offsets
+
+
+def updateCache(cache, ouFilePath, repeatNum, fileTable, offset, endOffset):
+    """
+    Store the newly parsed table of a .ou file in its cache entry, appended
+    to the rows already parsed when the file was parsed from an offset.
+    Returns the full table of that file
+    """
+
+    if offset > 0:
+        fileTable = concatTables([cache["files"][ouFilePath]["records"][1],
+                                  fileTable])
+
+    stat = os.stat(ouFilePath)
+    cache["files"][ouFilePath] = {"size": stat.st_size,
+                                  "mtime": stat.st_mtime,
+                                  "offset": endOffset,
+                                  "head": readHead(ouFilePath),
+                                  "records": [repeatNum, fileTable]}
+
+    return fileTable
+
+
+def readHead(ouFilePath):
+    """
+    Return the first bytes of a file, used to tell a .ou file that was
+    rewritten by a new docking run from one that was only appended to
+    """
+
+    with open(ouFilePath, "rb") as f:
+        return f.read(256)
+
+
+def parseOuTask(parseTask):
+    """
+    Unpack a (ouFilePath, offset) task for parseOuFile, as used by the pool
+    """
+
+    return parseOuFile(*parseTask)
+
+
+def parseOuFile(ouFilePath, offset=0):
+    """
+    Parse the "SCORES>" lines of a single .ou file, starting at the byte
+    offset. Returns the file path, its repeat number (name of the repeat
+    directory), its results table, the offset where parsing stopped and the
+    number of lines skipped because they do not hold every score term.
+    This runs in the worker processes when parsing in parallel, so nothing is
+    printed here
+    """
+
+    vs_dir = os.path.dirname(os.path.dirname(ouFilePath))
+    repeatNum = os.path.dirname(ouFilePath).replace(vs_dir + "/", "")
+    # print ouFilePath
+    # print repeatNum
+
+    scoreLines, endOffset = readScoreLines(ouFilePath, offset)
+
+    ligInfos = []
+    skipped = 0
+    for line in scoreLines:
+        ligInfo = parseLigInfo(line, repeatNum)
+        # Lines that do not hold every score term cannot be stored in the table
+        if len(ligInfo) != len(TABLE_COLUMNS):
+            skipped += 1
+            continue
+        ligInfos.append(ligInfo)
+
+    nameWidth = max([len(ligInfo[-2]) for ligInfo in ligInfos] + [1])
+    fileTable = np.array(ligInfos, dtype=tableDtype(nameWidth))
+
+    return ouFilePath, repeatNum, fileTable, endOffset, skipped
+
+
+def readScoreLines(ouFilePath, offset=0):
+    """
+    Find the "SCORES>" lines of a .ou file from the byte offset. The file is
+    memory mapped and searched for the marker, so that only the "SCORES>"
+    lines are decoded. A last line that is still being written by ICM (no end
+    of line, and not the FINISHED line) is left for the next read. Returns the
+    lines and the offset of the end of the last line read
+    """
+
+    with ouscan.mapOuFile(ouFilePath) as data:
+        endOffset = ouscan.completeEnd(data, offset)
+        scoreLines = list(ouscan.markerLines(data, b"SCORES>", offset,
+                                             endOffset))
+
+    return scoreLines, endOffset
+
+
+def keepBestScore(bestTable, repCounts, fileTables):
+    """
+    Streaming version of sortRepeats: fold the newly parsed file tables into
+    the table of the best repeat of each ligand, and add their rows to the
+    count of repeats of each ligand (repCounts)
+    """
+
+    table = concatTables([bestTable] + fileTables)
+    counts = np.concatenate([repCounts] +
+                            [np.ones(len(t), dtype="i4") for t in fileTables])
+
+    # Sort by ligand ID then score. The sort is stable and the previous best
+    # repeats come first, so that ties are resolved in favour of the first
+    # repeat parsed
+    order = np.lexsort((table["Score"], table["No"]))
+    table = table[order]
+    counts = counts[order]
+
+    # The first row of each ligand is its best repeat
+    firsts = firstOfEachLigand(table)
+
+    return table[firsts], np.add.reduceat(counts, firsts).astype("i4")
+
+
+def firstOfEachLigand(table):
+    """
+    Return the indexes of the first row of each ligand, in a table sorted by
+    ligand ID
+    """
+
+    ligIDs = table["No"]
+    newLig = np.ones(len(ligIDs), dtype=bool)
+    newLig[1:] = ligIDs[1:] != ligIDs[:-1]
+
+    return np.flatnonzero(newLig)
+
+
+def parseLigInfo(line, repeatNum):
+    """
+    Split a "SCORES>" line into the ligInfo tuple, typed as in TABLE_COLUMNS:
+    (ligID, Nat, Nva, dEhb, dEgrid, dEin, dEsurf, dEel, dEhp, Score, mfScore,
+     Name, Run#)
     """
 
     ll = line.split()
@@ -181,173 +925,349 @@ def parseScoreLine(ligDict, line, repeatNum):
         # (determined by the presnce of a '=')
         if "=" in split:
             val = ll[i + 1].rstrip("%FINISHED")
-            # The score has to be stored as a float,
-            # because it is used for sorting
-            if split.strip() == "Score=":
+            # Nat and Nva are counts, the energy terms and scores are floats
+            if len(ligInfo) < 3:
+                val = int(val)
+            else:
                 val = float(val)
             ligInfo.append(val)
 
     # Add the ligand name, which can be none when it is
     # not provided in the original .sdf library
-    ligInfo.append(ligName)
+    ligInfo.append(ligName.encode())
     # Lastly adding the repeat number info
-    ligInfo.append(repeatNum)
+    ligInfo.append(int(repeatNum))
 
-    # Add that ligInfo to the ligDict, if it already exists
-    # just append to the list, otherwise create a new list
-    keys = ligDict.keys()
-    if ligID not in keys:
-        ligDict[ligID] = [ligInfo]
-    else:
-        ligDict[ligID].append(ligInfo)
+    return tuple(ligInfo)
 
-    return ligDict
 
-
-def removeFailed(ligDict, totalRepeatNum, minRepeatNum):
+def removeFailed(table, totalRepeatNum, minRepeatNum, repCounts=None,
+                 coveragePath=None, adaptiveRanges=None, dockedRanges=None):
     """
     Loop over all results and remove those not successful for all repeats
-    attempted. Print the information about the failed dockings.
+    attempted. Print the information about the failed dockings, as ranges of
+    ligand IDs grouped by number of successful repeats, and write it to the
+    coverage file if a path is provided.
+    The number of repeats of each ligand is read from repCounts when it is
+    provided (streamed results, one row per ligand), otherwise it is counted
+    from the rows of the table.
+    With adaptiveRanges, only the ligands in these ID ranges were docked in
+    every repeat, the others were planned for the first repeat only.
+    With dockedRanges (stage 2 of a multi-stage VS), only the ligands in these
+    ID ranges were docked: the IDs missing outside them are not reported.
     """
 
-    # Get the max ligID of the docked ligands
-    ligIDs = sorted(ligDict.keys())
-    minLigID = ligIDs[0]
-    maxLigID = ligIDs[-1]
-    # Create a range list of IDs, stopping at the max
-    rangeIDs = range(minLigID, maxLigID + 1)
-    rangeFlag = dict([(ligID, False) for ligID in rangeIDs])
-    # print rangeFlag
-
     print("\nINCOMPLETE DOCKINGS:\n")
 
-    # keys = ligDict.keys()
-    for key in ligIDs:
-        currRepeatNum = len(ligDict[key])
-
-        # When the number of repeats found is not equal to the max number of
-        # repeats expected
-        if currRepeatNum != totalRepeatNum:
-            print("\tid:" + str(key) + "# of sucessful repeats:" +
-                  str(currRepeatNum))
-            # For cases where a ligand was docked more than the defined repeat
-            # number (when there was mistake in the VS setup)
-            if currRepeatNum > totalRepeatNum:
-                print("\t\t(included)")
-            # For cases where the repeat number of a given ligand is above or
-            # equal to the user defined minimum repeat number
-            elif currRepeatNum >= minRepeatNum:
-                print("\t\t(included)")
-            # Otherwise delete the ligand's information from the list
-            else:
-                print("\t\t(deleted)")
-                del ligDict[key]
-	    sys.stdout.flush()
+    if len(table) == 0:
+        print("\nSUMMARY:\n")
+        print("\tTotal ligands docked:0")
+        return table
 
-        # Flag the current ligID when it is found
-        if key in rangeFlag.keys():
-            rangeFlag[key] = True
+    # Get the docked ligIDs and the number of repeats of each
+    if repCounts is None:
+        ligIDs, rowLig, ligCounts = np.unique(table["No"], return_inverse=True,
+                                              return_counts=True)
+    else:
+        order = np.argsort(table["No"], kind="stable")
+        ligIDs = table["No"][order]
+        ligCounts = repCounts[order]
+        rowLig = np.empty(len(table), dtype=np.intp)
+        rowLig[order] = np.arange(len(table))
+
+    # Ligands docked in all the repeats planned for them, or more (when there
+    # was a mistake in the VS setup), or in at least the user defined minimum
+    # number of repeats, are included. Others are deleted from the results
+    expected = requiredRepeats(ligIDs, totalRepeatNum, adaptiveRanges)
+    included = ligCounts >= np.minimum(expected, min(totalRepeatNum,
+                                                     minRepeatNum))
+
+    # Ranges of IDs in the docked range that were not found in any repeat,
+    # then of the IDs found in each number of repeats other than the max
+    # number of repeats expected
+    coverage = {"totalRepeats": int(totalRepeatNum),
+                "minRepeats": int(min(totalRepeatNum, minRepeatNum)),
+                "idRange": [int(ligIDs[0]), int(ligIDs[-1])],
+                "ligands": {}, "incomplete": {}}
+    missing = missingRanges(ligIDs, ligIDs[0], ligIDs[-1])
+    if dockedRanges is not None:
+        missing = intersectRanges(missing, dockedRanges)
+    coverage["ligands"]["0"] = int(np.sum(missing[:, 1] - missing[:, 0] + 1))
+    coverage["incomplete"]["0"] = missing.tolist()
+    printRanges(0, coverage["ligands"]["0"], missing, "not included")
+
+    counts, countLigs = np.unique(ligCounts, return_counts=True)
+    for count, countLig in zip(counts, countLigs):
+        coverage["ligands"][str(count)] = int(countLig)
+        # Only list the ligands not docked the number of repeats planned
+        listed = (ligCounts == count) & (ligCounts != expected)
+        if not np.any(listed):
+            continue
+        coverage["incomplete"][str(count)] = \
+            idRanges(ligIDs[listed]).tolist()
+        for status, shown in (("included", listed & included),
+                              ("deleted", listed & ~included)):
+            printRanges(count, np.count_nonzero(shown),
+                        idRanges(ligIDs[shown]), status)
+
+    # With all repeats in the table, also get the IDs missing from each repeat
+    # (only from the ranges planned for the later repeats of an adaptive VS)
+    if repCounts is None:
+        coverage["missingPerRepeat"] = {}
+        for repeat in range(1, totalRepeatNum + 1):
+            repeatIDs = np.unique(table["No"][table["Run#"] == repeat])
+            missing = missingRanges(repeatIDs, ligIDs[0], ligIDs[-1])
+            if adaptiveRanges is not None and repeat > 1:
+                missing = intersectRanges(missing, adaptiveRanges)
+            if dockedRanges is not None:
+                missing = intersectRanges(missing, dockedRanges)
+            coverage["missingPerRepeat"][str(repeat)] = missing.tolist()
 
-    for key in rangeFlag.keys():
-        if rangeFlag[key] is False:
-            print("\tid:", key, "# of successful repeats: 0 (not included)")
+    if coveragePath:
+        with open(coveragePath, "w") as f:
+            json.dump(coverage, f, indent=1)
+
+    table = table[included[rowLig]]
 
     print("\nSUMMARY:\n")
 
-    print("\tTotal ligands docked:" + str(len(ligDict.keys())))
+    for count in sorted(coverage["ligands"].keys(), key=int):
+        print("\tLigands docked in " + count + " repeat(s):" +
+              str(coverage["ligands"][count]))
+    print("\tTotal ligands docked:" + str(np.count_nonzero(included)))
+    if coveragePath:
+        print("\tCoverage written to:" + coveragePath)
     sys.stdout.flush()
-    return ligDict
+    return table
+
+
+def idRanges(ligIDs, maxGap=0):
+    """
+    Compress a sorted array of unique ligand IDs into an array of inclusive
+    [start, end] ranges of consecutive IDs. Ranges separated by at most maxGap
+    IDs are merged
+    """
 
+    ligIDs = np.asarray(ligIDs, dtype="i8")
+    if len(ligIDs) == 0:
+        return np.zeros((0, 2), dtype="i8")
 
-def sortRepeats(ligDict):
+    breaks = np.flatnonzero(np.diff(ligIDs) > maxGap + 1)
+    starts = np.concatenate([ligIDs[:1], ligIDs[breaks + 1]])
+    ends = np.concatenate([ligIDs[breaks], ligIDs[-1:]])
+
+    return np.stack([starts, ends], axis=1)
+
+
+def intersectRanges(rangesA, rangesB):
+    """
+    Return the inclusive [start, end] ranges of the IDs found in both arrays of
+    sorted and disjoint ranges
+    """
+
+    intersect = []
+    i = 0
+    j = 0
+    rangesA = np.asarray(rangesA).tolist()
+    rangesB = np.asarray(rangesB).tolist()
+    while i < len(rangesA) and j < len(rangesB):
+        start = max(rangesA[i][0], rangesB[j][0])
+        end = min(rangesA[i][1], rangesB[j][1])
+        if start <= end:
+            intersect.append([start, end])
+        # Move on from the range that ends first
+        if rangesA[i][1] < rangesB[j][1]:
+            i += 1
+        else:
+            j += 1
+
+    return np.array(intersect, dtype="i8").reshape(-1, 2)
+
+
+def missingRanges(ligIDs, firstID, lastID):
+    """
+    Return the inclusive [start, end] ranges of the IDs between firstID and
+    lastID that are not in the sorted array of unique ligIDs. Only the gaps
+    between ligIDs are looked at, so this does not depend on the size of the
+    ID range
+    """
+
+    ligIDs = np.asarray(ligIDs, dtype="i8")
+    ligIDs = ligIDs[(ligIDs >= firstID) & (ligIDs <= lastID)]
+    # Bound the IDs by the IDs just outside the range, to get the gaps at
+    # both ends of the range
+    bounded = np.concatenate([[firstID - 1], ligIDs, [lastID + 1]])
+    gaps = np.flatnonzero(np.diff(bounded) > 1)
+
+    return np.stack([bounded[gaps] + 1, bounded[gaps + 1] - 1], axis=1)
+
+
+def printRanges(count, ligNum, ranges, status, maxShown=20):
+    """
+    Print the ID ranges of the ligands docked in a given number of repeats,
+    showing at most maxShown ranges
+    """
+
+    if ligNum == 0:
+        return
+
+    rangeStrs = [str(start) if start == end else str(start) + "-" + str(end)
+                 for start, end in ranges[:maxShown].tolist()]
+    if len(ranges) > maxShown:
+        rangeStrs.append("... " + str(len(ranges) - maxShown) +
+                         " more ranges")
+
+    print("\t# of successful repeats:" + str(count) + ", " + str(ligNum) +
+          " ligands (" + status + ")")
+    print("\t\tids: " + ", ".join(rangeStrs))
+
+
+def sortRepeats(table):
     """
     For each ligandID, get the repeat that got the best score, this will
     represent that ligand in this VS scoring
     """
 
-    # For each ligID, sort each repeat based on score (lig[9])
-    # The result is a ligDict for which the first of each ligID is
-    # the one with the best score
-    keys = ligDict.keys()
-    for key in keys:
-        repeatsLigInfo = ligDict[key]
-        repeatsLigInfo = sorted(repeatsLigInfo, key=lambda lig: lig[9])
-        ligDict[key] = repeatsLigInfo
+    # Sort the rows by ligID then score, so that the first row of each ligID
+    # is the one with the best score. The sort is stable, ties go to the
+    # repeat parsed first
+    table = table[np.lexsort((table["Score"], table["No"]))]
 
-    return ligDict
+    return table[firstOfEachLigand(table)]
 
 
-def writeResultFiles(ligDict, projName, vsDir):
+def writeResultFiles(bestTable, projName, vsDir):
     """
     Write out the results of this VS
     """
-    # Write the ligand info
-    keys = ligDict.keys()
-    vsResult = []
-    for key in keys:
-        # Get only the first in the list of repeats information
-        # for this ligand
-        # for ligInfo in ligDict[key]:
-        ligInfo = ligDict[key][0]
-        vsResult.append(ligInfo)
 
-    # Sort the vsResult based on score, for the sorted full VS result
-    vsResult = sorted(vsResult, key=lambda lig: lig[9])
+    # Sort the best repeats based on score, for the sorted full VS result
+    vsResult = bestTable[np.argsort(bestTable["Score"], kind="stable")]
 
     print("\nWRITING:\n")
 
-    # Create results file
+    # Create results file, through a temporary file so that the results file
+    # is complete whenever it is read (e.g. while watching a running VS)
     print("\tresults_" + projName + ".csv")
     sys.stdout.flush()
-    fileResult = open(vsDir + "/results_" + projName + ".csv", "w")
+    resultPath = vsDir + "/results_" + projName + ".csv"
+    fileResult = open(resultPath + ".tmp", "w")
     fileResult.write("No,Nat,Nva,dEhb,dEgrid,dEin,dEsurf" +
                      ",dEel,dEhp,Score,mfScore,Name,Run#\n")
 
-    # Loop over the sorted results, and write to the result(s) file(s)
-    for ligInfo in vsResult:
-        # Write single repeat result (the best repeat)
-        writeResultLine(ligInfo, fileResult)
+    # Write the sorted results (the best repeat of each ligand)
+    writeTable(vsResult, fileResult)
 
     fileResult.close()
+    os.replace(resultPath + ".tmp", resultPath)
+
+
+def writeMergedFile(bestTable, stage2Table, projName, vsDir):
+    """
+    Write out the merged results of a multi-stage VS: the stage 2 best repeat
+    of the ligands docked in stage 2, and the stage 1 best repeat of the
+    others, sorted by score. The Run# of the stage 2 rows is the path of their
+    repeat directory (e.g. stage2/1), as used by vs_poses.py
+    """
+
+    stage1Rest = bestTable[~np.isin(bestTable["No"], stage2Table["No"])]
+    merged = concatTables([stage2Table, stage1Rest])
+    fromStage2 = np.arange(len(merged)) < len(stage2Table)
+
+    order = np.argsort(merged["Score"], kind="stable")
+    runPrefixes = np.where(fromStage2[order], "stage2/", "")
+
+    mergedName = "results_" + projName + "_merged.csv"
+    print("\t" + mergedName + " (" + str(len(stage2Table)) +
+          " ligands from stage 2)")
+    sys.stdout.flush()
+    mergedPath = vsDir + "/" + mergedName
+    with open(mergedPath + ".tmp", "w") as fileResult:
+        fileResult.write("No,Nat,Nva,dEhb,dEgrid,dEin,dEsurf" +
+                         ",dEel,dEhp,Score,mfScore,Name,Run#\n")
+        writeTable(merged[order], fileResult, runPrefixes=runPrefixes)
+    os.replace(mergedPath + ".tmp", mergedPath)
 
 
-def writeRepeatFile(repFile, repeat, ligDict):
+def topFileName(top, projName):
     """
-    Get a repeat result file and repeat number. Extract VS data corresponding
-    to that repeat from ligDict, sort the results according to score, and
-    write those to the corresponding repeat results text file.
+    Name of the file holding the results of the top best ligands
     """
-    # Store VS repeat results in a list
-    repeatResults = []
 
-    # Get the repeat results from the ligDict, looping over ligand ID
-    for ligID in ligDict.keys():
-        # For each ligID, loop over all repeats
-        for repeatLigInfo in ligDict[ligID]:
-            # If this is the repeat that matches the one we want (last item)
-            if repeat == int(repeatLigInfo[-1]):
-                # Append to the list
-                repeatResults.append(repeatLigInfo)
+    return "top" + str(top) + "_results_" + projName + ".csv"
+
 
-    # Sort the repeat VS result list, based on score
-    repeatResults = sorted(repeatResults, key=lambda lig: lig[9])
+def writeTopFile(bestTable, top, projName, vsDir):
+    """
+    Write out the results of the top best ligands of this VS, given the table
+    of the best repeat of each ligand
+    """
+
+    # Select the top best repeats, sorted by score (ties ordered as in the
+    # full results file)
+    vsResult = bestTable[np.argsort(bestTable["Score"], kind="stable")[:top]]
+
+    print("\t" + topFileName(top, projName))
+    sys.stdout.flush()
+    topPath = vsDir + "/" + topFileName(top, projName)
+    with open(topPath + ".tmp", "w") as fileResult:
+        fileResult.write("No,Nat,Nva,dEhb,dEgrid,dEin,dEsurf" +
+                         ",dEel,dEhp,Score,mfScore,Name,Run#\n")
+        writeTable(vsResult, fileResult)
+    os.replace(topPath + ".tmp", topPath)
 
-    # Write results to file
-    for repeatResultsLine in repeatResults:
-        writeResultLine(repeatResultsLine, repFile)
-    repFile.close()
+
+def writeRepeatFiles(table, totalRepeatNum, projName, vsDir):
+    """
+    Write the results of each repeat to its own repeat results file. The table
+    is partitioned by repeat in a single pass, then each partition is sorted
+    according to score and written to the corresponding repeat results file.
+    """
+
+    # Partition the rows by repeat number: a stable sort on the integer Run#
+    # column keeps the rows of each repeat in the order they were parsed
+    table = table[np.argsort(table["Run#"], kind="stable")]
+    repeats = np.arange(1, totalRepeatNum + 1)
+    starts = np.searchsorted(table["Run#"], repeats, side="left")
+    ends = np.searchsorted(table["Run#"], repeats, side="right")
+
+    for repeat, start, end in zip(repeats, starts, ends):
+        # Initialise a results text file
+        repFileName = "repeat{}_results_{}.csv".format(repeat, projName)
+        print("\t" + repFileName)
+        sys.stdout.flush()
+
+        # Sort the rows of that repeat based on score, and write them
+        repeatResults = table[start:end]
+        repeatResults = repeatResults[np.argsort(repeatResults["Score"],
+                                                 kind="stable")]
+        with open(vsDir + "/" + repFileName, "w",
+                  buffering=1024 * 1024) as repFile:
+            repFile.write("No,Nat,Nva,dEhb,dEgrid,dEin,dEsurf" +
+                          ",dEel,dEhp,Score,mfScore,Name,Run#\n")
+            writeTable(repeatResults, repFile)
 
 
-def writeResultLine(ligInfo, fileResult):
+def writeTable(table, fileResult, chunkSize=100000, runPrefixes=None):
     """
-    Write single results line to file
+    Write the rows of a results table to file, converting the table to text
+    by chunks of rows. runPrefixes optionally gives a string prepended to the
+    Run# of each row
     """
-    ligInfoStr = []
-    for val in ligInfo:
-        ligInfoStr.append(str(val))
 
-    fileResult.write(",".join(ligInfoStr))
-    fileResult.write("\n")
+    for start in range(0, len(table), chunkSize):
+        chunk = table[start:start + chunkSize]
+        # Convert each column to a list of python values, for str() to give
+        # the shortest representation of the floats
+        columns = [chunk[col].tolist() for col, typ in TABLE_COLUMNS]
+        columns[-2] = [name.decode(errors="replace") for name in columns[-2]]
+        if runPrefixes is not None:
+            columns[-1] = [prefix + str(run) for prefix, run in
+                           zip(runPrefixes[start:start + chunkSize].tolist(),
+                               columns[-1])]
+
+        fileResult.write("".join(",".join(map(str, row)) + "\n"
+                                 for row in zip(*columns)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Resumes the slices of a VS that were interrupted (e.g. by the walltime) before
+# docking all their ligands. The .ou file of each interrupted slice is scanned
+# for the last ligand ICM completed: that part of the slice is kept in its own
+# .part.ou file, and a continuation job docking only the remaining ligands is
+# written (and optionally submitted), so that no docking is repeated. The
+# continuation scripts (_resume<ID>.slurm/.sge) are only submitted by
+# vs_submit.py -resume, and are added to the manifest of the VS.
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import argparse
+import glob
+import re
+import sys
+import time
+
+import manifest
+import ouscan
+import vs_build
+import vs_submit
+
+
+def main():
+    """
+    Run script
+    """
+
+    vsDir, queue, walltime, idle, submit = parseArgs()
+
+    icmHome = vs_build.getPath()
+
+    reportLines = []
+    queuePaths = []
+
+    for repeatDir in getRepeatDirs(vsDir):
+        print("\nREPEAT:" + repeatDir + "\n")
+        repeat = os.path.basename(os.path.normpath(repeatDir))
+        slices = readSlices(repeatDir)
+        connection = manifest.openManifest(
+            os.path.dirname(os.path.normpath(repeatDir)))
+
+        for projName, lowerLimit, upperLimit, thor, sliceWalltime in slices:
+            if walltime is None and sliceWalltime is None:
+                print("The walltime of the slice ending at " +
+                      str(upperLimit) + " is unknown, use --walltime")
+                sys.exit()
+
+            resumeLimit = resumeSlice(repeatDir, projName, lowerLimit,
+                                      upperLimit, idle)
+            if resumeLimit is None:
+                continue
+
+            sliceName = projName + "_rep" + repeat + "_sl" + \
+                str(upperLimit) + "_resume" + str(resumeLimit)
+            reportLines = writeResumeSlice(queue, walltime or sliceWalltime,
+                                           sliceName, projName, thor,
+                                           resumeLimit, upperLimit, repeatDir,
+                                           reportLines, icmHome)
+            queuePaths.append(os.path.join(repeatDir, sliceName + "." + queue))
+            if connection is not None:
+                row = manifest.sliceRow(int(repeat), 1,
+                                        [(resumeLimit, upperLimit)],
+                                        repeat + "/" + sliceName + "." + queue,
+                                        queue)
+                manifest.resumeSlices(connection, int(repeat), resumeLimit,
+                                      upperLimit, [row])
+
+        if connection is not None:
+            connection.close()
+
+    print("\n" + str(len(queuePaths)) + " continuation jobs written")
+    for line in reportLines:
+        print(line)
+
+    if submit and queuePaths:
+        vs_submit.confirmSubmit(queuePaths)
+        vs_submit.submitQueueScripts(queuePaths, os.getcwd(), queue,
+                                     vsDir=vsDir)
+
+    print("")
+
+
+def parseArgs():
+    """
+    Define arguments, parse and return them
+    """
+
+    descr = "Write continuation jobs docking the ligands left undocked by the" \
+        " interrupted slices of a VS"
+    descr_vsDir = "VS directory to be resumed"
+    descr_queue = "Queuing system of the continuation jobs (sge/slurm)"
+    descr_walltime = "Walltime of the continuation jobs (format: 1-24:00:00)." \
+        " Default is the walltime of the interrupted slice"
+    descr_idle = "Only resume the slices whose .ou file was not modified in" \
+        " that many minutes, so that running slices are left alone. Default" \
+        " is 10"
+    descr_submit = "Submit the continuation jobs once written"
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("vsDir", help=descr_vsDir)
+    parser.add_argument("queue", help=descr_queue)
+    parser.add_argument("--walltime", help=descr_walltime)
+    parser.add_argument("--idle", type=float, default=10., help=descr_idle)
+    parser.add_argument("-submit", action="store_true", help=descr_submit)
+
+    args = parser.parse_args()
+
+    if args.queue not in ("sge", "slurm"):
+        print("Only 'sge' and 'slurm' are accepted queuing system options")
+        sys.exit()
+
+    return args.vsDir, args.queue, args.walltime, args.idle, args.submit
+
+
+def getRepeatDirs(vsDir):
+    """
+    List the repeat directories of the VS, and of its second stage if any
+    """
+
+    repeatDirs = []
+    for baseDir in (vsDir, os.path.join(vsDir, "stage2")):
+        if not os.path.isdir(baseDir):
+            continue
+        for subDir in sorted(os.listdir(baseDir), key=lambda d: d.zfill(9)):
+            if subDir.isdigit():
+                repeatDirs.append(os.path.join(os.path.abspath(baseDir),
+                                               subDir) + "/")
+
+    return repeatDirs
+
+
+def readSlices(repeatDir):
+    """
+    Read the ID ranges docked in a repeat directory from the ICM commands of
+    the slice scripts written by vs_build.py (and from the slice table of a
+    job array), with the project name, thoroughness and walltime of their
+    job. A range resumed before is given from its latest continuation job.
+    Returns a list of (project, from, to, thoroughness, walltime), sorted by to
+    """
+
+    commandPattern = re.compile(r"_dockScan\s+(\S+)\s+thorough=(\S+)\s+" +
+                                r"from=(\d+)\s+to=(\d+)")
+    arrayPattern = re.compile(r"_dockScan\s+(\S+)\s+thorough=(\S+)")
+    walltimePattern = re.compile(r"(?:--time=|h_rt=)(\S+)")
+
+    slices = {}
+    scriptPaths = glob.glob(repeatDir + "*.slurm") + \
+        glob.glob(repeatDir + "*.sge") + glob.glob(repeatDir + "*.sh")
+    arrayCommand = None
+    arrayWalltime = None
+
+    for scriptPath in scriptPaths:
+        with open(scriptPath) as f:
+            script = f.read()
+        walltimeMatch = walltimePattern.search(script)
+        walltime = walltimeMatch.group(1) if walltimeMatch else None
+
+        # The array scripts take their ranges from the slice table
+        if os.path.basename(scriptPath).startswith("array_"):
+            arrayMatch = arrayPattern.search(script)
+            if arrayMatch:
+                arrayCommand = arrayMatch.groups()
+            arrayWalltime = walltime
+            continue
+
+        for projName, thor, lowerLimit, upperLimit in \
+                commandPattern.findall(script):
+            lowerLimit = int(lowerLimit)
+            upperLimit = int(upperLimit)
+            if upperLimit not in slices or \
+                    slices[upperLimit][1] < lowerLimit:
+                slices[upperLimit] = (projName, lowerLimit, upperLimit, thor,
+                                      walltime)
+
+    tablePath = repeatDir + "slices.tsv"
+    if arrayCommand is not None and os.path.exists(tablePath):
+        with open(tablePath) as f:
+            for line in f:
+                ll = line.split()
+                if len(ll) != 3:
+                    continue
+                lowerLimit = int(ll[1])
+                upperLimit = int(ll[2])
+                if upperLimit not in slices:
+                    slices[upperLimit] = (arrayCommand[0], lowerLimit,
+                                          upperLimit, arrayCommand[1],
+                                          arrayWalltime)
+
+    return [slices[upperLimit] for upperLimit in sorted(slices.keys())]
+
+
+def resumeSlice(repeatDir, projName, lowerLimit, upperLimit, idle):
+    """
+    Check the .ou file of a slice, and prepare its continuation if it was
+    interrupted: the ligands completed are kept in a .part.ou file named after
+    the last of them (the incomplete line ICM was writing is dropped, and
+    the suffix tells the FINISHED checks that the slice is resumed), so that
+    the continuation writes the remaining ligands to the .ou file of the
+    slice. Returns the first ligand ID of the continuation, or None when the
+    slice is finished, not started, or still running
+    """
+
+    ouPath = os.path.join(repeatDir, projName + "_" + str(upperLimit) + ".ou")
+    if not os.path.exists(ouPath):
+        return None
+    if time.time() - os.path.getmtime(ouPath) < idle * 60:
+        print("\tRUNNING: " + os.path.basename(ouPath))
+        return None
+
+    with ouscan.mapOuFile(ouPath) as data:
+        if data.find(b"FINISHED") != -1:
+            return None
+        end = ouscan.completeEnd(data)
+        lastID = ouscan.lastLigandID(data, end)
+
+    if lastID is None or lastID < lowerLimit:
+        print("\tINTERRUPTED: " + os.path.basename(ouPath) +
+              ", no ligand completed")
+        return lowerLimit
+
+    if lastID >= upperLimit:
+        return None
+
+    donePath = os.path.join(repeatDir, projName + "_" + str(lastID) +
+                            ouscan.PART_SUFFIX)
+    if os.path.exists(donePath):
+        print("\tSKIPPED: " + os.path.basename(ouPath) + ", " +
+              os.path.basename(donePath) + " already exists")
+        return None
+
+    # Keep the completed part of the slice under its own name
+    os.truncate(ouPath, end)
+    os.rename(ouPath, donePath)
+    print("\tINTERRUPTED: " + os.path.basename(ouPath) + ", completed up to " +
+          str(lastID) + " (kept in " + os.path.basename(donePath) + ")")
+
+    return lastID + 1
+
+
+def writeResumeSlice(queue, walltime, sliceName, projName, thor, lowerLimit,
+                     upperLimit, repeatDir, reportLines, icmHome):
+    """
+    Write the continuation job of a slice, docking lowerLimit to upperLimit
+    """
+
+    if queue == "sge":
+        return vs_build.sgeSlice(walltime, sliceName, projName, thor,
+                                 [(lowerLimit, upperLimit)], repeatDir,
+                                 reportLines, icmHome)
+
+    return vs_build.slurmSlice(walltime, sliceName, projName, thor,
+                               [(lowerLimit, upperLimit)], repeatDir,
+                               reportLines, icmHome)
+
+
+if __name__ == "__main__":
+    main()
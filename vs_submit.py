@@ -2,18 +2,38 @@
 
 # Execute within a VS directory, will crawl through
 # all its subdirs and submit all .slurm or .sge
-# files found there, while pausing for 1 second
-# between each submission
+# files found there. Submissions are issued by a
+# pool of subprocesses, at a limited rate, retrying
+# the transient errors of the scheduler, and the
+# job IDs are recorded in the VS directory (and in
+# its manifest, with the state of the jobs). With
+# --maxQueued, runs as a daemon keeping the number
+# of queued jobs of the VS under that ceiling. With
+# -supervise, the failed slices are resubmitted. With
+# -aggregate, a last job depending on all the others
+# extracts the results of the VS on a compute node
 #
 # https://github.com/thomas-coudrat/toolbx_vs
 # Thomas Coudrat <thomas.coudrat@gmail.com>
 
 import os
+import glob
+import math
 import time
 import argparse
 import sys
 import socket
 import json
+import random
+import re
+import shlex
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import manifest
+import ouscan
+import vs_build
 
 def main():
     """
@@ -21,19 +41,75 @@ def main():
     """
 
     # Return the queuing system chosen
-    vsDir, queue = parsing()
+    vsDir, queue, throttle, maxArray, pool, rate, retries, maxQueued, poll, \
+        queueCommand, refresh, supervise, maxResubmits, memFactor, \
+        timeFactor, aggregate, dependency, resultsArgs, aggregateCores, \
+        aggregateWalltime, resume = parsing()
+
+    # Only update the manifest with the state of the jobs submitted
+    if refresh:
+        refreshManifest(vsDir, queue, queueCommand=queueCommand)
+        print("")
+        return
+
+    if supervise and manifest.openManifest(vsDir) is None:
+        print("The supervised mode needs the manifest of the VS, build it" +
+              " again with vs_build.py to create it")
+        sys.exit()
 
     # Get the current working directory
     cwd = os.getcwd()
 
     # Store all queueing scripts to be submitted in this directory
-    queuePaths = getQueueScripts(vsDir, queue)
+    queuePaths = getQueueScripts(vsDir, queue, resume)
+
+    # Job arrays are submitted in chunks that fit the maximum array size
+    if queue == "slurm-array":
+        arrayJobs = getArrayJobs(queuePaths, maxArray)
+        confirmSubmit(arrayJobs, sum(size for path, offset, size
+                                     in arrayJobs))
+        submissions = arraySubmissions(arrayJobs, cwd, throttle)
+        weights = [size for path, offset, size in arrayJobs]
+    else:
+        # Ask for confirmation to submit run
+        confirmSubmit(queuePaths)
+        submissions = scriptSubmissions(queuePaths, cwd, queue)
+        weights = [scriptJobNum(queuePath) for queuePath in queuePaths]
+
+    # Submit all those scripts (using the proper queueing system), all at
+    # once or as the queue drains. The supervised mode can be stopped and
+    # started again: the scripts submitted since the VS was built are skipped
+    if maxQueued is None:
+        if supervise:
+            submitted = submittedJobIDs(vsDir, submissions)
+            submissions = [submission for submission in submissions
+                           if os.path.relpath(submission[0], vsDir)
+                           not in submitted]
+        results = submitJobs(submissions, pool, rate, retries, vsDir)
+        jobIDs = [jobID for label, jobID in results if jobID is not None]
+        if not jobIDs:
+            jobIDs = None
+    else:
+        jobIDs = daemonSubmit(vsDir, queue, submissions, weights, maxQueued,
+                              poll, queueCommand, pool, rate, retries)
+        # The jobs of the previous runs of the daemon that already left the
+        # queue (and may be purged by the scheduler) are not waited for
+        if jobIDs is not None:
+            jobIDs = stillQueued(queue, jobIDs, queueCommand)
 
-    # Ask for confirmation to submit run
-    confirmSubmit(queuePaths)
+    # Resubmit the failed slices until all the slices ended, the aggregation
+    # then has no job to wait for
+    if supervise:
+        ended = superviseSlices(vsDir, queue, maxResubmits, memFactor,
+                                timeFactor, maxArray, poll, queueCommand,
+                                pool, rate, retries)
+        jobIDs = [] if ended else None
 
-    # Submit all those scripts (using the proper queueing system)
-    submitQueueScripts(queuePaths, cwd, queue)
+    # Extract the results once all the jobs ended (not when the daemon or
+    # the supervision was stopped before)
+    if aggregate and jobIDs is not None:
+        submitAggregate(vsDir, queue, jobIDs, dependency, resultsArgs,
+                        aggregateCores, aggregateWalltime, retries)
 
     print("")
 
@@ -46,31 +122,165 @@ def parsing():
     # Define and collect arguments
     descr = "Submits a VS using either -slurm or -sge queuing system"
     descr_vsDir = "VS directory to be submitted to the queue"
-    descr_queue = "Queuing system to be used (sge/slurm)"
+    descr_queue = "Queuing system to be used (sge/slurm/slurm-array/" \
+        "slurm-pull/slurm-node)"
+    descr_throttle = "With slurm-array, maximum number of tasks of each" \
+        " array job running at the same time"
+    descr_maxArray = "With slurm-array, maximum number of tasks per array" \
+        " job (the MaxArraySize of the cluster). Default is 1000"
+    descr_pool = "Number of submissions running at the same time. Default" \
+        " is 4"
+    descr_rate = "Maximum number of submissions per second. Default is 5"
+    descr_retries = "Number of times a submission failing with a transient" \
+        " error of the scheduler is retried, waiting longer each time." \
+        " Default is 5"
+    descr_maxQueued = "Daemon mode: keep at most this number of jobs (or" \
+        " array tasks) of the VS pending or running, submitting the next" \
+        " scripts as the earlier ones finish. The scripts whose slices got a" \
+        " job ID in the manifest since they were built are not submitted" \
+        " again, so that the daemon can be stopped and started again"
+    descr_poll = "Daemon mode: seconds between two checks of the queue." \
+        " Default is 120"
+    descr_queueCommand = "Daemon mode: command listing the queued jobs, one" \
+        " per line starting with the job ID. Default is squeue (or qstat)" \
+        " for the jobs of the user"
+    descr_refresh = "Do not submit, update the state and exit code of the" \
+        " jobs submitted in the manifest of the VS, from the accounting of" \
+        " the scheduler (sacct)"
+    descr_supervise = "Supervised mode: once submitted, check the slices" \
+        " as their job ends, and resubmit the failed ones (job failed, ICM" \
+        " exit code, .ou file without FINISHED, error in the job output)." \
+        " Runs until all the slices ended (sge, slurm and slurm-array)"
+    descr_maxResubmits = "Supervised mode: number of times a slice is" \
+        " resubmitted before it is reported as exhausted. Default is 3"
+    descr_memFactor = "Supervised mode: multiply the memory of a slice by" \
+        " this factor at each resubmission. Default is 1"
+    descr_timeFactor = "Supervised mode: multiply the walltime of a slice by" \
+        " this factor at each resubmission. Default is 1"
+    descr_resume = "Only submit the continuation jobs written by" \
+        " vs_resume.py (_resume<ID>.slurm or .sge), which are otherwise" \
+        " skipped"
+    descr_aggregate = "Once the scripts are submitted, submit a last job" \
+        " running vs_results.py on the VS, that only starts when all the" \
+        " other jobs ended (with -supervise, it is submitted once the" \
+        " supervision ended)"
+    descr_dependency = "With -aggregate, start the aggregation job once all" \
+        " the jobs ended (afterany), or only if they all succeeded (afterok," \
+        " SLURM only). Default is afterany"
+    descr_resultsArgs = "With -aggregate, options given to vs_results.py" \
+        " (e.g. \"--top 1000 -coverage\")"
+    descr_aggregateCores = "With -aggregate, number of cores of the" \
+        " aggregation job, used by vs_results.py --jobs. Default is 1"
+    descr_aggregateWalltime = "With -aggregate, walltime of the aggregation" \
+        " job (format: 1-24:00:00). Default is 0-04:00:00"
 
     parser = argparse.ArgumentParser(description=descr)
     parser.add_argument("vsDir", help=descr_vsDir)
     parser.add_argument("queue", help=descr_queue)
+    parser.add_argument("--throttle", type=int, help=descr_throttle)
+    parser.add_argument("--maxArray", type=int, default=1000,
+                        help=descr_maxArray)
+    parser.add_argument("--pool", type=int, default=4, help=descr_pool)
+    parser.add_argument("--rate", type=float, default=5., help=descr_rate)
+    parser.add_argument("--retries", type=int, default=5,
+                        help=descr_retries)
+    parser.add_argument("--maxQueued", type=int, help=descr_maxQueued)
+    parser.add_argument("--poll", type=float, default=120.,
+                        help=descr_poll)
+    parser.add_argument("--queueCommand", help=descr_queueCommand)
+    parser.add_argument("-refresh", action="store_true", help=descr_refresh)
+    parser.add_argument("-supervise", action="store_true",
+                        help=descr_supervise)
+    parser.add_argument("--maxResubmits", type=int, default=3,
+                        help=descr_maxResubmits)
+    parser.add_argument("--memFactor", type=float, default=1.,
+                        help=descr_memFactor)
+    parser.add_argument("--timeFactor", type=float, default=1.,
+                        help=descr_timeFactor)
+    parser.add_argument("-resume", action="store_true", help=descr_resume)
+    parser.add_argument("-aggregate", action="store_true",
+                        help=descr_aggregate)
+    parser.add_argument("--dependency", default="afterany",
+                        choices=("afterany", "afterok"),
+                        help=descr_dependency)
+    parser.add_argument("--resultsArgs", default="", help=descr_resultsArgs)
+    parser.add_argument("--aggregateCores", type=int, default=1,
+                        help=descr_aggregateCores)
+    parser.add_argument("--aggregateWalltime", default="0-04:00:00",
+                        help=descr_aggregateWalltime)
 
     args = parser.parse_args()
 
     vsDir = args.vsDir
     queue = args.queue
+    throttle = args.throttle
+    maxArray = max(1, args.maxArray)
+    pool = max(1, args.pool)
+    rate = args.rate
+    retries = max(0, args.retries)
+    maxQueued = args.maxQueued
+    poll = max(1., args.poll)
+    queueCommand = args.queueCommand
+    refresh = args.refresh
+    supervise = args.supervise
+    maxResubmits = max(0, args.maxResubmits)
+    memFactor = args.memFactor
+    timeFactor = args.timeFactor
+    aggregate = args.aggregate
+    dependency = args.dependency
+    resultsArgs = args.resultsArgs
+    aggregateCores = max(1, args.aggregateCores)
+    aggregateWalltime = args.aggregateWalltime
+    resume = args.resume
+
+    if queue not in ("sge", "slurm", "slurm-array", "slurm-pull",
+                     "slurm-node"):
+        print("Only 'sge', 'slurm', 'slurm-array', 'slurm-pull' and" +
+              " 'slurm-node' are accepted queuing system options")
+        sys.exit()
+
+    if rate <= 0:
+        print("--rate has to be a positive number of submissions per second")
+        sys.exit()
+
+    if maxQueued is not None and maxQueued < 1:
+        print("--maxQueued has to be at least 1")
+        sys.exit()
+
+    if supervise and queue not in ("sge", "slurm", "slurm-array"):
+        print("The supervised mode is only available with 'sge', 'slurm'" +
+              " and 'slurm-array'")
+        sys.exit()
+
+    if memFactor < 1 or timeFactor < 1:
+        print("--memFactor and --timeFactor have to be at least 1")
+        sys.exit()
+
+    if resume and queue not in ("sge", "slurm"):
+        print("The continuation jobs are only written for 'sge' and 'slurm'")
+        sys.exit()
 
-    if queue not in ("sge", "slurm"):
-        print("Only 'sge' and 'slurm' are accepted queuing system options")
+    # The SGE hold only waits for the jobs to end
+    if aggregate and queue == "sge" and dependency == "afterok":
+        print("--dependency afterok is only available with SLURM")
         sys.exit()
 
-    return vsDir, queue
+    return vsDir, queue, throttle, maxArray, pool, rate, retries, maxQueued, \
+        poll, queueCommand, refresh, supervise, maxResubmits, memFactor, \
+        timeFactor, aggregate, dependency, resultsArgs, aggregateCores, \
+        aggregateWalltime, resume
 
 
-def confirmSubmit(queuePaths):
+def confirmSubmit(queuePaths, sliceNum=None):
     """
     Ask for user input confirmation to submit the jobs, listing information
-    on what is about to be submitted
+    on what is about to be submitted (and the number of slices they run, for
+    job arrays)
     """
 
     print("\nYou are about to submit " + str(len(queuePaths)) + " jobs.")
+    if sliceNum is not None:
+        print("These job arrays run " + str(sliceNum) + " slices.")
 
     answer = input("Do you want to proceed? (yes/no) ")
     print (answer)
@@ -82,9 +292,15 @@ def confirmSubmit(queuePaths):
         sys.exit()
 
 
-def getQueueScripts(vsDir, queue):
+# Continuation jobs written by vs_resume.py
+RESUME_SCRIPT = re.compile(r"_sl\d+_resume\d+\.(slurm|sge)$")
+
+
+def getQueueScripts(vsDir, queue, resume=False):
     """
-    Make a list of the scripts to be submited
+    Make a list of the scripts to be submited: with resume, only the
+    continuation jobs written by vs_resume.py, otherwise all the other
+    scripts (the continuations are never submitted with the slices)
     """
 
     queuePaths = []
@@ -97,40 +313,919 @@ def getQueueScripts(vsDir, queue):
             # For each of these, save every file that ends with .slurm or
             # .sge in a list, by saving its full path
             for file in files:
-                if file.endswith("." + queue):
+                if queue == "slurm-array":
+                    if file.startswith("array_") and file.endswith(".slurm"):
+                        queuePaths.append(os.path.join(path, file))
+                elif queue == "slurm-pull":
+                    if file.endswith("_workers.slurm"):
+                        queuePaths.append(os.path.join(path, file))
+                elif queue == "slurm-node":
+                    if file.endswith("_nodes.slurm"):
+                        queuePaths.append(os.path.join(path, file))
+                elif file.endswith("." + queue) and \
+                        bool(RESUME_SCRIPT.search(file)) == resume:
                     queuePaths.append(os.path.join(path, file))
 
     return queuePaths
 
 
-def submitQueueScripts(queuePaths, cwd, queue):
+def getArrayJobs(queuePaths, maxArray):
     """
-    Submit all the queueing scripts
+    Split the job array of each repeat into chunks of at most maxArray tasks.
+    Returns the (array script path, slice offset, number of tasks) of each
+    chunk
     """
 
-    # Loop over the saved .slurm or .sge paths
+    arrayJobs = []
     for queuePath in queuePaths:
+        # The slice table written by vs_build.py holds one line per ID range,
+        # starting with the slice index, in increasing order
+        tablePath = os.path.join(os.path.dirname(queuePath), "slices.tsv")
+        sliceNum = 0
+        with open(tablePath) as f:
+            for line in f:
+                if line.strip():
+                    sliceNum = int(line.split()[0])
+
+        for offset in range(0, sliceNum, maxArray):
+            arrayJobs.append((queuePath, offset,
+                              min(maxArray, sliceNum - offset)))
+
+    return arrayJobs
+
+
+def submitArrayJobs(arrayJobs, cwd, throttle, pool=4, rate=5., retries=5,
+                    vsDir=None):
+    """
+    Submit the job array chunks, passing their slice offset to the array
+    script, and the number of tasks allowed to run at once. Returns the
+    results of the submissions (see submitJobs)
+    """
+
+    return submitJobs(arraySubmissions(arrayJobs, cwd, throttle), pool,
+                      rate, retries, vsDir)
+
 
+def arraySubmissions(arrayJobs, cwd, throttle):
+    """
+    Submission commands of the job array chunks, as (label, directory,
+    command) tuples
+    """
+
+    submissions = []
+    for queuePath, offset, size in arrayJobs:
+        arrayRange = "1-" + str(size)
+        if throttle:
+            arrayRange += "%" + str(throttle)
+        command = ["sbatch", "--parsable", "--array=" + arrayRange,
+                   "--export=ALL,SLICE_OFFSET=" + str(offset),
+                   os.path.basename(queuePath)]
+        submissions.append((queuePath + ":" + str(offset),
+                            os.path.dirname(os.path.join(cwd, queuePath)),
+                            command))
+
+    return submissions
+
+
+def submitQueueScripts(queuePaths, cwd, queue, pool=4, rate=5., retries=5,
+                       vsDir=None):
+    """
+    Submit all the queueing scripts, from their repeat directory, using
+    either SLURM or SGE. Returns the results of the submissions (see
+    submitJobs)
+    """
+
+    return submitJobs(scriptSubmissions(queuePaths, cwd, queue), pool, rate,
+                      retries, vsDir)
+
+
+def scriptSubmissions(queuePaths, cwd, queue):
+    """
+    Submission commands of the queueing scripts, as (label, directory,
+    command) tuples
+    """
+
+    if queue == "sge":
+        submitCommand = ["qsub", "-terse"]
+    else:
+        submitCommand = ["sbatch", "--parsable"]
+
+    submissions = []
+    for queuePath in queuePaths:
         # Get the full path relative to the root
         queueFullPath = os.path.join(cwd, queuePath)
+        submissions.append((queuePath, os.path.dirname(queueFullPath),
+                            submitCommand + [os.path.basename(queuePath)]))
+
+    return submissions
+
+
+def scriptJobNum(queuePath):
+    """
+    Number of jobs a script puts in the queue: the size of its job array
+    (the worker and node scripts), or 1
+    """
+
+    with open(queuePath) as f:
+        match = re.search(r"--array=1-(\d+)", f.read())
+    if match is None:
+        return 1
+
+    return int(match.group(1))
+
+
+class tokenBucket:
+    """
+    Limits the rate of the submissions: a submission takes a token, and
+    tokens are added at rate per second, up to burst tokens
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Wait for a token and take it
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def submitJobs(submissions, pool=4, rate=5., retries=5, vsDir=None):
+    """
+    Run the submission commands, given as (label, directory, command)
+    tuples, in a pool of threads each waiting on a subprocess, at no more
+    than rate submissions per second. Returns the (label, job ID) of each
+    submission in the order given, the job ID being None when the
+    submission failed. With vsDir, each job ID is written to its jobs.tsv
+    file as soon as the job is submitted, and to its manifest if any
+    """
+
+    bucket = tokenBucket(rate, max(1., min(rate, pool)))
+    printLock = threading.Lock()
+    jobIDs = {}
+    connection = None
+    if vsDir is not None:
+        connection = manifest.openManifest(vsDir)
+
+    with ThreadPoolExecutor(max_workers=pool) as executor:
+        futures = {executor.submit(submitJob, command, directory, bucket,
+                                   retries): (label, command)
+                   for label, directory, command in submissions}
+        for future in as_completed(futures):
+            label, command = futures[future]
+            jobID, message, attempts = future.result()
+            jobIDs[label] = jobID
+            with printLock:
+                if jobID is None:
+                    print("\tFAILED: " + label + "\t" + message)
+                else:
+                    print("\tSUBMITTED: " + label + "\t" + jobID)
+                    if vsDir is not None:
+                        writeJobIDs(vsDir, [(label, jobID)])
+                sys.stdout.flush()
+            if connection is not None:
+                manifest.recordSubmission(connection,
+                                          os.path.relpath(label, vsDir),
+                                          jobID, attempts - 1,
+                                          arraySize(command))
+
+    if connection is not None:
+        connection.close()
+
+    failed = sum(1 for jobID in jobIDs.values() if jobID is None)
+    print("\n" + str(len(jobIDs) - failed) + " jobs submitted, " +
+          str(failed) + " failed")
+    if vsDir is not None:
+        print("Job IDs written to: " + os.path.join(vsDir, "jobs.tsv"))
+
+    return [(label, jobIDs[label]) for label, directory, command
+            in submissions]
+
+
+# Errors of the scheduler that are worth retrying (busy or unreachable
+# controller), rather than errors of the job script itself
+TRANSIENT_ERRORS = re.compile(r"timed out|temporarily|try again|" +
+                              r"unable to contact|connection refused|" +
+                              r"socket|busy|communication", re.IGNORECASE)
+
+
+def submitJob(command, directory, bucket, retries=5):
+    """
+    Run a submission command in the directory, once a token of the bucket is
+    taken. Transient errors are retried after waiting 2, 4, 8... seconds (at
+    most 60, with some jitter so that the retries are spread). Returns the
+    job ID printed by the scheduler, the error message and the number of
+    attempts (None, message, attempts when the submission failed)
+    """
+
+    message = ""
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(min(60., 2. ** attempt) * random.uniform(0.5, 1.))
+        bucket.take()
+
+        try:
+            process = subprocess.run(command, cwd=directory,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     universal_newlines=True)
+        except OSError as e:
+            return None, str(e), attempt + 1
+
+        if process.returncode == 0:
+            jobID = parseJobID(process.stdout)
+            if jobID is not None:
+                return jobID, "", attempt + 1
+            # The job was most likely queued: submitting it again could
+            # queue it twice
+            return None, "no job ID in: " + process.stdout.strip(), \
+                attempt + 1
+
+        message = " ".join(process.stderr.split()) or \
+            "exit status " + str(process.returncode)
+        if not TRANSIENT_ERRORS.search(message):
+            return None, message, attempt + 1
+
+    return None, message, retries + 1
+
+
+def parseJobID(output):
+    """
+    Get the job ID from the output of sbatch --parsable ("jobID" or
+    "jobID;cluster") or qsub -terse ("jobID", or "jobID.1-10:1" for arrays).
+    Only the last line is read, as banners or warnings may come before it
+    """
+
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    if not lines:
+        return None
+
+    match = re.match(r"^(\d+)([;.]|$)", lines[-1])
+    if match is None:
+        return None
+
+    return match.group(1)
+
+
+def arraySize(command):
+    """
+    Number of tasks of the job array chunk submitted by a command, or None
+    when it is not an array chunk
+    """
+
+    for arg in command:
+        match = re.match(r"--array=1-(\d+)", arg)
+        if match is not None:
+            return int(match.group(1))
+
+    return None
+
+
+def daemonSubmit(vsDir, queue, submissions, weights, maxQueued, poll,
+                 queueCommand=None, pool=4, rate=5., retries=5):
+    """
+    Submit the scripts as the queue drains: every poll seconds, the jobs of
+    the VS still queued (pending or running) are counted, and the next
+    scripts are submitted as long as their jobs fit under maxQueued. The
+    progress is kept in the manifest of the VS (see submittedJobIDs), so
+    that the scripts submitted by a previous run are skipped, and their jobs
+    counted. The
+    state of the jobs that left the queue is updated in the manifest.
+    Returns the job IDs of all the scripts once they are submitted, or None
+    when the daemon was stopped before
+    """
+
+    submitted = submittedJobIDs(vsDir, submissions)
+    jobIDs = set(submitted.values())
+    pending = [(submission, weight)
+               for submission, weight in zip(submissions, weights)
+               if os.path.relpath(submission[0], vsDir) not in submitted]
+
+    print("\nDAEMON: " + str(len(submissions) - len(pending)) +
+          " scripts submitted before, " + str(len(pending)) +
+          " to submit, at most " + str(maxQueued) + " jobs queued\n")
+
+    try:
+        while pending:
+            queued = queuedJobs(queue, jobIDs, queueCommand)
+            if queued is None:
+                print("\tThe queue could not be read, trying again in " +
+                      str(int(poll)) + " seconds")
+                time.sleep(poll)
+                continue
+            refreshManifest(vsDir, queue, quiet=True,
+                            queueCommand=queueCommand)
+
+            # Take the next scripts whose jobs fit in the room left (a script
+            # larger than the ceiling is submitted once the queue is empty)
+            room = maxQueued - queued
+            batch = []
+            while pending and (pending[0][1] <= room or
+                               (queued == 0 and not batch)):
+                submission, weight = pending.pop(0)
+                batch.append(submission)
+                room -= weight
+
+            print(time.strftime("%Y-%m-%d_%H:%M:%S") + " queued:" +
+                  str(queued) + ", submitting:" + str(len(batch)) +
+                  ", left:" + str(len(pending)))
+            sys.stdout.flush()
+
+            if batch:
+                results = submitJobs(batch, pool, rate, retries, vsDir)
+                jobIDs.update(jobID for label, jobID in results
+                              if jobID is not None)
+
+            if pending:
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        print("\nDaemon stopped, run the same command to resume the" +
+              " submission")
+        return None
+
+    print("\nDAEMON: all scripts submitted")
+
+    return sorted(jobIDs)
+
+
+def queuedJobs(queue, jobIDs, queueCommand=None):
+    """
+    Count the queued jobs (and array tasks) among jobIDs, listed by the
+    queueCommand, or by squeue (qstat for SGE) for the jobs of the user.
+    Returns None when the command fails
+    """
+
+    lines = listQueue(queue, queueCommand)
+    if lines is None:
+        return None
+
+    queued = 0
+    for line in lines:
+        ll = line.split()
+        if not ll:
+            continue
+        match = re.match(r"\d+", ll[0])
+        if match is None or match.group(0) not in jobIDs:
+            continue
+        # The pending tasks of an SGE array are listed on one line, with
+        # their range (e.g. 1-100:1) in the last column
+        taskRange = re.match(r"(\d+)-(\d+):(\d+)$", ll[-1])
+        if queue == "sge" and taskRange:
+            first, last, step = [int(g) for g in taskRange.groups()]
+            queued += (last - first) // step + 1
+        else:
+            queued += 1
+
+    return queued
+
+
+def stillQueued(queue, jobIDs, queueCommand=None):
+    """
+    Keep the jobIDs still listed in the queue (all of them when the queue
+    cannot be read)
+    """
+
+    lines = listQueue(queue, queueCommand)
+    if lines is None:
+        return list(jobIDs)
+
+    queued = set()
+    for line in lines:
+        match = re.match(r"\s*(\d+)", line)
+        if match is not None:
+            queued.add(match.group(1))
+
+    return [jobID for jobID in jobIDs if jobID in queued]
+
+
+def listQueue(queue, queueCommand=None):
+    """
+    List the queued jobs with the queueCommand, or with squeue (qstat for
+    SGE) for the jobs of the user, one line per job starting with its job ID.
+    Returns None when the command fails
+    """
+
+    user = os.environ.get("USER", "")
+    if queueCommand is not None:
+        command = shlex.split(queueCommand)
+    elif queue == "sge":
+        command = ["qstat", "-u", user]
+    else:
+        # One line per array task, giving the ID of its array job
+        command = ["squeue", "-h", "-r", "-u", user, "-o", "%F"]
+
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+
+    return process.stdout.splitlines()
+
+
+# States of sacct whose job is still in the queue
+SLURM_RUNNING_STATES = ("COMPLETING", "CONFIGURING", "REQUEUED", "RESIZING",
+                        "SUSPENDED", "STAGE_OUT")
+
+
+def refreshManifest(vsDir, queue, quiet=False, queueCommand=None):
+    """
+    Update the state and exit code of the jobs of the manifest of the VS that
+    were still queued, from sacct: pending, running, then the final state of
+    the job (completed, failed, timeout, cancelled, out_of_memory...). The
+    worker and node scripts are submitted as a job array: the array takes
+    the state of its tasks once they all left the queue (completed, or the
+    first other final state), and its highest exit code. With SGE, the jobs
+    that left the queue (qstat, or the queueCommand) are only marked as
+    ended, their exit code being unknown
+    """
+
+    connection = manifest.openManifest(vsDir)
+    if connection is None:
+        if not quiet:
+            print("\nNo manifest in " + vsDir + ", build the VS again with" +
+                  " vs_build.py to create it")
+        return
+
+    jobIDs = manifest.activeJobIDs(connection)
+    states = {}
+    for start in range(0, len(jobIDs), 500):
+        if queue == "sge":
+            break
+        accounting = sacctStates(jobIDs[start:start + 500])
+        if accounting is None:
+            if not quiet:
+                print("\nThe accounting could not be read (sacct)")
+            connection.close()
+            return
+        for jobID in jobIDs[start:start + 500]:
+            if jobID in accounting:
+                states[jobID] = accounting[jobID]
+                continue
+            tasks = [accounting[taskID] for taskID in accounting
+                     if taskID.startswith(jobID + "_")]
+            if tasks:
+                states[jobID] = arrayState(tasks)
+
+    if queue == "sge":
+        lines = listQueue(queue, queueCommand)
+        if lines is None:
+            if not quiet:
+                print("\nThe queue could not be read (qstat)")
+            connection.close()
+            return
+        queued = set(line.split()[0] for line in lines if line.split())
+        states = dict((jobID, ("ended", None)) for jobID in jobIDs
+                      if jobID not in queued)
+
+    manifest.recordStates(connection, states)
+
+    if not quiet:
+        print("\n" + str(len(states)) + " of the " + str(len(jobIDs)) +
+              " jobs queued before were updated in the manifest")
+        for repeat, state, sliceNum, ligandNum in \
+                manifest.stateCounts(connection):
+            print("\tREPEAT:" + str(repeat) + "\t" + state + ": " +
+                  str(sliceNum) + " slices, " + str(ligandNum) + " ligands")
+
+    connection.close()
+
+
+def sacctStates(jobIDs):
+    """
+    Read the state and exit code of the jobs (and of the tasks of the job
+    arrays) from sacct, as a dictionary of (state, exitCode) by job ID.
+    Returns None when sacct fails
+    """
+
+    command = ["sacct", "-n", "-P", "-X", "-o", "JobID,State,ExitCode",
+               "-j", ",".join(jobIDs)]
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 universal_newlines=True)
+    except OSError:
+        return None
+    if process.returncode != 0:
+        return None
+
+    states = {}
+    for line in process.stdout.splitlines():
+        ll = line.split("|")
+        if len(ll) < 3 or not ll[1]:
+            continue
+        # e.g. "CANCELLED by 1234"
+        state = ll[1].split()[0]
+        if state in SLURM_RUNNING_STATES:
+            state = "RUNNING"
+        exitCode = None
+        if ll[2].split(":")[0].isdigit():
+            exitCode = int(ll[2].split(":")[0])
+        states[ll[0]] = (state.lower(), exitCode)
+
+    return states
+
+
+def arrayState(tasks):
+    """
+    State and exit code of a job array, from the (state, exitCode) of its
+    tasks
+    """
+
+    stateList = [state for state, exitCode in tasks]
+    exitCodes = [exitCode for state, exitCode in tasks
+                 if exitCode is not None]
+    exitCode = max(exitCodes) if exitCodes else None
+
+    for state in manifest.ACTIVE_STATES[::-1]:
+        if state in stateList:
+            return state, None
+    for state in stateList:
+        if state != "completed":
+            return state, exitCode
+
+    return "completed", exitCode
+
+
+def superviseSlices(vsDir, queue, maxResubmits=3, memFactor=1.,
+                    timeFactor=1., maxArray=1000, poll=120.,
+                    queueCommand=None, pool=4, rate=5., retries=5):
+    """
+    Supervised mode: every poll seconds, update the state of the jobs in the
+    manifest, check the slices whose job ended, and resubmit the failed
+    ones, with their memory and walltime multiplied by memFactor and
+    timeFactor at each resubmission. A slice resubmitted maxResubmits times
+    is marked as exhausted. Runs until no slice of the VS is queued, then
+    reports the exhausted slices. The cancelled jobs are not resubmitted.
+    Returns whether all the slices ended (False when it was stopped before)
+    """
+
+    connection = manifest.openManifest(vsDir)
+
+    print("\nSUPERVISING: slices resubmitted at most " + str(maxResubmits) +
+          " times\n")
+
+    try:
+        while True:
+            refreshManifest(vsDir, queue, quiet=True,
+                            queueCommand=queueCommand)
+
+            checked = []
+            exhausted = []
+            failed = []
+            for row in manifest.endedSlices(connection):
+                sliceID, repeat, sliceIndex, ranges, script, jobID, state, \
+                    exitCode, resubmits = row
+                problem = sliceProblem(vsDir, script, ranges, jobID, state,
+                                       exitCode, queue)
+                if problem is None:
+                    checked.append(sliceID)
+                    continue
+                print("\tFAILED: " + script + " (" + ranges + ")\t" + problem)
+                if resubmits >= maxResubmits:
+                    exhausted.append(sliceID)
+                else:
+                    failed.append(row)
+
+            manifest.markChecked(connection, checked)
+            manifest.markChecked(connection, exhausted, "exhausted")
+            if failed:
+                resubmitSlices(connection, vsDir, queue, failed, memFactor,
+                               timeFactor, maxArray, pool, rate, retries)
+
+            active = manifest.activeCount(connection)
+            print(time.strftime("%Y-%m-%d_%H:%M:%S") + " queued slices:" +
+                  str(active) + ", checked:" + str(len(checked)) +
+                  ", resubmitted:" + str(len(failed)) + ", exhausted:" +
+                  str(len(exhausted)))
+            sys.stdout.flush()
+
+            if active == 0 and not failed:
+                break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        print("\nSupervision stopped, run the same command to resume it")
+        connection.close()
+        return False
+
+    print("\nSUPERVISION: all the slices ended")
+    exhausted = [row for row in manifest.failedSlices(connection)
+                 if row[4] == "exhausted"]
+    if exhausted:
+        print("\n" + str(len(exhausted)) + " slices failed " +
+              str(maxResubmits + 1) + " times and were not resubmitted:")
+    for repeat, ranges, script, jobID, state, exitCode in exhausted:
+        print("\t" + script + "\tranges:" + ranges + "\tlast job:" +
+              str(jobID))
+
+    connection.close()
+
+    return True
+
+
+# Lines of the job outputs reporting an error of the job, rather than of ICM
+JOB_ERRORS = re.compile(r"error|killed|oom|segmentation fault|cancelled|" +
+                        r"license", re.IGNORECASE)
+
+
+def sliceProblem(vsDir, script, ranges, jobID, state, exitCode, queue):
+    """
+    Check a slice whose job ended: its state and exit code, the FINISHED
+    line ICM writes at the end of the .ou file of each ID range, and the
+    output of the job (slurm-<jobID>.out, or <name>.o<jobID> for SGE).
+    Returns the problem found, or None when the slice is complete
+    """
+
+    if state not in ("completed", "ended"):
+        return "job " + state + ", exit code " + str(exitCode)
+    if exitCode:
+        return "exit code " + str(exitCode)
+
+    repeatDir = os.path.join(vsDir, os.path.dirname(script))
+    dtbPaths = glob.glob(os.path.join(repeatDir, "*.dtb"))
+    if dtbPaths:
+        projName = os.path.basename(dtbPaths[0])[:-len(".dtb")]
+        for lowerLimit, upperLimit in [r.split("-") for r
+                                       in ranges.split(",")]:
+            ouName = projName + "_" + upperLimit + ".ou"
+            ouPath = os.path.join(repeatDir, ouName)
+            if not os.path.exists(ouPath):
+                return ouName + " missing"
+            with ouscan.mapOuFile(ouPath) as data:
+                if data.find(b"FINISHED") == -1:
+                    return ouName + " truncated"
+
+    if queue == "sge":
+        outName = os.path.splitext(os.path.basename(script))[0] + ".o" + \
+            str(jobID)
+    else:
+        outName = "slurm-" + str(jobID) + ".out"
+    outPath = os.path.join(repeatDir, outName)
+    if os.path.exists(outPath):
+        with open(outPath, errors="replace") as f:
+            for line in f:
+                if JOB_ERRORS.search(line):
+                    return "error in " + outName + ": " + line.strip()
+
+    return None
+
+
+def resubmitSlices(connection, vsDir, queue, failed, memFactor=1.,
+                   timeFactor=1., maxArray=1000, pool=4, rate=5., retries=5):
+    """
+    Resubmit the failed slices (rows of manifest.endedSlices), and record
+    their new job in the manifest. The failed tasks of a job array chunk are
+    resubmitted together, as an array of these tasks only
+    """
+
+    groups = {}
+    for sliceID, repeat, sliceIndex, ranges, script, jobID, state, \
+            exitCode, resubmits in failed:
+        offset = 0
+        if queue == "slurm-array":
+            offset = (sliceIndex - 1) // maxArray * maxArray
+        groups.setdefault((script, offset, resubmits), []).append(
+            (sliceID, sliceIndex - offset))
+
+    submissions = []
+    for (script, offset, resubmits), tasks in sorted(groups.items()):
+        scriptPath = os.path.join(vsDir, script)
+        command = resubmitCommand(scriptPath, queue, resubmits + 1, memFactor,
+                                  timeFactor)
+        label = scriptPath
+        if queue == "slurm-array":
+            label += ":" + str(offset)
+            command += ["--array=" + ",".join(str(task) for sliceID, task
+                                              in tasks),
+                        "--export=ALL,SLICE_OFFSET=" + str(offset)]
+        command.append(os.path.basename(script))
+        submissions.append((label, os.path.dirname(os.path.abspath(
+            scriptPath)), command))
+
+    print("\nRESUBMITTING " + str(len(failed)) + " slices:")
+    results = submitJobs(submissions, pool, rate, retries)
+
+    sliceJobIDs = []
+    for (label, jobID), tasks in zip(results, [tasks for key, tasks
+                                               in sorted(groups.items())]):
+        for sliceID, task in tasks:
+            if jobID is not None and queue == "slurm-array":
+                sliceJobIDs.append((sliceID, jobID + "_" + str(task)))
+            else:
+                sliceJobIDs.append((sliceID, jobID))
+    manifest.recordResubmission(connection, sliceJobIDs)
+
+
+def resubmitCommand(scriptPath, queue, resubmit, memFactor=1.,
+                    timeFactor=1.):
+    """
+    Submission command of a script, without the script, requesting the
+    memory and walltime of the script multiplied by memFactor and
+    timeFactor once per resubmission
+    """
+
+    if queue == "sge":
+        command = ["qsub", "-terse"]
+    else:
+        command = ["sbatch", "--parsable"]
+
+    with open(scriptPath) as f:
+        script = f.read()
+
+    resources = []
+    memMatch = re.search(r"--mem=(\d+)|h_vmem=(\d+)([MG])", script)
+    if memFactor > 1 and memMatch is not None:
+        if memMatch.group(1) is not None:
+            mem = int(memMatch.group(1))
+        else:
+            mem = int(memMatch.group(2)) * \
+                (1024 if memMatch.group(3) == "G" else 1)
+        mem = int(math.ceil(mem * memFactor ** resubmit))
+        if queue == "sge":
+            resources.append("h_vmem=" + str(mem) + "M")
+        else:
+            command.append("--mem=" + str(mem))
+
+    timeMatch = re.search(r"(?:--time=|h_rt=)(\S+)", script)
+    if timeFactor > 1 and timeMatch is not None:
+        seconds = vs_build.walltimeSeconds(timeMatch.group(1)) * \
+            timeFactor ** resubmit
+        if queue == "sge":
+            resources.append("h_rt=" + str(int(math.ceil(seconds))))
+        else:
+            command.append("--time=" + vs_build.formatWalltime(seconds))
+
+    if resources:
+        command += ["-l", ",".join(resources)]
+
+    return command
+
+
+# Memory of the aggregation job per core, in MB
+AGGREGATE_MEM = 4096
+
+
+def submitAggregate(vsDir, queue, jobIDs, dependency="afterany",
+                    resultsArgs="", cores=1, walltime="0-04:00:00",
+                    retries=5):
+    """
+    Write the aggregation job of the VS and submit it, held until the jobs
+    given ended (SLURM dependency, or SGE hold on their job IDs). Job array
+    IDs hold it until all their tasks ended
+    """
+
+    scriptPath = writeAggregateScript(vsDir, queue, resultsArgs, cores,
+                                      walltime)
+
+    if queue == "sge":
+        command = ["qsub", "-terse"]
+        if jobIDs:
+            command += ["-hold_jid", ",".join(jobIDs)]
+    else:
+        command = ["sbatch", "--parsable"]
+        if jobIDs:
+            command.append("--dependency=" + dependency + ":" +
+                           ":".join(jobIDs))
+    command.append(os.path.basename(scriptPath))
+
+    print("\nAGGREGATION: " + os.path.basename(scriptPath) + ", waiting for " +
+          str(len(jobIDs)) + " jobs")
+    submitJobs([(scriptPath, os.path.dirname(os.path.abspath(scriptPath)),
+                 command)], retries=retries, vsDir=vsDir)
+
+
+def writeAggregateScript(vsDir, queue, resultsArgs="", cores=1,
+                         walltime="0-04:00:00"):
+    """
+    Write the aggregation job script in the VS directory, running
+    vs_results.py on the VS with a process per core (each argument quoted
+    for the shell). Returns its path
+    """
+
+    vsPath = os.path.abspath(vsDir)
+    # The job name is given unquoted to the scheduler
+    jobName = "aggregate_" + re.sub(r"[^\w.-]", "_", os.path.basename(vsPath))
+    resultsPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "vs_results.py")
+    resultsCommand = " ".join(shlex.quote(arg) for arg in
+                              [sys.executable, resultsPath, vsPath,
+                               "--jobs", str(cores)] +
+                              shlex.split(resultsArgs))
+
+    lines = []
+    if queue == "sge":
+        lines.append("#!/bin/sh")
+        lines.append("#$ -S /bin/sh")
+        lines.append("#$ -l h_rt=" + str(vs_build.walltimeSeconds(walltime)))
+        lines.append("#$ -l h_vmem=" + str(AGGREGATE_MEM) + "M")
+        lines.append("#$ -q hqu9")
+        if cores > 1:
+            lines.append("#$ -pe smp " + str(cores))
+        lines.append("#$ -cwd")
+        lines.append("#$ -N " + jobName)
+        scriptPath = os.path.join(vsDir, jobName + ".sge")
+    else:
+        lines.append("#!/bin/bash")
+        lines.append("#SBATCH --mem=" + str(cores * AGGREGATE_MEM))
+        lines.append("#SBATCH --time=" + walltime)
+        lines.append("#SBATCH --job-name=" + jobName)
+        lines.append("#SBATCH --account=monash063")
+        lines.append("#SBATCH --ntasks=1")
+        lines.append("#SBATCH --cpus-per-task=" + str(cores))
+        scriptPath = os.path.join(vsDir, jobName + ".slurm")
+    lines.append("")
+    lines.append(resultsCommand)
+
+    with open(scriptPath, "w") as f:
+        f.write("\n".join(lines))
+
+    return scriptPath
+
+
+def submittedJobIDs(vsDir, submissions):
+    """
+    Job IDs of the submissions already made since the VS was built, by label
+    relative to the VS directory: the job ID recorded in the manifest for the
+    slices of each script (or job array chunk), which vs_build.py resets
+    when it writes the scripts again. A VS built before the manifest existed
+    falls back to its jobs.tsv file
+    """
+
+    connection = manifest.openManifest(vsDir)
+    if connection is None:
+        return readJobIDs(vsDir)
+    sliceJobIDs = manifest.sliceJobIDs(connection)
+    connection.close()
+
+    submitted = {}
+    for label, directory, command in submissions:
+        label = os.path.relpath(label, vsDir)
+        script, sep, offset = label.partition(":")
+        scriptJobIDs = sliceJobIDs.get(script, {})
+        if not sep:
+            jobIDs = list(scriptJobIDs.values())
+        else:
+            # The slices of a job array chunk hold the ID of their task
+            offset = int(offset)
+            jobIDs = [scriptJobIDs[sliceIndex].rpartition("_")[0]
+                      for sliceIndex in range(offset + 1, offset +
+                                              arraySize(command) + 1)
+                      if sliceIndex in scriptJobIDs]
+        if jobIDs:
+            submitted[label] = jobIDs[0]
+
+    return submitted
+
+
+def readJobIDs(vsDir):
+    """
+    Read the jobs.tsv file of the VS directory into a dictionary of the job
+    ID of each submitted script
+    """
+
+    jobIDs = {}
+    jobsPath = os.path.join(vsDir, "jobs.tsv")
+    if not os.path.exists(jobsPath):
+        return jobIDs
+
+    with open(jobsPath) as f:
+        for line in f:
+            ll = line.rstrip("\n").split("\t")
+            if len(ll) >= 2:
+                jobIDs[ll[0]] = ll[1]
+
+    return jobIDs
+
+
+def writeJobIDs(vsDir, results):
+    """
+    Append the job ID of each submitted script to the jobs.tsv file of the VS
+    directory (script, job ID, date), for the submissions that succeeded
+    """
 
-        # Get the directory name and the file name separately
-        queueDir = os.path.dirname(queueFullPath)
-        queueFile = os.path.basename(queuePath)
-        # print queuePath, queueDir
-
-        # Change to that repeat directory
-        # queuePath = os.path.joindir(cwd, queueDir)
-        os.chdir(queueDir)
-        # And submit using either SLURM or SGE queueing
-        # system depending on what was chosen
-        if queue == "slurm":
-            # print "sbatch " + queueFile
-            os.system("sbatch " + queueFile)
-        elif queue == "sge":
-            # print "qsub " + queueFile
-            os.system("qsub " + queueFile)
-        time.sleep(1)
+    date = time.strftime("%Y-%m-%d_%H:%M:%S")
+    with open(os.path.join(vsDir, "jobs.tsv"), "a") as f:
+        for label, jobID in results:
+            if jobID is not None:
+                f.write(os.path.relpath(label, vsDir) + "\t" + jobID + "\t" +
+                        date + "\n")
 
 
 if __name__ == "__main__":
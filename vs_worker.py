@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+# Worker of a VS built with the slurm-pull queuing system. Each worker job
+# claims the next chunk of ligands not docked yet from the queue of a repeat
+# directory, docks it with ICM, marks it done and claims the next one, until
+# the queue is empty or its walltime is nearly used up. The queue is a log
+# file shared by all workers, locked while a chunk is claimed. The node jobs of
+# the slurm-node queuing system run one worker per core.
+#
+# https://github.com/thomas-coudrat/toolbx_vs
+# Thomas Coudrat <thomas.coudrat@gmail.com>
+
+import os
+import argparse
+import fcntl
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import vs_build
+
+# Seconds a claim lasts unless its worker renews it. A worker renews the claim
+# of the chunk it docks every third of this time, so the chunk of a worker
+# that died is claimed again shortly after, rather than at its walltime
+CLAIM_LEASE = 600.
+
+
+def main():
+    """
+    Run script
+    """
+
+    repeatDirs, projName, thor, walltime, margin, chunkTime, slot = \
+        parseArgs()
+
+    icmHome = os.environ.get("ICMHOME")
+    if icmHome is None:
+        print("The ICMHOME environment variable must be set for your system." +
+              " Exiting.")
+        sys.exit()
+
+    workerID = getWorkerID(slot)
+    startTime = time.time()
+    deadline = startTime + vs_build.walltimeSeconds(walltime)
+
+    # Drain the queue of each repeat directory in turn
+    for repeatDir in repeatDirs:
+        chunkTime = runQueue(repeatDir, projName, thor, icmHome, workerID,
+                             deadline, margin, chunkTime)
+
+
+def parseArgs():
+    """
+    Define arguments, parse and return them
+    """
+
+    descr = "Dock the chunks of ligands claimed from the queue of VS repeat" \
+        " directories, until they are empty or the walltime is nearly used"
+    descr_repeatDirs = "Repeat directories whose queue is drained, in order"
+    descr_projName = "ICM project name"
+    descr_thor = "Thoroughness of the docking (format: 5.)"
+    descr_walltime = "Walltime of the worker job (format: 1-24:00:00)"
+    descr_margin = "Seconds kept free at the end of the walltime. Default" \
+        " is 300"
+    descr_chunkTime = "Expected docking time of a chunk in seconds, until" \
+        " chunks have been docked by this worker. Default is 0 (the first" \
+        " chunk is always claimed)"
+    descr_slot = "Slot of this worker in its job, when a job runs several" \
+        " workers"
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument("repeatDirs", nargs="+", help=descr_repeatDirs)
+    parser.add_argument("--projName", required=True, help=descr_projName)
+    parser.add_argument("--thor", required=True, help=descr_thor)
+    parser.add_argument("--walltime", required=True, help=descr_walltime)
+    parser.add_argument("--margin", type=float, default=300.,
+                        help=descr_margin)
+    parser.add_argument("--chunkTime", type=float, default=0.,
+                        help=descr_chunkTime)
+    parser.add_argument("--slot", help=descr_slot)
+
+    args = parser.parse_args()
+
+    return args.repeatDirs, args.projName, args.thor, args.walltime, \
+        args.margin, args.chunkTime, args.slot
+
+
+def getWorkerID(slot=None):
+    """
+    Identify this worker in the queue: its SLURM job (and array task), or its
+    host and process, followed by its slot in the job if any
+    """
+
+    jobID = os.environ.get("SLURM_JOB_ID")
+    if jobID is None:
+        return socket.gethostname() + ":" + str(os.getpid())
+
+    taskID = os.environ.get("SLURM_ARRAY_TASK_ID")
+    if taskID is not None:
+        jobID = os.environ.get("SLURM_ARRAY_JOB_ID", jobID) + "_" + taskID
+
+    if slot is not None:
+        jobID += "." + slot
+
+    return jobID
+
+
+def runQueue(repeatDir, projName, thor, icmHome, workerID, deadline, margin,
+             chunkTime):
+    """
+    Claim, dock and mark as done the chunks of the queue of a repeat
+    directory, as long as a chunk is expected to finish before the deadline
+    (minus the margin). The expected time of a chunk is the longest chunk
+    docked so far by this worker. Returns that expected time.
+    A chunk is marked done with its docking time and the exit status of ICM
+    (the first non-zero status of its ID ranges), so that failed chunks are
+    not claimed again but can be found in the queue log
+    """
+
+    chunks = readChunks(repeatDir)
+
+    while time.time() + chunkTime + margin < deadline:
+        chunkIndex = claimChunk(repeatDir, chunks, workerID, deadline)
+        if chunkIndex is None:
+            break
+
+        # Renew the claim while the chunk is docked
+        docked = threading.Event()
+        heartbeat = threading.Thread(target=renewClaim,
+                                     args=(repeatDir, chunkIndex, workerID,
+                                           deadline, docked))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        chunkStart = time.time()
+        status = 0
+        for lowerLimit, upperLimit in chunks[chunkIndex]:
+            rangeStatus = dockRange(repeatDir, projName, thor, icmHome,
+                                    lowerLimit, upperLimit)
+            if status == 0:
+                status = rangeStatus
+        chunkSeconds = time.time() - chunkStart
+
+        docked.set()
+        heartbeat.join()
+
+        writeQueue(repeatDir, "done", chunkIndex, workerID,
+                   str(int(chunkSeconds)) + " " + str(status))
+        chunkTime = max(chunkTime, chunkSeconds)
+
+    return chunkTime
+
+
+def readChunks(repeatDir):
+    """
+    Read the chunk table written by vs_build.py (one line per ID range: chunk
+    index, from, to) into a dictionary of the ID ranges of each chunk
+    """
+
+    chunks = {}
+    with open(os.path.join(repeatDir, "chunks.tsv")) as f:
+        for line in f:
+            ll = line.split()
+            if len(ll) == 3:
+                chunks.setdefault(int(ll[0]), []).append((int(ll[1]),
+                                                          int(ll[2])))
+
+    return chunks
+
+
+def claimChunk(repeatDir, chunks, workerID, deadline):
+    """
+    Claim the first chunk that is neither done nor claimed by a worker still
+    running: a claim lapses after CLAIM_LEASE seconds (or at the deadline of
+    its worker) unless it is renewed, so that the chunks of workers killed
+    before finishing them are docked again. The queue log is locked while it
+    is read and the claim is written. Returns the chunk index, or None when
+    there is nothing left to claim
+    """
+
+    now = time.time()
+
+    with open(os.path.join(repeatDir, "queue.log"), "a+") as queueFile:
+        fcntl.lockf(queueFile, fcntl.LOCK_EX)
+        try:
+            done, claims = readQueue(queueFile)
+
+            for chunkIndex in sorted(chunks.keys()):
+                if chunkIndex in done or \
+                        claims.get(chunkIndex, ("", 0.))[1] > now:
+                    continue
+                queueFile.write("claim " + str(chunkIndex) + " " + workerID +
+                                " " + str(int(min(now + CLAIM_LEASE,
+                                                  deadline))) + "\n")
+                queueFile.flush()
+                os.fsync(queueFile.fileno())
+                return chunkIndex
+        finally:
+            fcntl.lockf(queueFile, fcntl.LOCK_UN)
+
+    return None
+
+
+def renewClaim(repeatDir, chunkIndex, workerID, deadline, docked):
+    """
+    Renew the claim of a chunk every third of CLAIM_LEASE until the docked
+    event is set, as long as the chunk is still claimed by this worker (a
+    worker stalled past its lease may have lost it to another)
+    """
+
+    while not docked.wait(CLAIM_LEASE / 3.):
+        with open(os.path.join(repeatDir, "queue.log"), "a+") as queueFile:
+            fcntl.lockf(queueFile, fcntl.LOCK_EX)
+            try:
+                done, claims = readQueue(queueFile)
+                if chunkIndex in done or \
+                        claims.get(chunkIndex, ("", 0.))[0] != workerID:
+                    return
+                queueFile.write("claim " + str(chunkIndex) + " " + workerID +
+                                " " + str(int(min(time.time() + CLAIM_LEASE,
+                                                  deadline))) + "\n")
+                queueFile.flush()
+                os.fsync(queueFile.fileno())
+            finally:
+                fcntl.lockf(queueFile, fcntl.LOCK_UN)
+
+
+def readQueue(queueFile):
+    """
+    Read a locked queue log from its start: returns the set of the chunks
+    done, and the (worker, lapse time) of the latest claim of each chunk
+    """
+
+    queueFile.seek(0)
+    done = set()
+    claims = {}
+    for line in queueFile:
+        ll = line.split()
+        if len(ll) < 4:
+            continue
+        if ll[0] == "done":
+            done.add(int(ll[1]))
+        elif ll[0] == "claim":
+            claims[int(ll[1])] = (ll[2], float(ll[3]))
+
+    return done, claims
+
+
+def writeQueue(repeatDir, status, chunkIndex, workerID, value):
+    """
+    Append a line to the queue log of a repeat directory, while it is locked
+    """
+
+    with open(os.path.join(repeatDir, "queue.log"), "a") as queueFile:
+        fcntl.lockf(queueFile, fcntl.LOCK_EX)
+        try:
+            queueFile.write(status + " " + str(chunkIndex) + " " + workerID +
+                            " " + str(value) + "\n")
+            queueFile.flush()
+            os.fsync(queueFile.fileno())
+        finally:
+            fcntl.lockf(queueFile, fcntl.LOCK_UN)
+
+
+def dockRange(repeatDir, projName, thor, icmHome, lowerLimit, upperLimit):
+    """
+    Run the ICM docking of the ligands lowerLimit to upperLimit in the repeat
+    directory, writing to the .ou file named after upperLimit, as the slice
+    scripts do. Returns the exit status of ICM
+    """
+
+    ouPath = os.path.join(repeatDir, projName + "_" + str(upperLimit) + ".ou")
+    with open(ouPath, "w") as ouFile:
+        return subprocess.call([icmHome + "/icm64", "-vlscluster",
+                                icmHome + "/_dockScan", projName,
+                                "thorough=" + thor, "from=" + str(lowerLimit),
+                                "to=" + str(upperLimit)],
+                               cwd=repeatDir, stdout=ouFile,
+                               stderr=subprocess.STDOUT)
+
+
+if __name__ == "__main__":
+    main()